@@ -0,0 +1,212 @@
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .quidem import Quidem, Action
+
+# Append-only log of the actions accepted by a quidem session, with periodic snapshots
+#
+# each entry is a JSON list [seq, action, sender, target_consumer_id, body] on its own line
+# every snapshot_interval entries the state of the session is saved along with the offset of the next entry,
+# a session is rebuilt from its latest snapshot and the entries after it, so at most snapshot_interval entries are replayed
+# the log itself keeps every entry from the start of the session, replay() runs it again, ie. for offline benchmarks
+# entries and snapshots are serialized by the host, the files are written by a writer thread so the event loop never waits on the disk
+
+# removal of a consumer that disconnected, the only entry that is not an Action sent by a client
+DISCONNECT = 'disconnect'
+
+class ActionLogError(Exception):
+    pass
+
+# writes the files of every log of the process in the order they were recorded
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='quidem-action-log')
+
+# applies an entry to the quidem the same way the session host applied the action
+def apply_entry(quidem, entry):
+    _, action, sender, target_consumer_id, body = entry
+    if action == Action.NEXT_PHASE.value:
+        quidem.next_phase()
+    elif action == Action.CLOSE_SESSION.value:
+        quidem.force_close()
+    elif action == Action.CHANGE_SETTING.value:
+        quidem.change_settings(body)
+    elif action == Action.JOIN.value:
+        quidem.new_consumers(body['nicknames'])
+    elif action == DISCONNECT:
+        quidem.force_remove_consumer(target_consumer_id)
+    else:
+        quidem.process_action(action, sender, target_consumer_id, body)
+
+# reads the entries of a log file from the start, a line cut short by a crash ends the log
+def read_entries(path, offset=0):
+    with open(path, 'rb') as log_file:
+        log_file.seek(offset)
+        for line in log_file:
+            if not line.endswith(b'\n'):
+                return
+            yield json.loads(line)
+
+# replays entries on top of quidem, a new session when not given, and returns it
+def replay(entries, quidem=None):
+    if quidem is None:
+        quidem = Quidem()
+    for entry in entries:
+        apply_entry(quidem, entry)
+    return quidem
+
+class ActionLog():
+
+    def __init__(self, path=None, snapshot_interval=100):
+        self.path = path # the log is only kept in memory without a path
+        self.snapshot_interval = snapshot_interval
+        self.seq = 0 # seq of the last entry
+        self._snapshot = None # (seq, offset of the next entry in the log file, quidem.to_dict())
+        self._tail = [] # entries after the snapshot
+        self._file = None
+        self._offset = 0 # size of the log file once the writes queued so far are done
+        self._pending = None # future of the last write queued
+        self._error = None # first write that failed
+        if path is not None:
+            self._file = open(path, 'ab')
+            self._offset = self._file.tell()
+
+    @property
+    def snapshot_path(self):
+        return self.path + '.snapshot'
+
+    # opens an existing log where it left off
+    @classmethod
+    def load(cls, path, snapshot_interval=100):
+        try:
+            with open(path + '.snapshot') as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except FileNotFoundError:
+            raise ActionLogError(f'{path} has no snapshot')
+
+        tail = []
+        end = snapshot['offset']
+        with open(path, 'rb') as log_file:
+            log_file.seek(end)
+            for line in log_file:
+                if not line.endswith(b'\n'):
+                    break
+                tail.append(json.loads(line))
+                end += len(line)
+            # drops a line cut short by a crash, new entries would be appended to it otherwise
+            log_file.seek(0, os.SEEK_END)
+            if log_file.tell() != end:
+                os.truncate(path, end)
+
+        action_log = cls(path, snapshot_interval)
+        action_log._snapshot = (snapshot['seq'], snapshot['offset'], snapshot['state'])
+        action_log._tail = tail
+        action_log.seq = tail[-1][0] if tail else snapshot['seq']
+        return action_log
+
+    # appends an accepted action, and takes a snapshot of quidem once the tail is long enough
+    def record(self, quidem, action, sender, target_consumer_id=None, body=None):
+        self.seq += 1
+        entry = [self.seq, action, sender, target_consumer_id, body]
+        self._tail.append(entry)
+        if self._file is not None:
+            line = json.dumps(entry, separators=(',', ':')).encode() + b'\n'
+            self._offset += len(line)
+            self._queue(self._write_line, self._file, line)
+        if len(self._tail) >= self.snapshot_interval:
+            self.snapshot(quidem)
+
+    def snapshot(self, quidem):
+        offset = self._offset if self._file is not None else None
+        self._snapshot = (self.seq, offset, quidem.to_dict())
+        self._tail = []
+        if self.path is not None:
+            data = json.dumps({'seq': self.seq, 'offset': offset, 'state': self._snapshot[2]})
+            self._queue(self._write_snapshot, self.snapshot_path, data)
+
+    def _queue(self, func, *args):
+        self._pending = _writer.submit(func, *args)
+        self._pending.add_done_callback(self._check_write)
+
+    # called back by the writer thread, the writes after a failed one are still attempted
+    def _check_write(self, future):
+        if self._error is None:
+            self._error = future.exception()
+
+    @staticmethod
+    def _write_line(log_file, line):
+        log_file.write(line)
+        log_file.flush()
+
+    # written aside and renamed, so a crash never leaves a partial snapshot
+    @staticmethod
+    def _write_snapshot(path, data):
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as snapshot_file:
+            snapshot_file.write(data)
+        os.replace(temp_path, path)
+
+    # blocks until the files hold every entry and snapshot recorded so far, raises the error of a failed write
+    # drain() waits the same way without blocking the event loop
+    def wait(self):
+        if self._pending is not None:
+            self._check_write(self._pending)
+        if self._error is not None:
+            raise self._error
+
+    # the session as of the last entry
+    def rebuild(self):
+        if self._snapshot is None:
+            raise ActionLogError('The action log has no snapshot to rebuild the session from')
+        return replay(self._tail, Quidem.from_dict(self._snapshot[2]))
+
+    async def drain(self):
+        if self._pending is not None:
+            await asyncio.wait([asyncio.wrap_future(self._pending)])
+        self.wait()
+
+    # the file is closed once the writes queued before are done, drain() waits for them
+    def close(self):
+        if self._file is not None:
+            self._queue(self._file.close)
+            self._file = None
+
+def _get_path(quidem_id):
+    directory = getattr(settings, 'QUIDEM_ACTION_LOG_DIR', None)
+    if directory is None:
+        return None
+    return os.path.join(directory, f'quidem_{quidem_id}.log')
+
+# the log of the QUIDEM_ACTION_LOG_DIR setting for a session being hosted, None when actions are not logged
+# a session hosted again, ie. by another worker, carries on with its existing log when resume is set
+# a new session starts a log of its own, the log of an older session with the same id is dropped
+def open_action_log(quidem, resume=False):
+    path = _get_path(quidem.quidem_id)
+    if path is None:
+        return None
+    snapshot_interval = getattr(settings, 'QUIDEM_SNAPSHOT_INTERVAL', 100)
+    if resume and os.path.exists(path + '.snapshot'):
+        action_log = ActionLog.load(path, snapshot_interval)
+    else:
+        # removed rather than truncated, the writes still queued for the older session go to the removed files
+        for stale_path in (path, path + '.snapshot'):
+            try:
+                os.remove(stale_path)
+            except FileNotFoundError:
+                pass
+        action_log = ActionLog(path, snapshot_interval)
+    action_log.snapshot(quidem)
+    return action_log
+
+# rebuilds a session from its log, None when it has none
+def recover_session(quidem_id):
+    path = _get_path(quidem_id)
+    if path is None or not os.path.exists(path + '.snapshot'):
+        return None
+    action_log = ActionLog.load(path)
+    try:
+        return action_log.rebuild()
+    finally:
+        action_log.close()
@@ -0,0 +1,92 @@
+from array import array
+from collections.abc import MutableMapping, ValuesView
+
+# Compact storage for the ballots of a session
+# every ballot is kept as a length followed by its nomination ids in one contiguous array of fixed width ints,
+# the offset table links each consumer id to the start of its ballot
+# reads hand back plain lists, so the store can be used wherever a dict of consumer_id -> vote_set was
+
+class BallotStore(MutableMapping):
+
+    TYPECODE = 'i'
+
+    def __init__(self, ballots=None):
+        self._buffer = array(BallotStore.TYPECODE)
+        self._offsets = {}
+        self._garbage = 0 # slots of the buffer held by replaced or removed ballots
+        if ballots:
+            self.update(ballots)
+
+    def __getitem__(self, consumer_id):
+        offset = self._offsets[consumer_id]
+        return self._buffer[offset + 1:offset + 1 + self._buffer[offset]].tolist()
+
+    # raises OverflowError when a nomination id does not fit the fixed width
+    def __setitem__(self, consumer_id, vote_set):
+        ballot = array(BallotStore.TYPECODE, vote_set)
+        offset = self._offsets.get(consumer_id)
+
+        # a reordered ballot of the same length is overwritten in place
+        if offset is not None and self._buffer[offset] == len(ballot):
+            self._buffer[offset + 1:offset + 1 + len(ballot)] = ballot
+            return
+
+        if offset is not None:
+            self._garbage += self._buffer[offset] + 1
+        self._offsets[consumer_id] = len(self._buffer)
+        self._buffer.append(len(ballot))
+        self._buffer.extend(ballot)
+        self._compact_if_sparse()
+
+    def __delitem__(self, consumer_id):
+        offset = self._offsets.pop(consumer_id)
+        self._garbage += self._buffer[offset] + 1
+        self._compact_if_sparse()
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, consumer_id):
+        return consumer_id in self._offsets
+
+    def __repr__(self):
+        return f'BallotStore({self.as_dict()})'
+
+    def values(self):
+        return BallotValues(self)
+
+    # returns the buffer and the offset of each ballot, in consumer order, with no replaced ballots left in between
+    # each ballot is its length at its offset followed by that many nomination ids
+    def pack(self):
+        if self._garbage:
+            self._compact()
+        return self._buffer, list(self._offsets.values())
+
+    def as_dict(self):
+        return {consumer_id: self[consumer_id] for consumer_id in self._offsets}
+
+    # bytes held by the ballots themselves, not counting the offset table
+    @property
+    def buffer_size(self):
+        return self._buffer.itemsize * len(self._buffer)
+
+    def _compact_if_sparse(self):
+        if self._garbage and self._garbage * 2 >= len(self._buffer):
+            self._compact()
+
+    def _compact(self):
+        buffer = array(BallotStore.TYPECODE)
+        for consumer_id, offset in self._offsets.items():
+            self._offsets[consumer_id] = len(buffer)
+            buffer.extend(self._buffer[offset:offset + 1 + self._buffer[offset]])
+        self._buffer = buffer
+        self._garbage = 0
+
+# values view that lets batched tallies read the packed buffer instead of one list per ballot
+class BallotValues(ValuesView):
+
+    def pack(self):
+        return self._mapping.pack()
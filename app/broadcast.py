@@ -0,0 +1,86 @@
+import time
+
+# Coalesces bursts of state changes into a single broadcast
+#
+# a broadcast goes out once no change was requested for `window` seconds,
+# and never later than `max_delay` seconds after the first request it covers
+# broadcast() performs the broadcast, call_later(delay) has to call on_timer() after delay seconds
+# a window of 0 broadcasts on every request
+
+class BroadcastScheduler():
+
+    # counts across every scheduler of the process
+    totals = {
+        'requested': 0,
+        'broadcasts': 0
+    }
+
+    def __init__(self, broadcast, call_later, window=0.05, max_delay=0.25, clock=time.monotonic):
+        self.window = window
+        self.max_delay = max_delay
+        self.requested = 0
+        self.broadcasts = 0
+
+        self._broadcast = broadcast
+        self._call_later = call_later
+        self._clock = clock
+        self._first_request = None # time of the oldest request not broadcast yet
+        self._deadline = None
+        self._armed = False # whether a call to on_timer is pending
+
+    @property
+    def pending(self):
+        return self._first_request is not None
+
+    # broadcasts the pending requests would have cost on their own, minus the ones actually sent
+    @property
+    def saved(self):
+        return self.requested - self.broadcasts - (1 if self.pending else 0)
+
+    def request(self):
+        self.requested += 1
+        BroadcastScheduler.totals['requested'] += 1
+        if self.window <= 0:
+            self._flush()
+            return
+
+        now = self._clock()
+        if self._first_request is None:
+            self._first_request = now
+        self._deadline = min(now + self.window, self._first_request + self.max_delay)
+        if not self._armed:
+            self._armed = True
+            self._call_later(self._deadline - now)
+
+    # the deadline only moves later, so a single timer is re-armed until it is reached
+    def on_timer(self):
+        self._armed = False
+        if not self.pending:
+            return
+        now = self._clock()
+        if now >= self._deadline:
+            self._flush()
+        else:
+            self._armed = True
+            self._call_later(self._deadline - now)
+
+    # broadcasts right away if anything is pending
+    def flush(self):
+        if self.pending:
+            self._flush()
+
+    def _flush(self):
+        self._first_request = None
+        self._deadline = None
+        self.broadcasts += 1
+        BroadcastScheduler.totals['broadcasts'] += 1
+        self._broadcast()
+
+    def metrics(self):
+        return {
+            'requested': self.requested,
+            'broadcasts': self.broadcasts,
+            'saved': self.saved,
+            'window': self.window,
+            'max_delay': self.max_delay
+        }
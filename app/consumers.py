@@ -1,83 +1,86 @@
 from enum import Enum
 from os import path
+import itertools
 import json
+import time
 
-from channels.generic.websocket import JsonWebsocketConsumer
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from channels.layers import get_channel_layer
-from django.core.cache import cache
-from asgiref.sync import async_to_sync
+from django.conf import settings
 
 from .quidem import Quidem, Action, Phase, ActionError
+from .session_host import SessionHost
+from .worker_pool import get_worker_pool
+from . import session_ids, metrics
+from .profiling import profiled
+from .wire import negotiate
 
 # first request sends quidem id
-# if id == cached next_quidem_id, make a new quidem instance and increment next_quidem_id
-# else request join
+# the first connection to an allocated id makes a new quidem instance
+# else request join, the author answers with the consumer id and the current state
+# the session is hosted by the consumer of the author, or by a worker of the pool when QUIDEM_WORKERS is set
 
 class QuidemConsumerError(Exception):
     pass
 
-class QuidemConsumer(JsonWebsocketConsumer):
+class QuidemConsumer(AsyncJsonWebsocketConsumer):
 
     DEFAULT_NICKNAME = 'Anonymous'
 
     ### Consumer methods
 
     # receives code from author
-    def connect(self):
+    async def connect(self):
 
-        next_quidem_id = cache.get('next_quidem_id')
+        self.state_version = None # version of the last state sent to the client
+        self._vote = None # ballot of this consumer as last acknowledged by the host
+        self._awaiting_snapshot = False
+        self.host = None # session host, when the author consumer hosts the session itself
+        self.codec = negotiate(self.scope.get('subprotocols')) # encoding of the frames, see wire
+        self._counted = False # whether the consumer is counted in metrics.CONSUMERS
+        self._join_requested_at = None
+        self._message_ids = itertools.count() # numbers the messages sent to the host, see _send_to_host
 
         query_data = self.scope['path'].split('/')[-2].split('&')
         self.quidem_id = int(query_data[0])
         self.client_key = int(query_data[1])
         self.nickname = query_data[2]
 
-        if self.quidem_id > next_quidem_id: # requested a quidem with an id > the expected next id
+        if not session_ids.is_allocated(self.quidem_id): # requested a quidem id that was never handed out
             raise QuidemConsumerError('Invalid Quidem ID')
         else:
             self.group_name = self.get_group()
+            if metrics.enabled():
+                self._counted = True
+                metrics.CONSUMERS.inc()
 
-            # join quidem
-            if self.quidem_id < next_quidem_id:
-                self.consumer_id = None
+            # create quidem session
+            if session_ids.claim_session(self.quidem_id):
+                await self._create_quidem()
 
-                self.cache_key = str(self.quidem_id) + '&' + str(self.client_key)
-                cache.set(self.cache_key, None)
+            # join quidem, the consumer id and the state arrive with the answer of the author
+            else:
+                self.consumer_id = None
 
-                async_to_sync(self.channel_layer.group_add)(
+                await self.channel_layer.group_add(
                     self.group_name,
                     self.channel_name
                 )
-                self.accept()
-                self._make_join_request()
-
-                # # if failed to join, close connection
-                # if not self.consumer_id:
-                #     self.close()
-                #     return
-
-            # create quidem session
-            else:
-                self._create_quidem()
-                cache.set('next_quidem_id', next_quidem_id + 1, None)
+                await self.accept(self.codec.subprotocol)
+                await self._make_join_request()
 
         if self.consumer_id == Quidem.AUTHOR:
-            async_to_sync(self.channel_layer.group_add)(
+            await self.channel_layer.group_add(
                 self.group_name,
                 self.channel_name
             )
-            self.accept()
-            self._send_obj({
+            await self.accept(self.codec.subprotocol)
+            await self._send_obj({
                 'type': 'join',
                 'key': self.client_key,
                 'consumer_id': self.consumer_id
             })
-            async_to_sync(self.channel_layer.group_send)(
-                self.group_name,
-                {
-                    'type': 'broadcast_updated_state'
-                }
-            )
+            await self._host_session()
 
     def get_group(self):
         return f'quidem_{self.quidem_id}'
@@ -85,208 +88,229 @@ class QuidemConsumer(JsonWebsocketConsumer):
     def get_author_group(self):
         return f'author_quidem_{self.quidem_id}'
 
-    def _send_obj(self, obj):
-        self.send(text_data=json.dumps(obj))
+    async def _send_obj(self, obj):
+        await self._send_frame(self.codec.encode(obj))
+
+    async def _send_frame(self, frame):
+        if metrics.enabled():
+            encoding = 'msgpack' if self.codec.binary else 'json'
+            metrics.SENT_FRAMES.inc(encoding)
+            metrics.SENT_BYTES.inc(encoding, amount=len(frame))
+        if self.codec.binary:
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    # binary frames are decoded by the codec negotiated on connect
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if bytes_data is not None:
+            await self.receive_json(self.codec.decode(bytes_data), **kwargs)
+        else:
+            await super().receive(text_data, bytes_data, **kwargs)
 
-    def receive_json(self, content):
+    @profiled
+    async def receive_json(self, content):
+        # not admitted to the session yet
         if self.consumer_id is None:
-            self.consumer_id = cache.get(self.cache_key)
-            cache.delete(self.cache_key)
-            if not self.consumer_id:
-                self.close()
-                return
+            return
 
-            self._send_obj({
-                'type': 'join',
-                'key': self.client_key,
-                'consumer_id': self.consumer_id
-            })
-            print('JOINING', self.consumer_id)
-            async_to_sync(self.channel_layer.group_send)(
-                self.group_name,
-                {
-                    'type': 'broadcast_updated_state'
-                }
-            )
+        # clients that lost track of the state versions ask for a full state
+        # a list of actions is forwarded as one message, the host applies them as a unit
+        if isinstance(content, dict) and content.get('action') == Action.RESYNC_STATE.value:
+            await self._request_state_snapshot()
             return
-        if self.consumer_id != Quidem.AUTHOR:
-            async_to_sync(self.channel_layer.group_send)(
-                self.get_author_group(),
-                {
-                    'type': 'process_action',
-                    'content': content,
-                    'sender': self.consumer_id
-                }
-            )
-        else:
-            self.process_action({'content':content, 'sender': self.consumer_id})
-
-    # receives quidem event and calls next method
-    def process_action(self, obj):
-
-        content = obj['content']
-
-        action = content.get('action')
-        sender = int(obj['sender'])
-        target_consumer_id = content.get('consumer_id')
-        if target_consumer_id is not None:
-            target_consumer_id = int(target_consumer_id)
-        body = content.get('body')
-
-         # closes quidem session
-        if action == Action.CLOSE_SESSION.value:
-            if sender == Quidem.AUTHOR:
-                self.quidem.force_close()
-                self._send_disconnect()
-                self.close()
-
-        # Ends session if phase is CLOSED
-        elif action == Action.NEXT_PHASE.value:
-            if sender == Quidem.AUTHOR:
-                self.quidem.next_phase()
-                self.broadcast_updated_state()
-
-                # Ends session if phase is CLOSED
-                if self.quidem.phase == Phase.CLOSED.value:
-                    self._send_disconnect()
-                    self.close()
-
-                print(self.quidem.phase)
-
-        # Changes Quidem settings
-        elif action == Action.CHANGE_SETTING.value:
-            if sender == Quidem.AUTHOR:
-                updated_settings = {
-                    'voting_algorithm': int(body.get('voting_algorithm', self.quidem.settings['voting_algorithm'])),
-                    'max_voting_slots': self.quidem.settings['max_voting_slots'],
-                    'question': self.quidem.settings['question']
-                }
-                if self.quidem.phase.value < Phase.VOTING.value:
-                    updated_settings['max_voting_slots'] = int(body.get('max_voting_slots', self.quidem.settings['max_voting_slots']))
-                    if self.quidem.phase.value == Phase.PRE_OPENING.value:
-                        updated_settings['question'] = body.get('question', self.quidem.settings['question'])
-                self.quidem.settings = updated_settings
-                self.broadcast_updated_state()
 
+        if self.host is None:
+            await self._send_to_host({
+                'type': 'process_action',
+                'content': content,
+                'sender': self.consumer_id,
+                'channel_name': self.channel_name
+            })
         else:
-            try:
-                if self.quidem.process_action(action, sender, target_consumer_id, body):
-                    if action == Action.REMOVE_USER.value:
-                        self._send_disconnect(target_consumer_id)
-                    self.broadcast_updated_state()
-            # sends any potential ActionError's in processing the action back to the client
-            except ActionError as err:
-                print('\n\n-----ERROR--------')
-                print(err)
-                print('\n\n')
-
-    def disconnect(self, close_code):
-        if self.consumer_id:
+            await self.host.process_action({'content':content, 'sender': self.consumer_id, 'channel_name': self.channel_name})
+
+    async def disconnect(self, close_code):
+        if self._counted:
+            self._counted = False
+            metrics.CONSUMERS.dec()
+        if self.consumer_id is not None:
             # group_discards the author group
             if self.consumer_id == Quidem.AUTHOR:
-                async_to_sync(self.channel_layer.group_discard)(
+                await self.channel_layer.group_discard(
                     self.get_author_group(),
                     self.channel_name
                 )
+                # the session hosted by this consumer or by a worker goes away with it
+                if self.host is not None:
+                    await self.host.author_left({})
+                    self.host = None
+                elif get_worker_pool() is not None:
+                    await self._send_to_host({'type': 'author.left'})
             else:
-                async_to_sync(self.channel_layer.group_send)(
-                    self.get_author_group(),
-                    {
-                        'type': 'disconnect_consumer',
-                        'consumer_id': self.consumer_id
-                    }
-                )
+                await self._send_to_host({
+                    'type': 'disconnect_consumer',
+                    'consumer_id': self.consumer_id
+                })
+
+    ### messages for the host of the session, only handled by the author consumer when it hosts the session
+
+    @profiled
+    async def process_action(self, obj):
+        if self.host is not None:
+            await self.host.process_action(obj)
+
+    async def disconnect_consumer(self, obj):
+        if self.host is not None:
+            await self.host.disconnect_consumer(obj)
+
+    @profiled
+    async def broadcast_updated_state(self, obj):
+        if self.host is not None:
+            await self.host.broadcast_updated_state(obj)
+
+    async def flush_broadcast(self, obj):
+        if self.host is not None:
+            await self.host.flush_broadcast(obj)
+
+    async def send_state_snapshot(self, obj):
+        if self.host is not None:
+            await self.host.send_state_snapshot(obj)
+
+    async def response_to_join_request(self, obj):
+        if self.host is not None:
+            await self.host.response_to_join_request(obj)
+
+    async def admit_joins(self, obj):
+        if self.host is not None:
+            await self.host.admit_joins(obj)
 
-    def disconnect_consumer(self, obj):
-        consumer_id = obj['consumer_id']
-        if not self.quidem.has_consumer(consumer_id) and self.quidem.phase.value < Phase.CLOSED.value:
-            self.quidem.force_remove_consumer(consumer_id)
-            self.broadcast_updated_state()
+    async def apply_votes(self, obj):
+        if self.host is not None:
+            await self.host.apply_votes(obj)
 
     ### other methods
 
-    # sends the updated state to all consumers, who then send it to the client end
-    def broadcast_updated_state(self, obj=None):
-        if self.consumer_id != Quidem.AUTHOR:
-            return
-        async_to_sync(self.channel_layer.group_send)(
-            self.group_name,
-            {
-                'type': 'send_updated_state',
-                'author': False,
-                'state': self.quidem.get_state(),
-                'votes': self.quidem._votes
-            }
-        )
-        async_to_sync(self.channel_layer.group_send)(
-            self.get_author_group(),
-            {
-                'type': 'send_updated_state',
-                'author': True,
-                'state': self.quidem.get_state(True)
-            }
-        )
+    # messages to the host carry the quidem_id, so a worker hosting many sessions can route them
+    # and an id, so a worker that gets a message twice while the session moves applies it once
+    async def _send_to_host(self, message):
+        message['quidem_id'] = self.quidem_id
+        message['message_id'] = f'{self.channel_name}:{next(self._message_ids)}'
+        await self.channel_layer.group_send(self.get_author_group(), message)
+
+    async def _request_state_snapshot(self):
+        self._awaiting_snapshot = True
+        await self._send_to_host({
+            'type': 'send_state_snapshot',
+            'author': self.consumer_id == Quidem.AUTHOR,
+            'channel_name': self.channel_name
+        })
 
     # only sends the state if the state is designated to that consumer's role
-    def send_updated_state(self, obj):
-        if (self.consumer_id == Quidem.AUTHOR) == obj['author']:
-            state = dict(obj['state'])
-            state['vote'] = state['votes'].get(self.consumer_id)
-            state['user'] = self.consumer_id
-            if self.consumer_id != Quidem.AUTHOR:
-                del state['votes']
-                state['nickname'] = self.nickname
-                state['calculated_votes'] = state['calculated_votes'][0:1]
-            self._send_obj({
-                'type': 'state',
-                'state': state
-            })
+    @profiled
+    async def send_updated_state(self, obj):
+        if self.consumer_id is None or (self.consumer_id == Quidem.AUTHOR) != obj['author']:
+            return
 
-    # method that sends message through channel to call response_to_join_request on the author consumer instance
-    def _make_join_request(self):
-        async_to_sync(self.channel_layer.group_send)(
-            self.get_author_group(),
-            {
-                'type': 'response.to.join.request',
-                'cache_key': self.cache_key,
-                'nickname': self.nickname
+        if 'state' in obj:
+            # a state the client already holds is only sent again when it asked for it
+            if self.state_version is not None and (obj['version'] < self.state_version or (obj['version'] == self.state_version and not self._awaiting_snapshot)):
+                return
+            self.state_version = obj['version']
+            self._awaiting_snapshot = False
+            fields = {
+                'vote': self._vote,
+                'user': self.consumer_id
             }
-        )
+            if self.consumer_id != Quidem.AUTHOR:
+                fields['nickname'] = self.nickname
+            await self._send_frame(self.codec.state_frame(obj['version'], obj['state'], fields))
 
+        # deltas only apply on top of the version the client holds, otherwise it gets a full snapshot
+        elif not self._awaiting_snapshot and (self.state_version is None or obj['version'] > self.state_version):
+            if obj['base_version'] != self.state_version:
+                await self._request_state_snapshot()
+                return
+            self.state_version = obj['version']
+            await self._send_frame(self.codec.delta_frame(obj['version'], obj['base_version'], obj['delta'], {}))
+
+    # the ballot of this consumer only ever comes from the host straight to its channel, it is set on the state as is
+    async def vote_updated(self, obj):
+        if obj['vote'] != self._vote:
+            self._vote = obj['vote']
+            await self._send_obj({
+                'type': 'vote',
+                'vote': self._vote
+            })
 
-    # method called on author consumer instance from visitor consumer requesting to join quidem session
-    def response_to_join_request(self, obj):
-        if self.consumer_id == Quidem.AUTHOR:
-            if self.quidem.phase is Phase.PRE_VOTING:
-                consumer_id = self.quidem.new_consumer(obj['nickname'])
-                cache.set(obj['cache_key'], consumer_id)
-
-    # broadcasts a disconnection event to all consumers in the group
-    def _send_disconnect(self, consumer_filter=None):
-        async_to_sync(self.channel_layer.group_send)(
-            self.group_name,
-            {
-                'type': 'filtered.disconnect.consumer',
-                'filter': consumer_filter
-            }
-        )
+    # how each action of a batch went, sent to the consumer that sent the batch
+    async def actions_result(self, obj):
+        await self._send_obj({
+            'type': 'actions',
+            'applied': obj['applied'],
+            'results': obj['results']
+        })
+
+    # asks the host to admit this consumer, the answer is sent straight back to its channel
+    async def _make_join_request(self):
+        if metrics.enabled():
+            self._join_requested_at = time.perf_counter()
+        await self._send_to_host({
+            'type': 'response.to.join.request',
+            'channel_name': self.channel_name,
+            'nickname': self.nickname
+        })
+
+    async def join_accepted(self, obj):
+        if self.consumer_id is not None:
+            return
+        self.consumer_id = obj['consumer_id']
+        if self._join_requested_at is not None:
+            metrics.JOIN_SECONDS.observe(time.perf_counter() - self._join_requested_at)
+        await self._send_obj({
+            'type': 'join',
+            'key': self.client_key,
+            'consumer_id': self.consumer_id
+        })
+        await self.send_updated_state(obj['state'])
+
+    async def join_rejected(self, obj):
+        if self.consumer_id is None:
+            await self.close()
 
     # disconnects specific consumer
-    def filtered_disconnect_consumer(self, obj):
-        consumer_filter = obj.get('consumer_filter')
+    async def filtered_disconnect_consumer(self, obj):
+        consumer_filter = obj.get('filter')
 
-        # only removes if not the author and if the filter matches the consumer's id
-        if self.consumer_id != Quidem.AUTHOR and (not consumer_filter or self.consumer_id == consumer_filter):
-            self.close()
+        # the author only leaves when the session closes, others if the filter matches the consumer's id
+        if self.consumer_id == Quidem.AUTHOR:
+            if obj.get('author'):
+                await self.close()
+        elif consumer_filter is None or self.consumer_id == consumer_filter:
+            await self.close()
 
-    # creates quidem instance
-    def _create_quidem(self):
+    # makes this consumer the author of the new session
+    async def _create_quidem(self):
         author_group_name = self.get_author_group()
 
-        self.quidem = Quidem(quidem_id=self.quidem_id)
         self.consumer_id = Quidem.AUTHOR
 
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             author_group_name,
             self.channel_name
         )
+
+    # hosts the session in this consumer, or has the worker that owns it host it
+    async def _host_session(self):
+        pool = get_worker_pool()
+        if pool is None:
+            self.host = SessionHost(Quidem(quidem_id=self.quidem_id), self.channel_layer, self.channel_name)
+            await self.host.broadcast_updated_state()
+        else:
+            await self.channel_layer.send(
+                pool.worker_for(self.quidem_id),
+                {
+                    'type': 'quidem.host',
+                    'quidem_id': self.quidem_id
+                }
+            )
@@ -0,0 +1,48 @@
+import heapq
+
+# Results of a session ranked by descending votes, ties keep the order the results were given in
+#
+# the results are kept in a binary heap, the best K are read in O(K log K) by walking down from its root
+# so views showing a few results never sort the thousands of nominations of a brainstorm
+# the full ranking, needed for rank lookups or a complete list, is only sorted once when first asked for
+
+class Leaderboard():
+
+    # results - tally results ({'nomination', 'nomination_id', 'votes'}), shared with the callers so never mutated
+    def __init__(self, results=()):
+        self._heap = [(-result['votes'], order, result) for order, result in enumerate(results)]
+        heapq.heapify(self._heap)
+        self._ranking = None # every result in order, sorted on first use
+        self._ranks = None # nomination_id -> rank
+
+    def __len__(self):
+        return len(self._heap)
+
+    # the best count results, all of them when count is None
+    def top(self, count=None):
+        if count is None or count >= len(self._heap):
+            return list(self._get_ranking())
+        elif self._ranking is not None:
+            return self._ranking[0:count]
+
+        # the next best result is always the best child of one already taken, or the root
+        results = []
+        frontier = [(self._heap[0], 0)] if count > 0 else []
+        while len(results) < count:
+            (_, _, result), index = heapq.heappop(frontier)
+            results.append(result)
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < len(self._heap):
+                    heapq.heappush(frontier, (self._heap[child], child))
+        return results
+
+    # position of the nomination in the ranking starting at 1, None when it has no result
+    def rank(self, nomination_id):
+        if self._ranks is None:
+            self._ranks = {result['nomination_id']: rank for rank, result in enumerate(self._get_ranking(), 1)}
+        return self._ranks.get(nomination_id)
+
+    def _get_ranking(self):
+        if self._ranking is None:
+            self._ranking = [result for _, _, result in sorted(self._heap)]
+        return self._ranking
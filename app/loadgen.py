@@ -0,0 +1,330 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+from channels.testing import WebsocketCommunicator
+
+from .quidem import Quidem, Action, Phase
+from .state_delta import apply_delta
+from . import session_ids, wire
+
+# Load generator driving the websocket application with simulated clients, all in this process
+#
+# every room runs the lifecycle of a session: the author opens it, its users join and nominate, the author opens
+# the voting, the users vote, and the author moves on to the results and closes the session
+# the clients only speak the websocket protocol through WebsocketCommunicator, as the consumer tests do
+#
+# reported per run:
+# join latency - from connecting until the client got its consumer id
+# action-to-broadcast latency - from a user sending an action until the author receives a state holding it
+# frames/sec - frames received by every client over the whole run
+#
+# the server and the clients share one event loop, so the numbers are those of a single worker carrying the rooms
+# run with `python -m app.loadgen --rooms 4 --users 500`, the in-memory channel layer is used unless --channel-layer settings
+
+# seconds a client waits for a frame it expects before the run gives up on it
+DEFAULT_TIMEOUT = 30
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+# latencies in seconds and counters of a run, shared by every room
+class LoadStats():
+
+    PERCENTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self):
+        self.join_latencies = []
+        self.action_latencies = {} # action name -> latencies
+        self.frames = 0
+        self.frame_bytes = 0
+        self.rejected = 0 # users closed before they got a consumer id
+        self.lost = 0 # actions the author never saw in its state
+        self.elapsed = None
+
+    def add_action_latency(self, name, latency):
+        self.action_latencies.setdefault(name, []).append(latency)
+
+    def _describe(self, latencies):
+        if not latencies:
+            return {'count': 0}
+        description = {'count': len(latencies), 'max': max(latencies)}
+        for fraction in self.PERCENTILES:
+            description[f'p{round(fraction * 100)}'] = percentile(latencies, fraction)
+        return description
+
+    def to_dict(self):
+        return {
+            'elapsed': self.elapsed,
+            'frames': self.frames,
+            'frame_bytes': self.frame_bytes,
+            'frames_per_second': self.frames / self.elapsed if self.elapsed else None,
+            'rejected': self.rejected,
+            'lost': self.lost,
+            'join': self._describe(self.join_latencies),
+            'actions': {name: self._describe(latencies) for name, latencies in self.action_latencies.items()}
+        }
+
+    def format(self):
+        summary = self.to_dict()
+        lines = [
+            f'{summary["frames"]} frames in {self.elapsed:.2f}s, {summary["frames_per_second"]:.0f} frames/sec, '
+            f'{summary["rejected"]} rejected, {summary["lost"]} lost'
+        ]
+        for name, description in [('join', summary['join']), *summary['actions'].items()]:
+            if description['count']:
+                lines.append(f'{name}: {description["count"]}, ' + ', '.join(
+                    f'{key} {value * 1000:.1f}ms' for key, value in description.items() if key != 'count'
+                ))
+        return '\n'.join(lines)
+
+# a simulated client, its frames are read by a task of its own until the server closes the socket
+class Client():
+
+    def __init__(self, application, stats, session_id, key, nickname, subprotocol=None):
+        self.stats = stats
+        self.codec = wire.negotiate([subprotocol] if subprotocol else None)
+        self.communicator = WebsocketCommunicator(
+            application,
+            f'ws/quidem/{session_id}&{key}&{nickname}/',
+            subprotocols=[subprotocol] if subprotocol else None
+        )
+        self.consumer_id = None
+        self.joined = asyncio.Event()
+        self.closed = asyncio.Event()
+        self._reader = None
+
+    async def connect(self, timeout=DEFAULT_TIMEOUT):
+        connected, _ = await self.communicator.connect(timeout=timeout)
+        if not connected:
+            self.closed.set()
+            return False
+        self._reader = asyncio.ensure_future(self._read())
+        return True
+
+    async def send(self, content):
+        if self.codec.binary:
+            await self.communicator.send_to(bytes_data=self.codec.encode(content))
+        else:
+            await self.communicator.send_to(text_data=self.codec.encode(content))
+
+    # a timeout of receive_output cancels the consumer, so the reader waits as long as the run lasts
+    async def _read(self):
+        try:
+            while True:
+                message = await self.communicator.receive_output(timeout=None)
+                if message['type'] == 'websocket.close':
+                    return
+                frame = message.get('bytes') if message.get('bytes') is not None else message.get('text')
+                self.stats.frames += 1
+                self.stats.frame_bytes += len(frame)
+                self.on_frame(frame)
+        finally:
+            self.closed.set()
+
+    def on_frame(self, frame):
+        # users only look into their frames until they joined, the author tracks the whole state
+        if self.consumer_id is None:
+            content = self.codec.decode(frame)
+            if content.get('type') == 'join':
+                self.consumer_id = content['consumer_id']
+                self.joined.set()
+
+    async def disconnect(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        await self.communicator.disconnect()
+
+# the author of a room, keeps the state it is sent so it can tell when the actions of the users reached it
+class AuthorClient(Client):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.state = None
+        self.version = None
+        self._pending = {} # (action name, id in the state) -> time it was sent
+        self._settled = asyncio.Event()
+        self._settled.set()
+        self._changed = asyncio.Event()
+
+    def on_frame(self, frame):
+        content = self.codec.decode(frame)
+        if content.get('type') == 'join':
+            self.consumer_id = content['consumer_id']
+            self.joined.set()
+        elif content.get('type') == 'state':
+            self.state = content['state']
+            self.version = content['version']
+            self._state_received()
+        elif content.get('type') == 'state_delta' and self.state is not None:
+            self.state = apply_delta(self.state, content['delta'])
+            self.version = content['version']
+            self._state_received()
+
+    # waits for the action to show up in the state, the latency is recorded once it does
+    def expect(self, name, state_id):
+        self._pending[(name, str(state_id))] = time.perf_counter()
+        self._settled.clear()
+
+    def _state_received(self):
+        received_at = time.perf_counter()
+        nomination_ids = {str(nomination['nomination_id']) for nomination in self.state.get('nominations', [])}
+        votes = {str(consumer_id) for consumer_id in self.state.get('votes', {})}
+        for (name, state_id), sent_at in list(self._pending.items()):
+            if (name == 'nominate' and state_id in nomination_ids) or (name == 'vote' and state_id in votes):
+                self.stats.add_action_latency(name, received_at - sent_at)
+                del self._pending[(name, state_id)]
+        if not self._pending:
+            self._settled.set()
+        self._changed.set()
+
+    # waits until every expected action arrived, the ones still missing after the timeout count as lost
+    async def settle(self, timeout=DEFAULT_TIMEOUT):
+        try:
+            await asyncio.wait_for(self._settled.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.stats.lost += len(self._pending)
+            self._pending.clear()
+            self._settled.set()
+
+    # waits for a state in the given phase
+    async def wait_for_phase(self, phase, timeout=DEFAULT_TIMEOUT):
+        async def wait():
+            while self.state is None or self.state.get('phase') != phase.value:
+                self._changed.clear()
+                await self._changed.wait()
+        await asyncio.wait_for(wait(), timeout)
+
+    async def act(self, action, body=None):
+        await self.send({'action': action.value, 'consumer_id': Quidem.AUTHOR, 'body': body})
+
+async def _spread_out(spread, rng):
+    if spread:
+        await asyncio.sleep(rng.uniform(0, spread))
+
+# runs the lifecycle of one room with users simulated users
+# spread - seconds the joins, nominations and votes of the users are randomly spread over, 0 sends them all at once
+async def run_room(application, stats, users, spread=0, slots=3, subprotocol=None, timeout=DEFAULT_TIMEOUT, seed=0):
+    rng = random.Random(seed)
+    session_id = session_ids.allocate_session()
+    author = AuthorClient(application, stats, session_id, 0, 'author', subprotocol)
+    if not await author.connect(timeout):
+        raise RuntimeError(f'The author of session {session_id} could not connect')
+    await author.act(Action.NEXT_PHASE)
+    await author.wait_for_phase(Phase.PRE_VOTING, timeout)
+
+    # joins
+    async def join(key):
+        await _spread_out(spread, rng)
+        client = Client(application, stats, session_id, key, f'user{key}', subprotocol)
+        start = time.perf_counter()
+        if await client.connect(timeout):
+            joined = asyncio.ensure_future(client.joined.wait())
+            closed = asyncio.ensure_future(client.closed.wait())
+            await asyncio.wait([joined, closed], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            joined.cancel()
+            closed.cancel()
+        if client.consumer_id is None:
+            stats.rejected += 1
+            await client.disconnect()
+            return None
+        stats.join_latencies.append(time.perf_counter() - start)
+        return client
+
+    clients = [client for client in await asyncio.gather(*(join(key) for key in range(1, users + 1))) if client is not None]
+
+    # nominations, a user nomination shows up under the negated consumer id
+    async def nominate(client):
+        await _spread_out(spread, rng)
+        author.expect('nominate', -client.consumer_id)
+        await client.send({'action': Action.NOMINATE.value, 'consumer_id': client.consumer_id, 'body': {'nomination': f'nomination of {client.consumer_id}'}})
+
+    await asyncio.gather(*(nominate(client) for client in clients))
+    await author.settle(timeout)
+
+    # votes
+    await author.act(Action.NEXT_PHASE)
+    await author.wait_for_phase(Phase.VOTING, timeout)
+    nomination_ids = [nomination['nomination_id'] for nomination in author.state['nominations']]
+
+    async def vote(client):
+        await _spread_out(spread, rng)
+        author.expect('vote', client.consumer_id)
+        vote_set = rng.sample(nomination_ids, min(slots, len(nomination_ids)))
+        await client.send({'action': Action.VOTE.value, 'consumer_id': client.consumer_id, 'body': {'vote_set': vote_set}})
+
+    await asyncio.gather(*(vote(client) for client in clients))
+    await author.settle(timeout)
+
+    # results, then every client is sent away
+    await author.act(Action.NEXT_PHASE)
+    await author.wait_for_phase(Phase.POST_VOTING, timeout)
+    start = time.perf_counter()
+    await author.act(Action.CLOSE_SESSION)
+    await asyncio.wait_for(asyncio.gather(*(client.closed.wait() for client in [author, *clients])), timeout)
+    stats.add_action_latency('close', time.perf_counter() - start)
+
+    for client in [author, *clients]:
+        await client.disconnect()
+
+# runs the rooms at the same time, returns the LoadStats of the run
+async def run_load(application, rooms=1, users=100, spread=0, slots=3, subprotocol=None, timeout=DEFAULT_TIMEOUT, seed=0):
+    stats = LoadStats()
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        run_room(application, stats, users, spread, slots, subprotocol, timeout, seed + room) for room in range(rooms)
+    ))
+    stats.elapsed = time.perf_counter() - start
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Drives the Quidem websocket application with simulated clients')
+    parser.add_argument('--rooms', type=int, default=1, help='sessions run at the same time')
+    parser.add_argument('--users', type=int, default=100, help='users joining each session')
+    parser.add_argument('--spread', type=float, default=0, help='seconds the actions of the users are spread over')
+    parser.add_argument('--slots', type=int, default=3, help='nominations on each ballot')
+    parser.add_argument('--subprotocol', help='websocket subprotocol of the clients, ie. quidem.msgpack')
+    parser.add_argument('--channel-layer', choices=['memory', 'settings'], default='memory',
+        help='in-memory channel layer, or the one configured in the settings (ie. a local redis)')
+    parser.add_argument('--setting', action='append', default=[], metavar='NAME=VALUE',
+        help='overrides a setting for the run, the value is read as JSON, ie. QUIDEM_BROADCAST_WINDOW=0.05')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help='seconds to wait for an expected frame')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='file the results are written to')
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
+    import django
+    from django.conf import settings
+    django.setup()
+    if args.channel_layer == 'memory':
+        settings.CHANNEL_LAYERS = {
+            'default': {
+                'BACKEND': 'channels.layers.InMemoryChannelLayer',
+                'CONFIG': {
+                    'capacity': 100000
+                }
+            }
+        }
+        # the whole run is one process, the session ids need no shared cache
+        settings.QUIDEM_SESSION_ID_CACHE = None
+    for setting in args.setting:
+        name, _, value = setting.partition('=')
+        setattr(settings, name, json.loads(value))
+    from .routing import application
+
+    stats = asyncio.run(run_load(
+        application, args.rooms, args.users, args.spread, args.slots, args.subprotocol, args.timeout, args.seed
+    ))
+    print(f'{args.rooms} rooms of {args.users} users')
+    print(stats.format())
+    if args.json:
+        with open(args.json, 'w') as output_file:
+            json.dump(stats.to_dict(), output_file, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
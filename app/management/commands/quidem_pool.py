@@ -0,0 +1,43 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import worker_pool
+
+# Reports the sessions hosted by each worker of the pool, and spreads the sessions over other workers
+#
+# ie. `manage.py quidem_pool --workers quidem-worker-0 quidem-worker-1` before stopping quidem-worker-2,
+# which hands its sessions over to the two others, then `manage.py quidem_pool` once it hosts none
+
+class Command(BaseCommand):
+
+    help = 'Reports the sessions hosted by each worker of the pool, or spreads the sessions over the given workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', nargs='+', help='channels of the workers to spread the sessions over, out of QUIDEM_WORKERS')
+        parser.add_argument('--timeout', type=float, default=5, help='seconds to wait for the report of the workers')
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'QUIDEM_WORKERS', None):
+            raise CommandError('QUIDEM_WORKERS is empty, every session is hosted by the consumer of its author')
+        worker_pool.check_settings()
+        channel_layer = get_channel_layer()
+
+        workers = options['workers']
+        if workers:
+            unknown = sorted(set(workers) - set(settings.QUIDEM_WORKERS))
+            if unknown:
+                raise CommandError(f'Not in QUIDEM_WORKERS: {", ".join(unknown)}')
+            async_to_sync(worker_pool.rebalance)(channel_layer, workers)
+
+        # the workers that left the pool are asked as well, until they have handed every session over
+        reported = sorted(settings.QUIDEM_WORKERS)
+        report = async_to_sync(worker_pool.request_report)(channel_layer, reported, options['timeout'])
+        pool = worker_pool.get_pool_workers()
+        for worker in reported:
+            state = 'in the pool' if worker in pool else 'out of the pool'
+            if worker in report:
+                self.stdout.write(f'{worker} ({state}): {len(report[worker])} sessions')
+            else:
+                self.stdout.write(f'{worker} ({state}): no answer')
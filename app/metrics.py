@@ -0,0 +1,172 @@
+import bisect
+
+from django.conf import settings
+
+from .broadcast import BroadcastScheduler
+from .quidem import Action
+
+# Counters, gauges and histograms of this process, served in the Prometheus text format by the /metrics/ view
+#
+# instrumented code checks enabled() before measuring anything, so with QUIDEM_METRICS off a measurement
+# costs one setting lookup and the values are never touched
+# every process keeps its own values, ie. each worker of the pool is scraped on its own
+# the values are only updated from the event loop of the process, the view only reads them
+
+def enabled():
+    return getattr(settings, 'QUIDEM_METRICS', False)
+
+# label value of an action number
+def action_label(action):
+    try:
+        return Action(action).name.lower()
+    except ValueError:
+        return 'unknown'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric():
+
+    type = None
+
+    # labelnames - names of the labels, their values are passed in the same order to inc, observe, etc.
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {} # label values -> value
+        (REGISTRY if registry is None else registry).register(self)
+
+    def reset(self):
+        self._values = {}
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in sorted(self._values.items()):
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{labels} {_format_value(value)}')
+        return '\n'.join(lines)
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+# a counter kept elsewhere, its value is read from function when rendered
+class CounterFunction(Metric):
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, function, registry=None):
+        super().__init__(name, documentation, (), registry)
+        self.function = function
+
+    def value(self):
+        return self.function()
+
+    def samples(self):
+        yield self.name, '', self.function()
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    # seconds, from a fast action up to a stalled broadcast
+    DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    # the value of a histogram is [count per bucket, with the overflow last, sum]
+    def observe(self, value, *labels):
+        observed = self._values.get(labels)
+        if observed is None:
+            observed = self._values[labels] = [[0] * (len(self.buckets) + 1), 0]
+        observed[0][bisect.bisect_left(self.buckets, value)] += 1
+        observed[1] += value
+
+    def value(self, *labels):
+        observed = self._values.get(labels)
+        return sum(observed[0]) if observed is not None else 0
+
+    def samples(self):
+        for labels, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', _format_labels(self.labelnames, labels, [('le', _format_value(bound))]), cumulative
+            yield f'{self.name}_sum', _format_labels(self.labelnames, labels), total
+            yield f'{self.name}_count', _format_labels(self.labelnames, labels), cumulative
+
+class Registry():
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self.metrics[metric.name] = metric
+
+    def reset(self):
+        for metric in self.metrics.values():
+            metric.reset()
+
+    # text exposition format, version 0.0.4
+    def render(self):
+        return ''.join(metric.render() + '\n' for metric in self.metrics.values())
+
+REGISTRY = Registry()
+
+ACTION_SECONDS = Histogram('quidem_action_seconds', 'Time the session host took to process an action', ['action'])
+ACTION_ERRORS = Counter('quidem_action_errors_total', 'Actions the session refused', ['action'])
+VOTES_SUPERSEDED = Counter('quidem_votes_superseded_total', 'Ballots replaced by a newer ballot of the same voter before they were applied')
+BROADCAST_FANOUT = Histogram(
+    'quidem_broadcast_fanout', 'Consumers a state broadcast is sent to', ['view'],
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+)
+BROADCAST_BYTES = Counter('quidem_broadcast_bytes_total', 'Bytes of the states and deltas broadcast, times their fan-out', ['kind'])
+SENT_FRAMES = Counter('quidem_sent_frames_total', 'Websocket frames sent to the clients', ['encoding'])
+SENT_BYTES = Counter('quidem_sent_bytes_total', 'Bytes of the websocket frames sent to the clients', ['encoding'])
+SESSIONS = Gauge('quidem_sessions', 'Sessions hosted by this process')
+CONSUMERS = Gauge('quidem_consumers', 'Websocket consumers connected to this process')
+JOIN_SECONDS = Histogram('quidem_join_seconds', 'Time from a join request until the user was admitted')
+BROADCAST_REQUESTS = CounterFunction(
+    'quidem_broadcast_requests_total', 'State changes that asked for a broadcast', lambda: BroadcastScheduler.totals['requested']
+)
+BROADCASTS = CounterFunction(
+    'quidem_broadcasts_total', 'State broadcasts sent after coalescing the requests', lambda: BroadcastScheduler.totals['broadcasts']
+)
@@ -0,0 +1,90 @@
+# Index of every nomination in a session
+# author nominations get increasing ids that are never reused, a user nomination is keyed by the negative of its consumer_id,
+# so removing a nomination never shifts the id of another one a ballot may point at
+
+class NominationIndex():
+
+    def __init__(self):
+        self._author_nominations = {}
+        self._user_nominations = {}
+        self._next_author_id = 0
+        self._view = None
+        self._pairs = None
+
+    # returns the nomination_id given to the author nomination
+    def add_author_nomination(self, nomination):
+        nomination_id = self._next_author_id
+        self._next_author_id += 1
+        self._author_nominations[nomination_id] = nomination
+        self._invalidate()
+        return nomination_id
+
+    # a user has at most one nomination, nominating again replaces it
+    def set_user_nomination(self, consumer_id, nomination):
+        self._user_nominations[-consumer_id] = nomination
+        self._invalidate()
+        return -consumer_id
+
+    def remove(self, nomination_id):
+        if nomination_id in self._user_nominations:
+            del self._user_nominations[nomination_id]
+        elif nomination_id in self._author_nominations:
+            del self._author_nominations[nomination_id]
+        else:
+            return False
+        self._invalidate()
+        return True
+
+    def get(self, nomination_id, default=None):
+        if nomination_id in self._user_nominations:
+            return self._user_nominations[nomination_id]
+        return self._author_nominations.get(nomination_id, default)
+
+    def __contains__(self, nomination_id):
+        return nomination_id in self._user_nominations or nomination_id in self._author_nominations
+
+    def __len__(self):
+        return len(self._author_nominations) + len(self._user_nominations)
+
+    @property
+    def author_nominations(self):
+        return list(self._author_nominations.values())
+
+    @property
+    def user_nominations(self):
+        return dict(self._user_nominations)
+
+    def to_dict(self):
+        return {
+            'author_nominations': [[nomination_id, nomination] for nomination_id, nomination in self._author_nominations.items()],
+            'user_nominations': [[nomination_id, nomination] for nomination_id, nomination in self._user_nominations.items()],
+            'next_author_id': self._next_author_id
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls()
+        index._author_nominations = {nomination_id: nomination for nomination_id, nomination in data['author_nominations']}
+        index._user_nominations = {nomination_id: nomination for nomination_id, nomination in data['user_nominations']}
+        index._next_author_id = data['next_author_id']
+        return index
+
+    # nominations as sent to the clients, author nominations first
+    # the list is cached until the next change and must not be mutated
+    def view(self):
+        if self._view is None:
+            self._view = [{
+                'nomination': nomination,
+                'nomination_id': nomination_id
+            } for nomination_id, nomination in self.pairs()]
+        return self._view
+
+    # (nomination_id, nomination) pairs in the same order as view, cached the same way
+    def pairs(self):
+        if self._pairs is None:
+            self._pairs = [*self._author_nominations.items(), *self._user_nominations.items()]
+        return self._pairs
+
+    def _invalidate(self):
+        self._view = None
+        self._pairs = None
@@ -0,0 +1,165 @@
+import functools
+import os
+import sys
+import threading
+import time
+
+from django.conf import settings
+
+# Sampling profiler of the handlers of the sessions, for finding where a slow room spends its time in production
+#
+# QUIDEM_PROFILE_DIR turns it on, the handlers decorated with @profiled are then sampled every QUIDEM_PROFILE_INTERVAL
+# seconds by a background thread that reads the stack of the thread running them
+# a sample is counted for the session whose handler is on that stack, time spent awaiting is not sampled
+# the samples of a session are written as folded stacks to <QUIDEM_PROFILE_DIR>/quidem-<quidem_id>.folded
+# every QUIDEM_PROFILE_DUMP_INTERVAL seconds and once its host is released,
+# ie. `flamegraph.pl quidem-42.folded > quidem-42.svg` or any viewer that reads the folded format
+# QUIDEM_PROFILE_SESSIONS limits the profiler to the given quidem ids, every session is profiled when it is None
+
+class SamplingProfiler():
+
+    def __init__(self, directory, interval=0.005, sessions=None, dump_interval=10, clock=time.monotonic):
+        self.directory = directory
+        self.interval = interval
+        self.sessions = set(sessions) if sessions is not None else None
+        self.dump_interval = dump_interval
+        self.samples = {} # quidem_id -> folded stack -> count
+        self._clock = clock
+        self._threads = set() # ids of the threads running profiled handlers
+        self._changed = set() # quidem ids with samples not dumped yet
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sampler = None
+
+    def targets(self, quidem_id):
+        return self.sessions is None or quidem_id in self.sessions
+
+    # the sampler thread starts with the first profiled handler
+    def watch(self, thread_id):
+        if thread_id not in self._threads:
+            self._threads.add(thread_id)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._run, name='quidem-profiler', daemon=True)
+                self._sampler.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        self.dump_all()
+
+    def _run(self):
+        next_dump = self._clock() + self.dump_interval
+        while not self._stopped.wait(self.interval):
+            self.sample()
+            if self._clock() >= next_dump:
+                self.dump_all()
+                next_dump = self._clock() + self.dump_interval
+
+    # takes one sample of every watched thread
+    def sample(self):
+        frames = sys._current_frames()
+        for thread_id in list(self._threads):
+            frame = frames.get(thread_id)
+            if frame is not None:
+                self._add_sample(frame)
+
+    # the stack is folded from the handler down, frames above it belong to the event loop
+    def _add_sample(self, frame):
+        stack = []
+        while frame is not None:
+            if frame.f_code is _profiled_call.__code__:
+                quidem_id = frame.f_locals.get('quidem_id')
+                folded = ';'.join(reversed(stack))
+                with self._lock:
+                    session = self.samples.setdefault(quidem_id, {})
+                    session[folded] = session.get(folded, 0) + 1
+                    self._changed.add(quidem_id)
+                return
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+
+    def path(self, quidem_id):
+        return os.path.join(self.directory, f'quidem-{quidem_id}.folded')
+
+    # writes every sample of the session taken so far, the file is replaced so readers never see half of it
+    def dump(self, quidem_id):
+        with self._lock:
+            self._changed.discard(quidem_id)
+            lines = self._lines(self.samples.get(quidem_id, {}))
+        self._write(quidem_id, lines)
+
+    # writes the profile of a session whose host went away, its samples are then dropped
+    def release(self, quidem_id):
+        with self._lock:
+            self._changed.discard(quidem_id)
+            lines = self._lines(self.samples.pop(quidem_id, {}))
+        self._write(quidem_id, lines)
+
+    @staticmethod
+    def _lines(samples):
+        return [f'{stack} {count}\n' for stack, count in sorted(samples.items())]
+
+    def _write(self, quidem_id, lines):
+        if not lines:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(quidem_id)
+        with open(path + '.tmp', 'w') as profile_file:
+            profile_file.writelines(lines)
+        os.replace(path + '.tmp', path)
+
+    def dump_all(self):
+        with self._lock:
+            changed = list(self._changed)
+        for quidem_id in changed:
+            self.dump(quidem_id)
+
+_profiler = None
+_profiler_lock = threading.Lock()
+
+# the profiler of the process, None unless QUIDEM_PROFILE_DIR is set
+def get_profiler():
+    global _profiler
+    directory = getattr(settings, 'QUIDEM_PROFILE_DIR', None)
+    if not directory:
+        return None
+    if _profiler is None or _profiler.directory != directory:
+        with _profiler_lock:
+            if _profiler is None or _profiler.directory != directory:
+                if _profiler is not None:
+                    _profiler.stop()
+                _profiler = SamplingProfiler(
+                    directory,
+                    getattr(settings, 'QUIDEM_PROFILE_INTERVAL', 0.005),
+                    getattr(settings, 'QUIDEM_PROFILE_SESSIONS', None),
+                    getattr(settings, 'QUIDEM_PROFILE_DUMP_INTERVAL', 10)
+                )
+    return _profiler
+
+# writes the profile of a session whose host goes away
+def release(quidem_id):
+    profiler = get_profiler()
+    if profiler is not None:
+        profiler.release(quidem_id)
+
+# samples the handler while it runs, the session is the quidem_id of the consumer or the one the message is for
+def profiled(handler):
+    @functools.wraps(handler)
+    async def wrapper(self, *args, **kwargs):
+        profiler = get_profiler()
+        if profiler is None:
+            return await handler(self, *args, **kwargs)
+        quidem_id = getattr(self, 'quidem_id', None)
+        if quidem_id is None and args and isinstance(args[0], dict):
+            quidem_id = args[0].get('quidem_id')
+        if not profiler.targets(quidem_id):
+            return await handler(self, *args, **kwargs)
+        profiler.watch(threading.get_ident())
+        return await _profiled_call(handler, self, args, kwargs, quidem_id)
+    return wrapper
+
+# the frame of this call marks where a profiled handler starts on the stack, see SamplingProfiler._add_sample
+async def _profiled_call(handler, obj, args, kwargs, quidem_id):
+    return await handler(obj, *args, **kwargs)
@@ -2,6 +2,12 @@ from enum import Enum
 
 import math
 
+from .tally import tally, RunningTally
+from .ballots import BallotStore
+from .nominations import NominationIndex
+from .leaderboard import Leaderboard
+from . import scoring
+
 # Represents a session instance
 
 class VotingAlgorithm(Enum):
@@ -28,15 +34,7 @@ class VotingAlgorithm(Enum):
 
     @classmethod
     def get_algorithm(cls, voting_algorithm):
-        algorithms = [
-            cls.flinear,
-            cls.fsquare,
-            cls.fcube,
-            cls.fexponential,
-            cls.flogarithmic
-        ]
-
-        return algorithms[voting_algorithm]
+        return _algorithms[voting_algorithm]
 
     linear = 0
     square = 1
@@ -44,6 +42,22 @@ class VotingAlgorithm(Enum):
     exponential = 3
     logarithmic = 4
 
+_algorithms = (
+    VotingAlgorithm.flinear,
+    VotingAlgorithm.fsquare,
+    VotingAlgorithm.fcube,
+    VotingAlgorithm.fexponential,
+    VotingAlgorithm.flogarithmic
+)
+
+# the voting algorithms score a position by the number of positions left, out_of - rank
+for voting_algorithm in VotingAlgorithm:
+    scoring.register_rule(
+        voting_algorithm.value,
+        voting_algorithm.name,
+        lambda out_of, rank, algorithm=_algorithms[voting_algorithm.value]: algorithm(out_of - rank)
+    )
+
 
 # Quidem configuration:
 ## user_visibility - dictates whether the other users in the party, or just the author, or neither may see the name of the users. If set to anonymous, users are not prompted for a username
@@ -80,6 +94,7 @@ class Action(Enum):
     NEXT_PHASE = 6
     CLOSE_SESSION = 7
     CHANGE_SETTING = 8
+    RESYNC_STATE = 9
 
 class QuidemError(Exception):
     pass
@@ -91,6 +106,14 @@ class ActionPhaseException(ActionError):
     """Raised when action is requested at an invalid phase"""
     pass
 
+class BatchActionError(ActionError):
+    """Raised when an action of a batch fails, none of the actions of the batch are applied then"""
+    def __init__(self, index, error, changed):
+        self.index = index
+        self.error = error
+        self.changed = changed # whether each action before the failed one changed the state
+        super().__init__(f'Action {index} of the batch failed: {error}')
+
 class ConsumerIdMismatchException(ActionError):
     """Raised when instance consumer id does not equal action consumer id"""
     def __init__(self, consumer_id, target_consumer_id):
@@ -106,8 +129,18 @@ class Quidem():
     INITIAL_SESSION_ID = 1
     AUTHOR = 0
 
+    # engine used to tally the votes on close, None picks numpy for large sessions when installed
+    tally_engine = None
+
+    # results shown in the author and user views, None shows every nomination
+    author_results = None
+    user_results = 1
+
     def __init__(self, quidem_id = 0, settings={}):
 
+        self._version = 0 # bumped on every change of state
+        self._state_cache = {} # state of each view along with the version it was built at
+
         self.settings = { ### change settings
             'voting_algorithm': settings.get('voting_algorithm') or VotingAlgorithm.linear.value,
             'max_voting_slots': settings.get('max_voting_slots') or 3,
@@ -118,38 +151,89 @@ class Quidem():
 
         self._phase = Phase.PRE_OPENING
 
-        self._author_nominations = []
-        self._user_nominations = {} # list of all nomination objects - keys are the negative value of the user consumer_id
+        self._nominations = NominationIndex() # user nominations are keyed by the negative value of the user consumer_id
 
-        self._votes = {}
+        self._votes = BallotStore() # vote_set of each consumer_id
 
-        self._calculated_votes = []
+        self._running_tally = None # votes per nomination kept up to date during VOTING
+
+        self._results = Leaderboard() # results calculated on close
 
         self._consumers = {} # dictionary of all consumer_id linked to their respective nicknames
 
         self._consumer_index = 0 # tracks consumer id so each consumer can have a unique id
 
+    # plain data that from_dict turns back into an equal session, ie. to store it as JSON
+    def to_dict(self):
+        return {
+            'quidem_id': self.quidem_id,
+            'version': self._version,
+            'settings': dict(self.settings),
+            'phase': self._phase.value,
+            'nominations': self._nominations.to_dict(),
+            'votes': [[consumer_id, vote_set] for consumer_id, vote_set in self._votes.items()],
+            'calculated_votes': self._results.top(),
+            'consumers': [[consumer_id, nickname] for consumer_id, nickname in self._consumers.items()],
+            'consumer_index': self._consumer_index
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        quidem = cls(quidem_id=data['quidem_id'])
+        quidem.settings = dict(data['settings'])
+        quidem._phase = Phase(data['phase'])
+        quidem._nominations = NominationIndex.from_dict(data['nominations'])
+        quidem._votes = BallotStore(dict(data['votes']))
+        quidem._results = Leaderboard(data['calculated_votes'])
+        quidem._consumers = dict(data['consumers'])
+        quidem._consumer_index = data['consumer_index']
+        if quidem._phase is Phase.VOTING:
+            quidem._start_running_tally()
+        quidem._version = data['version']
+        return quidem
+
     @property
     def consumers(self):
         return self.consumers
 
-    # unsure whether to keep this or not
+    @property
+    def version(self):
+        return self._version
+
+    # settings have to be reassigned, not mutated in place, for the change to be seen
+    @property
+    def settings(self):
+        return self._settings
+
+    @settings.setter
+    def settings(self, settings):
+        self._settings = settings
+        self._changed()
+
+    def _changed(self):
+        self._version += 1
+
+    # states are built once per version and shared between callers, so they must not be mutated
     def get_state(self, is_author=False):
+        cached = self._state_cache.get(is_author)
+        if cached is not None and cached[0] == self._version:
+            return cached[1]
         if is_author:
-            return self._get_state_author()
+            state = self._get_state_author()
         else:
-            return self._get_state_user()
+            state = self._get_state_user()
+        self._state_cache[is_author] = (self._version, state)
+        return state
 
     def _get_state_user(self):
         settings = dict(self.settings)
-        print(settings)
         del settings['voting_algorithm']
         state = {
             'settings': settings,
-            'users': self._consumers,
+            'users': dict(self._consumers),
             'phase': self.phase.value,
-            'votes': self._votes,
-            'calculated_votes': self._calculated_votes
+            'votes': self._get_votes(),
+            'calculated_votes': self.get_results(self.user_results)
         }
         if self.phase.value <= Phase.VOTING.value:
             state['nominations'] = self._get_nominations()
@@ -158,33 +242,31 @@ class Quidem():
     def _get_state_author(self):
         state = {
             'nominations': self._get_nominations(),
-            'users': self._consumers,
-            'settings': self.settings,
+            'users': dict(self._consumers),
+            'settings': dict(self.settings),
             'phase': self.phase.value,
-            'votes': self._votes,
-            'calculated_votes': self._calculated_votes
+            'votes': self._get_votes(),
+            'calculated_votes': self.get_results(self.author_results)
         }
         return state
 
+    # copy of the ballots shared by both views of a version
+    def _get_votes(self):
+        cached = self._state_cache.get('votes')
+        if cached is None or cached[0] != self._version:
+            cached = (self._version, dict(self._votes))
+            self._state_cache['votes'] = cached
+        return cached[1]
+
     def _get_nominations(self):
-        nominations = []
-        i = 0
-        for nomination in self._author_nominations:
-            nominations.append({
-                'nomination': nomination,
-                'nomination_id': i
-                })
-            i += 1
-        for consumer_id, nomination in self._user_nominations.items():
-            nominations.append({
-                'nomination': nomination,
-                'nomination_id': consumer_id
-            })
-        return nominations
+        return self._nominations.view()
 
     def has_consumer(self, consumer_id):
         return consumer_id in self._consumers
 
+    def get_consumer_count(self):
+        return len(self._consumers)
+
 
     # action
     # - type - type of action
@@ -221,20 +303,98 @@ class Quidem():
         else:
             raise ConsumerIdMismatchException(target_consumer_id, consumer_id)
 
+    # applies the actions of a batch in order as a unit, returns whether each one changed the state
+    # actions - the actions as sent by the client, ie. {'action', 'consumer_id', 'body'}
+    # when one fails, what the batch changed is undone and BatchActionError is raised
+    def process_actions(self, consumer_id, actions):
+        undo = {} # what the actions of the batch are about to change, as it was before the batch, see _undo
+        version = self._version
+        changed = []
+        try:
+            for index, content in enumerate(actions):
+                try:
+                    changed.append(bool(self._process_batched_action(consumer_id, content, undo)))
+                # malformed values the checks below let through, ie. a nomination id that is a list, fail the batch the same way
+                except (QuidemError, TypeError, ValueError) as err:
+                    raise BatchActionError(index, err, changed)
+        except BaseException:
+            self._undo(undo, version)
+            raise
+        return changed
+
+    def _process_batched_action(self, consumer_id, content, undo):
+        if not isinstance(content, dict):
+            raise ActionError('A batched action has to be an object')
+        target_consumer_id = content.get('consumer_id')
+        if target_consumer_id is not None:
+            try:
+                target_consumer_id = int(target_consumer_id)
+            except (TypeError, ValueError):
+                raise ActionError('The targeted consumer ID has to be a number')
+        body = content.get('body')
+        if body is not None and not isinstance(body, dict):
+            raise ActionError('The body of a batched action has to be an object')
+        action = content.get('action')
+        self._keep_undo(undo, action, consumer_id)
+        return self.process_action(action, consumer_id, target_consumer_id, body or {})
+
+    # only the ballot of the voter is kept for a vote, the nominations and the consumers for the actions
+    # of PRE_OPENING and PRE_VOTING, so undoing a batch costs no more than the batch itself
+    def _keep_undo(self, undo, action, consumer_id):
+        if action == Action.VOTE.value:
+            ballots = undo.setdefault('votes', {})
+            if consumer_id not in ballots:
+                ballots[consumer_id] = self._votes.get(consumer_id)
+        elif action in (Action.NOMINATE.value, Action.REMOVE_NOMINATION.value, Action.REMOVE_USER.value):
+            if 'nominations' not in undo:
+                undo['nominations'] = self._nominations.to_dict()
+            if action == Action.REMOVE_USER.value and 'consumers' not in undo:
+                undo['consumers'] = dict(self._consumers)
+
+    # puts back what process_actions kept before the actions of a failed batch, along with the version
+    # no state was built during the batch, so the states cached up to that version still hold
+    def _undo(self, undo, version):
+        for voter, ballot in undo.get('votes', {}).items():
+            current = self._votes.get(voter)
+            if self._running_tally is not None:
+                if current is not None:
+                    self._running_tally.remove(current)
+                if ballot is not None:
+                    self._running_tally.add(ballot)
+            if ballot is None:
+                self._votes.pop(voter, None)
+            else:
+                self._votes[voter] = ballot
+        if 'nominations' in undo:
+            self._nominations = NominationIndex.from_dict(undo['nominations'])
+        if 'consumers' in undo:
+            self._consumers = undo['consumers']
+        self._version = version
+
     # returns the consumer id for a new user
     # id for an author is always -1
     def new_consumer(self, nickname):
+        return self.new_consumers([nickname])[0]
+
+    # admits several users with a single state change, returns their consumer ids in the same order
+    def new_consumers(self, nicknames):
         if self.phase != Phase.PRE_VOTING:
             raise ActionPhaseException('Consumer creation can only be performed during PRE_VOTING phase')
-        self._consumer_index += 1
-        self._consumers[self._consumer_index] = nickname
-        return self._consumer_index
+        consumer_ids = []
+        for nickname in nicknames:
+            self._consumer_index += 1
+            self._consumers[self._consumer_index] = nickname
+            consumer_ids.append(self._consumer_index)
+        if consumer_ids:
+            self._changed()
+        return consumer_ids
 
     def force_remove_consumer(self, consumer_id):
         if consumer_id != Quidem.AUTHOR and consumer_id in self._consumers:
             if self.phase.value < Phase.VOTING.value:
                 self.remove_nomination(-consumer_id)
             del self._consumers[consumer_id]
+            self._changed()
 
     # removes nomination tied to consumer_id
     # then removes consumer
@@ -244,6 +404,7 @@ class Quidem():
         elif consumer_id != Quidem.AUTHOR:
             self.remove_nomination(-consumer_id)
             del self._consumers[consumer_id]
+            self._changed()
             return True
         return False
 
@@ -254,12 +415,20 @@ class Quidem():
         elif vote_set is None:
             raise ActionError('Vote body arguments cannot be None')
         if isinstance(vote_set, list):
-            fitted_vote_set = vote_set
-            print('max voting slots')
-            print(self.settings)
-            if len(fitted_vote_set) > self.settings['max_voting_slots']:
-                fitted_vote_set = fitted_vote_set[0:self.settings['max_voting_slots']]
-            self._votes[consumer_id] = fitted_vote_set
+            try:
+                fitted_vote_set = [int(nomination_id) for nomination_id in vote_set[0:self.settings['max_voting_slots']]]
+            except (TypeError, ValueError):
+                raise ActionError('Vote set can only contain nomination ids')
+            try:
+                previous_vote_set = self._votes.get(consumer_id)
+                self._votes[consumer_id] = fitted_vote_set
+            except OverflowError:
+                raise ActionError('Vote set contains an invalid nomination id')
+            if self._running_tally is not None:
+                if previous_vote_set is not None:
+                    self._running_tally.remove(previous_vote_set)
+                self._running_tally.add(fitted_vote_set)
+            self._changed()
             return True
         return False
 
@@ -274,25 +443,41 @@ class Quidem():
     def nominate(self, consumer_id, nomination):
         if self.phase.value > Phase.PRE_VOTING.value:
             raise ActionPhaseException('Nominating can only be performed during PRE_OPENING or PRE_VOTING phases')
-        elif nomination is None or nomination.strip() == '':
+        elif nomination is None:
+            return False
+        elif not isinstance(nomination, str):
+            raise ActionError('A nomination has to be a string')
+        elif nomination.strip() == '':
             return False
         if consumer_id == Quidem.AUTHOR:
-            self._author_nominations.append(nomination)
+            self._nominations.add_author_nomination(nomination)
         else:
-            self._user_nominations[-consumer_id] = nomination
+            self._nominations.set_user_nomination(consumer_id, nomination)
+        self._changed()
         return True
 
     # 'nomination_id' in body
     def remove_nomination(self, nomination_id):
         if self.phase.value > Phase.PRE_VOTING.value:
             raise ActionPhaseException('Nomination Removal can only be performed during PRE_OPENING or PRE_VOTING phases')
-        if nomination_id in self._user_nominations:
-            del self._user_nominations[nomination_id]
-        elif nomination_id >= 0 and nomination_id < len(self._author_nominations):
-            del self._author_nominations[nomination_id]
-        else:
-            return False
-        return True
+        if self._nominations.remove(nomination_id):
+            self._changed()
+            return True
+        return False
+
+    # 'voting_algorithm', 'max_voting_slots' and 'question' in body
+    # max_voting_slots can only change before VOTING, the question only before PRE_VOTING
+    def change_settings(self, body):
+        updated_settings = {
+            'voting_algorithm': int(body.get('voting_algorithm', self.settings['voting_algorithm'])),
+            'max_voting_slots': self.settings['max_voting_slots'],
+            'question': self.settings['question']
+        }
+        if self.phase.value < Phase.VOTING.value:
+            updated_settings['max_voting_slots'] = int(body.get('max_voting_slots', self.settings['max_voting_slots']))
+            if self.phase.value == Phase.PRE_OPENING.value:
+                updated_settings['question'] = body.get('question', self.settings['question'])
+        self.settings = updated_settings
 
     @property
     def phase(self):
@@ -303,45 +488,51 @@ class Quidem():
         # end quidem
         if self.phase is not Phase.CLOSED:
             self._phase = Phase(self._phase.value + 1)
-            if self._phase is Phase.CLOSED:
+            self._changed()
+            if self._phase is Phase.VOTING:
+                self._start_running_tally()
+            elif self._phase is Phase.CLOSED:
                 self.calculate_votes()
         else:
             raise QuidemError('Phase already set to Phase.CLOSED')
 
-    def calculate_votes(self):
-
-        nominations = self._user_nominations
+    def _get_out_of(self, nominations):
+        return min(len(nominations), self.settings['max_voting_slots'])
 
-        for key in nominations.keys():
-            nominations[key] = {
-                'nomination': nominations[key],
-                'nomination_id': key,
-                'votes': 0
-            }
+    # nominations can no longer change once VOTING starts, so the running tally is built against them
+    def _start_running_tally(self):
+        nominations = self._nominations.pairs()
+        self._running_tally = RunningTally(nominations, self._get_out_of(nominations), self.settings['max_voting_slots'])
+        for vote_set in self._votes.values():
+            self._running_tally.add(vote_set)
 
-        for i in range(len(self._author_nominations)):
-            nominations[i] = {
-                'nomination': self._author_nominations[i],
-                'nomination_id': i,
-                'votes': 0
-            }
+    # points of each ballot position under the current settings
+    def _get_weights(self, out_of):
+        return scoring.weight_vector(self.settings['voting_algorithm'], out_of, self.settings['max_voting_slots'])
 
-        out_of = min(len(nominations.items()), self.settings['max_voting_slots'])
+    # returns the current standings, provisional until the session is closed
+    def get_leaderboard(self):
+        if self._running_tally is not None:
+            return self._running_tally.results(self._get_weights(self._running_tally.out_of))
+        nominations = self._nominations.pairs()
+        return tally(nominations, self._votes.values(), self._get_weights(self._get_out_of(nominations)), self.tally_engine)
 
-        voting_algorithm = VotingAlgorithm.get_algorithm(self.settings['voting_algorithm'])
+    # the running tally hands its votes over unsorted, the leaderboard only orders what is asked of it
+    def calculate_votes(self):
+        if self._running_tally is not None:
+            self._results = Leaderboard(self._running_tally.scores(self._get_weights(self._running_tally.out_of)))
+        else:
+            self._results = Leaderboard(self.get_leaderboard())
+        self._changed()
 
-        for consumer_id, vote_set in self._votes.items():
-            print('VOTE SET')
-            print(vote_set)
-            for i in range(len(vote_set)):
-                nomination_id = int(vote_set[i])
-                if nomination_id not in nominations:
-                    continue
-                calculated_points = voting_algorithm(out_of - i)
-                nominations[nomination_id]['votes'] += calculated_points
+    # the best count results calculated on close, all of them when count is None
+    def get_results(self, count=None):
+        return self._results.top(count)
 
-        self._calculated_votes = sorted(nominations.values(), key=lambda item: -item['votes'])
-        print(self._calculated_votes)
+    # rank of a nomination in the results starting at 1, None before close
+    def get_rank(self, nomination_id):
+        return self._results.rank(nomination_id)
 
     def force_close(self):
         self._phase = Phase.CLOSED
+        self._changed()
@@ -6,17 +6,27 @@
 #     re_path(r'ws/chat/', consumers.ChatAppConsumer),
 # ]
 
+from django.conf import settings
 from django.urls import path, re_path
-from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.routing import ProtocolTypeRouter, URLRouter, ChannelNameRouter
 from channels.sessions import SessionMiddlewareStack
 from channels.security.websocket import AllowedHostsOriginValidator
-from . import consumers
+from . import consumers, worker_pool
+
+# channels 3 and later route to the ASGI application of a consumer, channels 2 to the consumer class itself
+def as_asgi(consumer):
+    return consumer.as_asgi() if hasattr(consumer, 'as_asgi') else consumer
+
+# refuses to start a pool of workers that could not hand the sessions over to each other
+worker_pool.check_settings()
 
 application = ProtocolTypeRouter({
     'websocket': #AllowedHostsOriginValidator(
         URLRouter(
             [
-                re_path(r'ws/quidem/.+/$', consumers.QuidemConsumer),
+                re_path(r'ws/quidem/.+/$', as_asgi(consumers.QuidemConsumer)),
             ]
-        )
+        ),
+    # workers of the pool hosting the sessions, see QUIDEM_WORKERS
+    'channel': ChannelNameRouter({worker: as_asgi(worker_pool.QuidemWorker) for worker in settings.QUIDEM_WORKERS})
 })
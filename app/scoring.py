@@ -0,0 +1,56 @@
+import functools
+import math
+
+# Scoring rules give the points a ballot position is worth, keyed by the voting_algorithm setting
+# a rule scores a (out_of, rank) pair, out_of being the number of positions that count and rank starting at 0
+
+# keys of the rules registered on top of the VotingAlgorithm ones
+BORDA = 5
+DOWDALL = 6
+TRUNCATED_EXPONENTIAL = 7
+
+class ScoringRule():
+
+    def __init__(self, key, name, score):
+        self.key = key
+        self.name = name
+        self.score = score
+
+    def __repr__(self):
+        return f'ScoringRule({self.key}, {self.name!r})'
+
+_rules = {}
+
+def register_rule(key, name, score):
+    _rules[key] = ScoringRule(key, name, score)
+    weight_vector.cache_clear()
+    return _rules[key]
+
+def get_rule(key):
+    rule = _rules.get(key)
+    if rule is None:
+        raise ValueError(f'No scoring rule registered for voting algorithm {key}')
+    return rule
+
+def get_rules():
+    return dict(_rules)
+
+# returns the points of the first width ballot positions as a tuple, computed once per (key, out_of, width)
+# positions a rule cannot score (ie. log of a non-positive number) are worth nothing
+@functools.lru_cache(maxsize=256)
+def weight_vector(key, out_of, width):
+    score = get_rule(key).score
+    weights = []
+    for rank in range(width):
+        try:
+            weights.append(score(out_of, rank))
+        except (ValueError, ZeroDivisionError):
+            weights.append(0)
+    return tuple(weights)
+
+# first position gets out_of - 1 points down to 0 for the last counted position
+register_rule(BORDA, 'borda', lambda out_of, rank: max(out_of - rank - 1, 0))
+# 1, 1/2, 1/3, ...
+register_rule(DOWDALL, 'dowdall', lambda out_of, rank: 1 / (rank + 1))
+# halves with every position, positions past out_of are worth nothing
+register_rule(TRUNCATED_EXPONENTIAL, 'truncated_exponential', lambda out_of, rank: math.ldexp(1, out_of - rank - 1) if rank < out_of else 0)
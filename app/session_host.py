@@ -0,0 +1,452 @@
+import asyncio
+import json
+import time
+
+from django.conf import settings
+
+from .quidem import Quidem, Action, Phase, QuidemError, BatchActionError
+from .state_delta import diff_state
+from .broadcast import BroadcastScheduler
+from . import action_log, metrics, profiling, session_ids
+
+# Hosts a quidem session: applies the actions sent to the author group and broadcasts the resulting states
+#
+# the host lives either in the consumer of the author or in a worker of the pool, channel_name is where
+# the messages it sends itself arrive, those carry the quidem_id so a worker hosting many sessions can route them
+
+class SessionHost():
+
+    def __init__(self, quidem, channel_layer, channel_name, revision=0, resume=False):
+        self.quidem = quidem
+        self.quidem_id = quidem.quidem_id
+        self.channel_layer = channel_layer
+        self.channel_name = channel_name
+        self.revision = revision # revision of the session store the quidem was loaded or last saved at, see worker_pool
+        self.group_name = self.get_group()
+        self.closed = False
+        self.released = False # set once the host lets go of the session, see release
+
+        self._broadcast_states = {} # last state broadcast for each view
+        self._state_messages = {} # last full state message encoded for each view
+        self._broadcast_due = False
+        self._pending_joins = [] # join requests waiting to be admitted
+        self._pending_votes = {} # consumer_id -> latest ballot message not applied yet, see QUIDEM_COALESCE_VOTES
+        self._flush_tasks = set() # flushes being posted, referenced until done so they are not garbage collected
+        self.action_log = action_log.open_action_log(quidem, resume) # None unless QUIDEM_ACTION_LOG_DIR is set, resume carries on with the log of a session hosted before
+        self._broadcast_scheduler = BroadcastScheduler(
+            self._mark_broadcast_due,
+            self._call_later,
+            window=getattr(settings, 'QUIDEM_BROADCAST_WINDOW', 0),
+            max_delay=getattr(settings, 'QUIDEM_BROADCAST_MAX_DELAY', 0.25)
+        )
+        self._counted = metrics.enabled() # whether the session is counted in metrics.SESSIONS
+        if self._counted:
+            metrics.SESSIONS.inc()
+
+    def get_group(self):
+        return f'quidem_{self.quidem_id}'
+
+    def get_author_group(self):
+        return f'author_quidem_{self.quidem_id}'
+
+    # the processing time of each action is observed when metrics are enabled
+    async def process_action(self, obj):
+        if not metrics.enabled():
+            await self._process_action(obj)
+            return
+        start = time.perf_counter()
+        try:
+            await self._process_action(obj)
+        finally:
+            content = obj['content']
+            if isinstance(content, list):
+                label = 'batch'
+            else:
+                label = metrics.action_label(content.get('action') if isinstance(content, dict) else None)
+            metrics.ACTION_SECONDS.observe(time.perf_counter() - start, label)
+
+    # receives quidem event and calls next method
+    async def _process_action(self, obj):
+
+        content = obj['content']
+        if isinstance(content, dict) and content.get('action') == Action.VOTE.value and getattr(settings, 'QUIDEM_COALESCE_VOTES', False):
+            await self._queue_vote(obj)
+            return
+
+        # the ballots queued before any other action are applied first, so the actions keep their order
+        await self.apply_votes()
+
+        if isinstance(content, list):
+            await self._process_batch(obj)
+            return
+
+        # the action is applied as the client sent it, malformed and refused actions are only counted, the client is left as it is
+        sender = int(obj['sender'])
+        action = content.get('action') if isinstance(content, dict) else None
+        try:
+            action, target_consumer_id, body = self._parse_action(content)
+            changed = self._apply_action(action, sender, target_consumer_id, body)
+        except (QuidemError, TypeError, ValueError):
+            if metrics.enabled():
+                metrics.ACTION_ERRORS.inc(metrics.action_label(action))
+            return
+        if not changed:
+            return
+
+        self._record(action, sender, target_consumer_id, body)
+        if action == Action.CLOSE_SESSION.value:
+            await self._close_session()
+            return
+        if action == Action.REMOVE_USER.value:
+            await self._send_disconnect(target_consumer_id)
+        elif action == Action.VOTE.value:
+            await self._send_vote(obj, sender)
+        await self._broadcast_updated_state()
+
+        # Ends session if phase is CLOSED
+        if self.quidem.phase is Phase.CLOSED:
+            await self._close_session()
+
+    # returns (action, target consumer id, body) of an action as sent by a client
+    # raises TypeError or ValueError when it is not shaped like one
+    @staticmethod
+    def _parse_action(content):
+        if not isinstance(content, dict):
+            raise TypeError('An action has to be an object')
+        target_consumer_id = content.get('consumer_id')
+        if target_consumer_id is not None:
+            target_consumer_id = int(target_consumer_id)
+        body = content.get('body')
+        if body is not None and not isinstance(body, dict):
+            raise TypeError('The body of an action has to be an object')
+        return content.get('action'), target_consumer_id, body
+
+    # applies an action to the quidem and returns whether it changed the session
+    # closing the session, moving to the next phase and changing the settings are left to the author
+    def _apply_action(self, action, sender, target_consumer_id, body):
+
+         # closes quidem session
+        if action == Action.CLOSE_SESSION.value:
+            if sender != Quidem.AUTHOR:
+                return False
+            self.quidem.force_close()
+            return True
+
+        elif action == Action.NEXT_PHASE.value:
+            if sender != Quidem.AUTHOR:
+                return False
+            self.quidem.next_phase()
+            return True
+
+        # Changes Quidem settings
+        elif action == Action.CHANGE_SETTING.value:
+            if sender != Quidem.AUTHOR:
+                return False
+            self.quidem.change_settings(body or {})
+            return True
+
+        return self.quidem.process_action(action, sender, target_consumer_id, body or {})
+
+    # a frame holding a list of actions is applied as a unit, see Quidem.process_actions
+    # the sender hears back how each action went, the rest of the session gets a single broadcast
+    async def _process_batch(self, obj):
+        actions = obj['content']
+        sender = int(obj['sender'])
+        try:
+            changed = self.quidem.process_actions(sender, actions)
+        except BatchActionError as err:
+            if metrics.enabled():
+                metrics.ACTION_ERRORS.inc('batch')
+            results = [{'status': 'ok' if item_changed else 'unchanged'} for item_changed in err.changed]
+            results.append({'status': 'error', 'error': str(err.error)})
+            results.extend({'status': 'skipped'} for _ in actions[len(results):])
+            await self._send_batch_result(obj, False, results)
+            return
+
+        voted = False
+        for content, item_changed in zip(actions, changed):
+            if not item_changed:
+                continue
+            action = content.get('action')
+            target_consumer_id = content.get('consumer_id')
+            if target_consumer_id is not None:
+                target_consumer_id = int(target_consumer_id)
+            self._record(action, sender, target_consumer_id, content.get('body') or {})
+            if action == Action.REMOVE_USER.value:
+                await self._send_disconnect(target_consumer_id)
+            elif action == Action.VOTE.value:
+                voted = True
+        # the ballot is acknowledged once, as it stands after the batch
+        if voted:
+            await self._send_vote(obj, sender)
+        await self._send_batch_result(obj, True, [{'status': 'ok' if item_changed else 'unchanged'} for item_changed in changed])
+        if any(changed):
+            await self._broadcast_updated_state()
+
+    async def _send_batch_result(self, obj, applied, results):
+        if obj.get('channel_name') is not None:
+            await self.channel_layer.send(
+                obj['channel_name'],
+                {
+                    'type': 'actions.result',
+                    'applied': applied,
+                    'results': results
+                }
+            )
+
+    # a ballot waits in the slot of its voter until the queued messages before it are read,
+    # a newer ballot of the same voter replaces it, so each voter costs one vote per round however often it changes its mind
+    async def _queue_vote(self, obj):
+        sender = int(obj['sender'])
+        if sender in self._pending_votes and metrics.enabled():
+            metrics.VOTES_SUPERSEDED.inc()
+        was_empty = not self._pending_votes
+        self._pending_votes[sender] = obj
+        if was_empty:
+            await self.channel_layer.send(
+                self.channel_name,
+                {
+                    'type': 'apply.votes',
+                    'quidem_id': self.quidem_id
+                }
+            )
+
+    # applies the latest ballot of every voter with a single broadcast, only the ballots that went through are acknowledged
+    async def apply_votes(self, obj=None):
+        if not self._pending_votes:
+            return
+        pending = self._pending_votes
+        self._pending_votes = {}
+
+        # a refused ballot is counted like any other action, the ones after it are still applied
+        changed = False
+        for sender, vote_obj in pending.items():
+            try:
+                _, _, body = self._parse_action(vote_obj['content'])
+                voted = self.quidem.process_action(Action.VOTE.value, sender, None, body or {})
+            except (QuidemError, TypeError, ValueError):
+                if metrics.enabled():
+                    metrics.ACTION_ERRORS.inc(metrics.action_label(Action.VOTE.value))
+                continue
+            if voted:
+                self._record(Action.VOTE.value, sender, None, body)
+                await self._send_vote(vote_obj, sender)
+                changed = True
+        if changed:
+            await self._broadcast_updated_state()
+
+    async def disconnect_consumer(self, obj):
+        consumer_id = obj['consumer_id']
+        await self.apply_votes()
+        if not self.quidem.has_consumer(consumer_id) and self.quidem.phase.value < Phase.CLOSED.value:
+            self.quidem.force_remove_consumer(consumer_id)
+            self._record(action_log.DISCONNECT, Quidem.AUTHOR, consumer_id)
+            await self._broadcast_updated_state()
+
+    # asks for a broadcast of the updated state, bursts of requests are coalesced into one
+    async def broadcast_updated_state(self, obj=None):
+        await self._broadcast_updated_state()
+
+    async def _broadcast_updated_state(self):
+        self._broadcast_scheduler.request()
+        await self._send_due_broadcast()
+
+    # called back through the channel layer once the coalescing window of the scheduler ends
+    async def flush_broadcast(self, obj):
+        self._broadcast_scheduler.on_timer()
+        await self._send_due_broadcast()
+
+    # the flush goes through the channel layer so it is handled in turn with the other messages of the host
+    def _call_later(self, delay):
+        asyncio.get_running_loop().call_later(delay, self._start_flush)
+
+    def _start_flush(self):
+        task = asyncio.ensure_future(self._post_flush_broadcast())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _post_flush_broadcast(self):
+        await self.channel_layer.send(
+            self.channel_name,
+            {
+                'type': 'flush.broadcast',
+                'quidem_id': self.quidem_id
+            }
+        )
+
+    # the scheduler decides when to broadcast, the broadcast itself is awaited by the handler that triggered it
+    def _mark_broadcast_due(self):
+        self._broadcast_due = True
+
+    async def _send_due_broadcast(self):
+        if self._broadcast_due:
+            self._broadcast_due = False
+            await self._send_updated_state()
+
+    # sends the updated state to all consumers, who then send it to the client end
+    # in delta mode only the changes since the previous broadcast are sent
+    # each view is serialized once here, consumers only add their own fields
+    async def _send_updated_state(self):
+        for is_author in (False, True):
+            message = self._state_message(is_author)
+            if message is not None:
+                await self.channel_layer.group_send(
+                    self.get_author_group() if is_author else self.group_name,
+                    message
+                )
+                if metrics.enabled():
+                    self._observe_broadcast(is_author, message)
+
+    # the author group only holds the author, the session group holds every consumer of the session
+    def _observe_broadcast(self, is_author, message):
+        fanout = 1 if is_author else self.quidem.get_consumer_count() + 1
+        kind = 'state' if 'state' in message else 'delta'
+        metrics.BROADCAST_FANOUT.observe(fanout, 'author' if is_author else 'user')
+        metrics.BROADCAST_BYTES.inc(kind, amount=len(message[kind]) * fanout)
+
+    # returns None when the view did not change since the previous broadcast, the next delta then builds on that broadcast still
+    def _state_message(self, is_author):
+        version = self.quidem.version
+        state = self._get_view(is_author)
+        previous = self._broadcast_states.get(is_author)
+        if getattr(settings, 'QUIDEM_DELTA_BROADCASTS', False) and previous is not None:
+            delta = diff_state(previous[1], state)
+            if delta is None:
+                return None
+            self._broadcast_states[is_author] = (version, state)
+            return {
+                'type': 'send_updated_state',
+                'author': is_author,
+                'version': version,
+                'base_version': previous[0],
+                'delta': json.dumps(delta).encode()
+            }
+        self._broadcast_states[is_author] = (version, state)
+        return self._get_state_message(is_author, version, state)
+
+    # users do not get the ballots of the others, their own ballot is sent by _send_vote
+    def _get_view(self, is_author):
+        state = self.quidem.get_state(is_author)
+        if is_author:
+            return state
+        state = dict(state)
+        del state['votes']
+        return state
+
+    # full state messages are encoded once per version, however many consumers ask for a snapshot
+    def _get_state_message(self, is_author, version, state):
+        cached = self._state_messages.get(is_author)
+        if cached is None or cached[0] != version:
+            cached = (version, {
+                'type': 'send_updated_state',
+                'author': is_author,
+                'version': version,
+                'state': json.dumps(state).encode()
+            })
+            self._state_messages[is_author] = cached
+        return cached[1]
+
+    # acknowledges an accepted ballot to the channel of the voter alone
+    async def _send_vote(self, obj, consumer_id):
+        if obj.get('channel_name') is not None:
+            await self.channel_layer.send(
+                obj['channel_name'],
+                {
+                    'type': 'vote.updated',
+                    'vote': self.quidem.get_vote(consumer_id)
+                }
+            )
+
+    # sends the last broadcast state, which the following deltas build on, to a consumer that fell behind
+    async def send_state_snapshot(self, obj):
+        version, state = self._broadcast_states.get(obj['author']) or (self.quidem.version, self._get_view(obj['author']))
+        await self.channel_layer.send(
+            obj['channel_name'],
+            self._get_state_message(obj['author'], version, state)
+        )
+
+    # join requests are queued and admitted together once the requests already waiting on the channel are read
+    async def response_to_join_request(self, obj):
+        self._pending_joins.append(obj)
+        if len(self._pending_joins) == 1:
+            await self.channel_layer.send(
+                self.channel_name,
+                {
+                    'type': 'admit.joins',
+                    'quidem_id': self.quidem_id
+                }
+            )
+
+    # the replies carry the consumer id along with the state that includes the whole batch, which then costs one broadcast
+    async def admit_joins(self, obj):
+        if not self._pending_joins:
+            return
+        requests = self._pending_joins
+        self._pending_joins = []
+
+        if self.quidem.phase is not Phase.PRE_VOTING:
+            for request in requests:
+                await self.channel_layer.send(request['channel_name'], {'type': 'join.rejected'})
+            return
+
+        nicknames = [request['nickname'] for request in requests]
+        consumer_ids = self.quidem.new_consumers(nicknames)
+        self._record(Action.JOIN.value, Quidem.AUTHOR, None, {'nicknames': nicknames})
+        state = self._get_state_message(False, self.quidem.version, self._get_view(False))
+        for request, consumer_id in zip(requests, consumer_ids):
+            await self.channel_layer.send(
+                request['channel_name'],
+                {
+                    'type': 'join.accepted',
+                    'consumer_id': consumer_id,
+                    'state': state
+                }
+            )
+        await self._broadcast_updated_state()
+
+    # broadcasts a disconnection event to all consumers in the group, the author only closes when close_author is set
+    async def _send_disconnect(self, consumer_filter=None, close_author=False):
+        await self.channel_layer.group_send(
+            self.group_name,
+            {
+                'type': 'filtered.disconnect.consumer',
+                'filter': consumer_filter,
+                'author': close_author
+            }
+        )
+
+    # applies the pending ballots, admits the pending joins and sends the pending broadcast right away, ie. before the session moves or closes
+    async def flush(self):
+        await self.apply_votes()
+        await self.admit_joins({})
+        self._broadcast_scheduler.flush()
+        await self._send_due_broadcast()
+
+    # appends an accepted action to the log of the session
+    def _record(self, action, sender, target_consumer_id=None, body=None):
+        if self.action_log is not None:
+            self.action_log.record(self.quidem, action, sender, target_consumer_id, body)
+
+    # the session goes away with its author, as it does when the author consumer hosts it
+    async def author_left(self, obj):
+        await self.flush()
+        self.release()
+
+    # snapshots and closes the log once the session is closed, moves to another worker or loses the consumer hosting it
+    def release(self):
+        self.released = True
+        if self.action_log is not None:
+            self.action_log.snapshot(self.quidem)
+            self.action_log.close()
+            self.action_log = None
+        if self._counted:
+            self._counted = False
+            metrics.SESSIONS.dec()
+        profiling.release(self.quidem_id)
+
+    async def _close_session(self):
+        await self.flush()
+        self.closed = True
+        self.release()
+        session_ids.release_session(self.quidem_id)
+        await self._send_disconnect(close_author=True)
@@ -0,0 +1,181 @@
+import collections
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+
+from .quidem import Quidem
+
+# Allocates quidem session ids that are unique across every worker process
+#
+# a counter backend hands out blocks of ids with one atomic increment, each worker then allocates from its block
+# without going back to the backend until the block runs out
+# an allocated id is marked as such, the first connection to claim it becomes the author of the session
+# and both marks are dropped once the session closes, the mark of an id nobody claims expires after QUIDEM_UNCLAIMED_SESSION_TTL
+#
+# QUIDEM_SESSION_ID_CACHE names the cache shared by the workers that holds the counter and the marks (ie. redis)
+# None keeps them in this process, which only suits a single process such as the tests or the load generator
+
+# in-process stand-in for a shared counter, only unique within one process
+class LocalCounter():
+
+    def __init__(self, first_id=Quidem.INITIAL_SESSION_ID):
+        self._next_id = first_id
+        self._lock = threading.Lock()
+
+    # returns the first id of a block of count ids nobody else gets
+    def lease(self, count):
+        with self._lock:
+            first_id = self._next_id
+            self._next_id += count
+            return first_id
+
+# counter kept in a cache shared by the workers (ie. redis or memcached), relies on the atomic incr of the backend
+class CacheCounter():
+
+    def __init__(self, cache, key='next_quidem_id', first_id=Quidem.INITIAL_SESSION_ID):
+        self.cache = cache
+        self.key = key
+        self.first_id = first_id
+
+    def lease(self, count):
+        self.cache.add(self.key, self.first_id - 1, None)
+        last_id = self.cache.incr(self.key, count)
+        return last_id - count + 1
+
+class SessionIdAllocator():
+
+    def __init__(self, counter, block_size=64):
+        self.counter = counter
+        self.block_size = block_size
+        self._next_id = 0
+        self._end_id = 0
+        self._lock = threading.Lock()
+
+    def allocate(self):
+        with self._lock:
+            if self._next_id >= self._end_id:
+                self._next_id = self.counter.lease(self.block_size)
+                self._end_id = self._next_id + self.block_size
+            session_id = self._next_id
+            self._next_id += 1
+            return session_id
+
+# in-process stand-in for CacheMarks, only knows the sessions allocated by this process
+class LocalMarks():
+
+    def __init__(self, clock=time.monotonic):
+        self._allocated = {} # session_id -> when the mark expires, None once claimed
+        self._expiries = collections.deque() # (expiry, session_id) in the order they were allocated
+        self._claimed = set()
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def allocate(self, session_id, ttl):
+        with self._lock:
+            now = self._clock()
+            # every mark lives as long, so the oldest ones expire first
+            while self._expiries and self._expiries[0][0] <= now:
+                _, expired_id = self._expiries.popleft()
+                if self._allocated.get(expired_id) is not None:
+                    del self._allocated[expired_id]
+            self._allocated[session_id] = now + ttl
+            self._expiries.append((now + ttl, session_id))
+
+    def is_allocated(self, session_id):
+        if session_id not in self._allocated:
+            return False
+        expiry = self._allocated.get(session_id)
+        return expiry is None or expiry > self._clock()
+
+    def claim(self, session_id):
+        with self._lock:
+            if session_id in self._claimed:
+                return False
+            self._claimed.add(session_id)
+            if session_id in self._allocated:
+                self._allocated[session_id] = None
+            return True
+
+    def release(self, session_id):
+        with self._lock:
+            self._allocated.pop(session_id, None)
+            self._claimed.discard(session_id)
+
+# marks kept in a cache shared by the workers, the claimed ones never expire so the cache must not evict them either
+class CacheMarks():
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def _allocated_key(self, session_id):
+        return f'quidem_{session_id}_allocated'
+
+    def _author_key(self, session_id):
+        return f'quidem_{session_id}_author'
+
+    def allocate(self, session_id, ttl):
+        self.cache.set(self._allocated_key(session_id), True, ttl)
+
+    def is_allocated(self, session_id):
+        return self.cache.get(self._allocated_key(session_id)) is not None
+
+    # the mark of a claimed session stays until the session closes
+    def claim(self, session_id):
+        if not self.cache.add(self._author_key(session_id), True, None):
+            return False
+        self.cache.touch(self._allocated_key(session_id), None)
+        return True
+
+    def release(self, session_id):
+        self.cache.delete_many([self._allocated_key(session_id), self._author_key(session_id)])
+
+# the cache named by QUIDEM_SESSION_ID_CACHE, None when the ids are kept in this process
+# caches that live in one process or keep nothing would hand the same id to several workers
+def get_shared_cache():
+    alias = getattr(settings, 'QUIDEM_SESSION_ID_CACHE', None)
+    if alias is None:
+        return None
+    shared_cache = caches[alias]
+    if isinstance(shared_cache, (LocMemCache, DummyCache)):
+        raise ImproperlyConfigured(f'QUIDEM_SESSION_ID_CACHE must name a cache shared by the workers, {alias} is not')
+    return shared_cache
+
+_allocator = None
+_marks = None
+
+def get_allocator():
+    global _allocator
+    if _allocator is None:
+        shared_cache = get_shared_cache()
+        counter = CacheCounter(shared_cache) if shared_cache is not None else LocalCounter()
+        _allocator = SessionIdAllocator(counter, getattr(settings, 'QUIDEM_SESSION_ID_BLOCK', 64))
+    return _allocator
+
+def get_marks():
+    global _marks
+    if _marks is None:
+        shared_cache = get_shared_cache()
+        _marks = CacheMarks(shared_cache) if shared_cache is not None else LocalMarks()
+    return _marks
+
+# returns a new session id, marked as allocated so connections to it are accepted
+def allocate_session():
+    session_id = get_allocator().allocate()
+    get_marks().allocate(session_id, getattr(settings, 'QUIDEM_UNCLAIMED_SESSION_TTL', 60 * 60))
+    return session_id
+
+def is_allocated(session_id):
+    return get_marks().is_allocated(session_id)
+
+# returns True for the one connection that claims the session, which then hosts it
+def claim_session(session_id):
+    return get_marks().claim(session_id)
+
+# forgets a closed session, the id is not handed out again and connections to it are refused
+def release_session(session_id):
+    get_marks().release(session_id)
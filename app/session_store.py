@@ -0,0 +1,129 @@
+import abc
+import json
+import threading
+
+try:
+    import redis
+except ImportError: # redis is optional, only the redis store needs it
+    redis = None
+
+from django.conf import settings
+
+from .quidem import Quidem
+
+# Stores serialized Quidem sessions outside of the consumer that hosts them
+#
+# the store only carries a session from one worker to the next when the pool hands it over, the worker hosting
+# a session applies its actions in memory
+# every saved session has a revision, a save only goes through if the revision it was loaded at is still the latest
+# so a worker that lost track of a session cannot overwrite a newer copy saved by another one
+
+class SessionStoreError(Exception):
+    pass
+
+class RevisionConflict(SessionStoreError):
+    pass
+
+class SessionStore(abc.ABC):
+
+    # returns (revision, quidem), or (0, None) when the session is not stored
+    def load(self, quidem_id):
+        revision, data = self._read(quidem_id)
+        if data is None:
+            return 0, None
+        return revision, Quidem.from_dict(json.loads(data))
+
+    def revision(self, quidem_id):
+        return self._read(quidem_id)[0]
+
+    # saves the quidem if the stored revision is still expected_revision, 0 meaning not stored yet
+    # returns the new revision, raises RevisionConflict otherwise
+    def save(self, quidem, expected_revision):
+        return self._write(quidem.quidem_id, json.dumps(quidem.to_dict()), expected_revision)
+
+    @abc.abstractmethod
+    def delete(self, quidem_id):
+        pass
+
+    # returns (revision, serialized quidem), or (0, None) when the session is not stored
+    @abc.abstractmethod
+    def _read(self, quidem_id):
+        pass
+
+    # stores data if the stored revision is still expected_revision, returns the new revision
+    @abc.abstractmethod
+    def _write(self, quidem_id, data, expected_revision):
+        pass
+
+# store for tests and single process deployments
+class InMemorySessionStore(SessionStore):
+
+    def __init__(self):
+        self._sessions = {} # quidem_id -> (revision, serialized quidem)
+        self._lock = threading.Lock()
+
+    def delete(self, quidem_id):
+        with self._lock:
+            self._sessions.pop(quidem_id, None)
+
+    def _read(self, quidem_id):
+        return self._sessions.get(quidem_id, (0, None))
+
+    def _write(self, quidem_id, data, expected_revision):
+        with self._lock:
+            revision = self._sessions.get(quidem_id, (0, None))[0]
+            if revision != expected_revision:
+                raise RevisionConflict(f'Quidem {quidem_id} is at revision {revision}, not {expected_revision}')
+            self._sessions[quidem_id] = (revision + 1, data)
+            return revision + 1
+
+# keeps each session in a redis hash of its revision and serialized state
+# takes any client with the redis-py interface, the revision check runs in a WATCH / MULTI transaction
+class RedisSessionStore(SessionStore):
+
+    def __init__(self, client, prefix='quidem_session'):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        if redis is None:
+            raise SessionStoreError('The redis package is required to store sessions in redis')
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def _key(self, quidem_id):
+        return f'{self.prefix}:{quidem_id}'
+
+    def delete(self, quidem_id):
+        self.client.delete(self._key(quidem_id))
+
+    def _read(self, quidem_id):
+        revision, data = self.client.hmget(self._key(quidem_id), 'revision', 'data')
+        if data is None:
+            return 0, None
+        return int(revision), data
+
+    def _write(self, quidem_id, data, expected_revision):
+        key = self._key(quidem_id)
+        with self.client.pipeline() as pipeline:
+            try:
+                pipeline.watch(key)
+                revision = int(pipeline.hget(key, 'revision') or 0)
+                if revision != expected_revision:
+                    raise RevisionConflict(f'Quidem {quidem_id} is at revision {revision}, not {expected_revision}')
+                pipeline.multi()
+                pipeline.hset(key, mapping={'revision': revision + 1, 'data': data})
+                pipeline.execute()
+            except redis.WatchError:
+                raise RevisionConflict(f'Quidem {quidem_id} changed while saving it')
+        return revision + 1
+
+_session_store = None
+
+# the store named by the QUIDEM_SESSION_STORE_URL setting, in memory when it is not set
+def get_session_store():
+    global _session_store
+    if _session_store is None:
+        url = getattr(settings, 'QUIDEM_SESSION_STORE_URL', None)
+        _session_store = RedisSessionStore.from_url(url) if url else InMemorySessionStore()
+    return _session_store
@@ -40,6 +40,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'app',
 ]
 
 MIDDLEWARE = [
@@ -85,6 +86,53 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Quidem
+
+# broadcast only what changed between states, clients that miss a version get a full snapshot
+QUIDEM_DELTA_BROADCASTS = False
+
+# seconds the author waits for more changes before broadcasting the state, 0 broadcasts every change
+QUIDEM_BROADCAST_WINDOW = 0
+# seconds a change may wait for its broadcast however long a burst lasts
+QUIDEM_BROADCAST_MAX_DELAY = 0.25
+
+# ballots wait for the messages queued before them and only the latest ballot of each voter is applied
+QUIDEM_COALESCE_VOTES = False
+
+# cache shared by every worker that holds the session id counter and which sessions were allocated and claimed
+# None keeps them in the process, which only suits a single process, several processes need a cache like 'quidem' below
+QUIDEM_SESSION_ID_CACHE = None
+# seconds an allocated session waits for its author to connect before its id is refused
+QUIDEM_UNCLAIMED_SESSION_TTL = 60 * 60
+# session ids each worker leases from the shared counter at once
+QUIDEM_SESSION_ID_BLOCK = 64
+
+# redis url of the store that holds serialized sessions, None keeps them in memory
+QUIDEM_SESSION_STORE_URL = None
+
+# channels of the workers that host the sessions, each run with `manage.py runworker <channel>`
+# `manage.py quidem_pool` reports the sessions of each worker and changes which of them the sessions are spread over
+# needs QUIDEM_SESSION_STORE_URL and QUIDEM_SESSION_ID_CACHE, empty hosts every session in the consumer of its author
+QUIDEM_WORKERS = []
+
+# directory of the action logs the sessions are rebuilt from, None keeps no log
+QUIDEM_ACTION_LOG_DIR = None
+# accepted actions between two snapshots of a logged session, ie. the most actions replayed to rebuild it
+QUIDEM_SNAPSHOT_INTERVAL = 100
+
+# counts actions, broadcasts, sessions and joins, served at /metrics/ in the Prometheus text format
+QUIDEM_METRICS = False
+
+# directory the sampling profiler writes the folded stacks of the sessions to, None does not profile, see profiling
+# the environment can turn it on for a running deployment, ie. QUIDEM_PROFILE_DIR=/tmp/profiles QUIDEM_PROFILE_SESSIONS=42,43
+QUIDEM_PROFILE_DIR = os.environ.get('QUIDEM_PROFILE_DIR')
+# seconds between two samples
+QUIDEM_PROFILE_INTERVAL = float(os.environ.get('QUIDEM_PROFILE_INTERVAL', 0.005))
+# quidem ids of the sessions to profile, None profiles every session
+QUIDEM_PROFILE_SESSIONS = [int(quidem_id) for quidem_id in os.environ['QUIDEM_PROFILE_SESSIONS'].split(',')] if os.environ.get('QUIDEM_PROFILE_SESSIONS') else None
+# seconds between two writes of the profiles of the live sessions
+QUIDEM_PROFILE_DUMP_INTERVAL = 10
+
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
 
@@ -102,7 +150,14 @@ CACHES = {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
         'LOCATION': 'unique-snowflake',
         'TIMEOUT': 5000,
-    }
+    },
+    # session ids shared by several processes, see QUIDEM_SESSION_ID_CACHE, needs the redis package
+    # the claimed sessions never expire so redis must not evict them (maxmemory-policy noeviction)
+    # 'quidem': {
+    #     'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+    #     'LOCATION': 'redis://127.0.0.1:6379/1',
+    #     'TIMEOUT': None,
+    # }
 }
 
 # Password validation
@@ -0,0 +1,105 @@
+# Differences between two states of the same view, so broadcasts only carry what changed
+#
+# a delta holds
+# - set - top level keys replaced by a new value
+# - unset - top level keys no longer in the state
+# - patch - top level keys patched entry by entry
+#   - dicts (users, settings, votes) as {'set': {key: value}, 'unset': [key]}
+#   - lists keyed by an id (nominations) as {'set': [[index, item]], 'unset': [id]}
+#     items are removed, then set items are (re)inserted at their index in ascending order
+
+KEYED_LISTS = {
+    'nominations': 'nomination_id'
+}
+
+# returns None when nothing changed
+def diff_state(old, new):
+    delta = {}
+    changed = {}
+    patched = {}
+    for key, value in new.items():
+        if key not in old:
+            changed[key] = value
+        elif old[key] != value:
+            patch = _diff_value(key, old[key], value)
+            if patch is None:
+                changed[key] = value
+            else:
+                patched[key] = patch
+    unset = [key for key in old if key not in new]
+
+    if changed:
+        delta['set'] = changed
+    if unset:
+        delta['unset'] = unset
+    if patched:
+        delta['patch'] = patched
+    return delta or None
+
+# returns None when the value is better replaced as a whole
+def _diff_value(key, old, new):
+    if isinstance(old, dict) and isinstance(new, dict):
+        return _diff_dict(old, new)
+    elif key in KEYED_LISTS and isinstance(old, list) and isinstance(new, list):
+        return _diff_keyed_list(KEYED_LISTS[key], old, new)
+    return None
+
+def _diff_dict(old, new):
+    patch = {}
+    changed = {key: value for key, value in new.items() if key not in old or old[key] != value}
+    unset = [key for key in old if key not in new]
+    if len(changed) + len(unset) >= len(new):
+        return None
+    if changed:
+        patch['set'] = changed
+    if unset:
+        patch['unset'] = unset
+    return patch
+
+def _diff_keyed_list(id_key, old, new):
+    old_items = {item[id_key]: item for item in old}
+    new_ids = {item[id_key] for item in new}
+    if len(old_items) != len(old) or len(new_ids) != len(new):
+        return None
+
+    changed = [[index, item] for index, item in enumerate(new) if old_items.get(item[id_key]) != item]
+    unset = [item_id for item_id in old_items if item_id not in new_ids]
+
+    # the items left alone must keep their relative order for the patch to rebuild the list
+    changed_ids = {item[id_key] for _, item in changed}
+    kept_old = [item[id_key] for item in old if item[id_key] in new_ids and item[id_key] not in changed_ids]
+    kept_new = [item[id_key] for item in new if item[id_key] not in changed_ids]
+    if kept_old != kept_new or len(changed) + len(unset) >= len(new):
+        return None
+
+    patch = {}
+    if changed:
+        patch['set'] = changed
+    if unset:
+        patch['unset'] = unset
+    return patch
+
+# returns a new state with the delta applied, as a client would
+def apply_delta(state, delta):
+    state = dict(state)
+    for key in delta.get('unset', []):
+        state.pop(key, None)
+    state.update(delta.get('set', {}))
+    for key, patch in delta.get('patch', {}).items():
+        if key in KEYED_LISTS:
+            state[key] = _apply_keyed_list(KEYED_LISTS[key], state[key], patch)
+        else:
+            value = dict(state[key])
+            for entry in patch.get('unset', []):
+                value.pop(entry, None)
+            value.update(patch.get('set', {}))
+            state[key] = value
+    return state
+
+def _apply_keyed_list(id_key, items, patch):
+    removed = set(patch.get('unset', []))
+    removed.update(item[id_key] for _, item in patch.get('set', []))
+    items = [item for item in items if item[id_key] not in removed]
+    for index, item in patch.get('set', []):
+        items.insert(index, item)
+    return items
@@ -0,0 +1,147 @@
+import itertools
+
+try:
+    import numpy
+except ImportError: # numpy is optional, the python engine is always available
+    numpy = None
+
+# Tally engines used to turn ballots into ranked results
+
+PYTHON = 'python'
+NUMPY = 'numpy'
+
+# below this many ballots the numpy packing overhead outweighs the batched scoring
+NUMPY_MIN_BALLOTS = 512
+
+def _result(nomination_id, nomination, votes):
+    return {
+        'nomination': nomination,
+        'nomination_id': nomination_id,
+        'votes': votes
+    }
+
+# nominations - list of (nomination_id, nomination) pairs, ties keep this order
+# vote_sets - sized collection of ballots, each a list of nomination ids (ints or numeric strings)
+# weights - points of each ballot position (see scoring.weight_vector), later positions are worth nothing
+# returns the nominations with their points, sorted by descending points
+def tally(nominations, vote_sets, weights, engine=None):
+    if engine is None:
+        engine = NUMPY if numpy is not None and len(vote_sets) >= NUMPY_MIN_BALLOTS else PYTHON
+    if engine == NUMPY:
+        return numpy_tally(nominations, vote_sets, weights)
+    elif engine == PYTHON:
+        return python_tally(nominations, vote_sets, weights)
+    raise ValueError(f'Unknown tally engine {engine}')
+
+def python_tally(nominations, vote_sets, weights):
+    results = {}
+    for nomination_id, nomination in nominations:
+        results[nomination_id] = _result(nomination_id, nomination, 0)
+
+    for vote_set in vote_sets:
+        for i in range(min(len(vote_set), len(weights))):
+            nomination_id = int(vote_set[i])
+            if nomination_id in results:
+                results[nomination_id]['votes'] += weights[i]
+
+    return sorted(results.values(), key=lambda item: -item['votes'])
+
+# returns the ballot lengths and every nomination id flattened into one array
+# a BallotStore hands over its buffer as is, ballots holding numeric strings go through int()
+def _pack(vote_sets):
+    pack = getattr(vote_sets, 'pack', None)
+    if pack is not None:
+        buffer, offsets = pack()
+        buffer = numpy.frombuffer(buffer, dtype=numpy.dtype(f'i{buffer.itemsize}')) if len(buffer) else numpy.zeros(0, dtype=numpy.int64)
+        offsets = numpy.array(offsets, dtype=numpy.intp)
+        ids = numpy.ones(len(buffer), dtype=bool)
+        ids[offsets] = False
+        return buffer[offsets].astype(numpy.intp), buffer[ids].astype(numpy.int64)
+
+    lengths = numpy.fromiter(map(len, vote_sets), dtype=numpy.intp, count=len(vote_sets))
+    count = int(lengths.sum())
+    try:
+        flat = numpy.fromiter(itertools.chain.from_iterable(vote_sets), dtype=numpy.int64, count=count)
+    except (TypeError, ValueError):
+        flat = numpy.fromiter(map(int, itertools.chain.from_iterable(vote_sets)), dtype=numpy.int64, count=count)
+    return lengths, flat
+
+# packs every ballot into a (ballots x ranks) matrix of nomination columns, histograms
+# the (nomination, rank) pairs and scores all nominations with one product against the weight vector
+def numpy_tally(nominations, vote_sets, weights):
+    if numpy is None:
+        raise RuntimeError('The numpy tally engine requires numpy to be installed')
+
+    nomination_count = len(nominations)
+    lengths, flat = _pack(vote_sets)
+    width = int(lengths.max()) if len(lengths) else 0
+
+    integral = all(isinstance(weight, int) for weight in weights)
+    weights = numpy.array(weights, dtype=numpy.int64 if integral else numpy.float64)
+
+    scores = numpy.zeros(nomination_count, dtype=weights.dtype)
+    if width and nomination_count and len(weights):
+        # maps each nomination id on a ballot to its column through a lookup table spanning the id range
+        ids = numpy.array([nomination_id for nomination_id, _ in nominations], dtype=numpy.int64)
+        lowest = int(ids.min())
+        lookup = numpy.full(int(ids.max()) - lowest + 2, -1, dtype=numpy.int64) # last slot catches unknown ids
+        lookup[ids - lowest] = numpy.arange(nomination_count)
+        offsets = flat - lowest
+        offsets[(offsets < 0) | (offsets >= len(lookup))] = len(lookup) - 1
+        columns = lookup[offsets]
+
+        rows = numpy.repeat(numpy.arange(len(lengths)), lengths)
+        ranks = numpy.arange(len(flat)) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+        ballots = numpy.full((len(lengths), width), -1, dtype=numpy.int64)
+        ballots[rows, ranks] = columns
+
+        # positions past the weight vector are worth nothing
+        ballots = ballots[:, 0:len(weights)]
+        width = ballots.shape[1]
+        if width < len(weights):
+            weights = weights[0:width]
+
+        cells = (ballots * width + numpy.arange(width))[ballots >= 0]
+        rank_counts = numpy.bincount(cells, minlength=nomination_count * width).reshape(nomination_count, width)
+        scores = rank_counts @ weights
+
+    ranking = numpy.argsort(-scores, kind='stable')
+    points = scores.tolist()
+    return [_result(*nominations[i], points[i]) for i in ranking.tolist()]
+
+# Keeps the votes of every nomination up to date as ballots are added, replaced or withdrawn
+# so results can be read at any moment without going over every ballot
+class RunningTally():
+
+    def __init__(self, nominations, out_of, width):
+        self._nominations = list(nominations)
+        self.out_of = out_of
+        self._width = width
+
+        # ballots per (nomination, rank), integer counts never drift as ballots come and go
+        # so the weights are only applied when the votes are read, fractional weights included
+        self._rank_counts = {nomination_id: [0] * width for nomination_id, _ in self._nominations}
+
+    def add(self, vote_set):
+        self._update(vote_set, 1)
+
+    def remove(self, vote_set):
+        self._update(vote_set, -1)
+
+    def _update(self, vote_set, sign):
+        for i in range(min(len(vote_set), self._width)):
+            rank_counts = self._rank_counts.get(int(vote_set[i]))
+            if rank_counts is not None:
+                rank_counts[i] += sign
+
+    # returns the nominations with their points, sorted by descending points, same as tally
+    def results(self, weights):
+        return sorted(self.scores(weights), key=lambda item: -item['votes'])
+
+    # returns the nominations with their points, in the order of the nominations
+    def scores(self, weights):
+        weights = weights[0:self._width]
+        return [
+            _result(nomination_id, nomination, sum(count * weight for count, weight in zip(self._rank_counts[nomination_id], weights)))
+            for nomination_id, nomination in self._nominations
+        ]
@@ -0,0 +1,89 @@
+import pytest
+
+import gc
+import json
+import os
+import platform
+import sys
+import time
+
+# Records the timings of the benchmarks and checks them against a baseline
+#
+# QUIDEM_BENCHMARK_JSON - file the timings of the run are written to, ie. to keep as the next baseline
+# QUIDEM_BENCHMARK_BASELINE - timings of an earlier run on the same machine
+# QUIDEM_BENCHMARK_THRESHOLD - a benchmark fails once it takes more than this many times its baseline, 1.5 by default
+
+# one repeat runs the benchmarked call at least this long, so fast calls are timed over many runs
+MIN_REPEAT_TIME = 0.005
+
+class BenchmarkRecorder():
+
+    def __init__(self, baseline=None, threshold=1.5):
+        self.baseline = baseline or {} # name -> seconds per call
+        self.threshold = threshold
+        self.results = {}
+
+    # seconds per call of func, the best of repeat runs, fails when it regressed against the baseline
+    # the garbage collector is paused while timing, as timeit does, so collections of other objects do not count
+    def measure(self, name, func, repeat=5):
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            number = self._calibrate(func)
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for _ in range(number):
+                    func()
+                elapsed = (time.perf_counter() - start) / number
+                best = elapsed if best is None else min(best, elapsed)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        self.results[name] = {
+            'seconds': best,
+            'number': number,
+            'repeat': repeat
+        }
+        baseline = self.baseline.get(name)
+        if baseline is not None and best > baseline * self.threshold:
+            pytest.fail(f'{name} takes {best * 1e6:.1f}us, {best / baseline:.2f}x its baseline of {baseline * 1e6:.1f}us')
+        return best
+
+    # number of calls making up one repeat
+    def _calibrate(self, func):
+        number = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            if time.perf_counter() - start >= MIN_REPEAT_TIME:
+                return number
+            number *= 10
+
+    def to_dict(self):
+        return {
+            'python': sys.version.split()[0],
+            'machine': platform.machine(),
+            'threshold': self.threshold,
+            'results': self.results
+        }
+
+def load_baseline(path):
+    with open(path) as baseline_file:
+        return {name: result['seconds'] for name, result in json.load(baseline_file)['results'].items()}
+
+@pytest.fixture(scope='session')
+def benchmark_recorder():
+    baseline_path = os.environ.get('QUIDEM_BENCHMARK_BASELINE')
+    recorder = BenchmarkRecorder(
+        load_baseline(baseline_path) if baseline_path else None,
+        float(os.environ.get('QUIDEM_BENCHMARK_THRESHOLD', 1.5))
+    )
+    yield recorder
+
+    output_path = os.environ.get('QUIDEM_BENCHMARK_JSON')
+    if output_path and recorder.results:
+        with open(output_path, 'w') as output_file:
+            json.dump(recorder.to_dict(), output_file, indent=2, sort_keys=True)
@@ -0,0 +1,42 @@
+import pytest
+
+import random
+import tracemalloc
+
+from ...ballots import BallotStore
+
+pytestmark = pytest.mark.benchmark
+
+def allocated(build):
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    store = build()
+    end, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return end - start, store
+
+@pytest.mark.parametrize('slots', [3, 10])
+def test_bytes_per_ballot(slots):
+    voters = 20000
+    rng = random.Random(0)
+    ids = list(range(-2000, 20))
+    vote_sets = [rng.sample(ids, slots) for _ in range(voters)]
+
+    def build_dict_of_str_lists():
+        return {consumer_id: [str(nomination_id) for nomination_id in vote_set] for consumer_id, vote_set in enumerate(vote_sets, 1)}
+
+    def build_dict_of_lists():
+        return {consumer_id: [int(nomination_id) for nomination_id in vote_set] for consumer_id, vote_set in enumerate(vote_sets, 1)}
+
+    def build_store():
+        store = BallotStore()
+        for consumer_id, vote_set in enumerate(vote_sets, 1):
+            store[consumer_id] = vote_set
+        return store
+
+    str_lists, _ = allocated(build_dict_of_str_lists)
+    lists, _ = allocated(build_dict_of_lists)
+    store, _ = allocated(build_store)
+
+    print(f'\n{slots} slots, bytes per ballot: dict of str lists {str_lists / voters:.0f}, dict of lists {lists / voters:.0f}, BallotStore {store / voters:.0f}')
+    assert store < lists < str_lists
@@ -0,0 +1,163 @@
+import pytest
+
+import asyncio
+import json
+import time
+
+from django.urls import re_path
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+
+from ...quidem import Quidem, Action
+from ...consumers import QuidemConsumer
+from ...session_ids import allocate_session
+
+pytestmark = pytest.mark.benchmark
+
+# Messages/sec and latency of a burst of votes through the consumers, on the in-memory channel layer
+# the harness only speaks the websocket protocol, so the same file measures any QuidemConsumer implementation
+
+def get_application():
+    consumer = QuidemConsumer.as_asgi() if hasattr(QuidemConsumer, 'as_asgi') else QuidemConsumer
+    return URLRouter([re_path(r'ws/quidem/.+/$', consumer)])
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+async def connect(application, session_id, key, nickname):
+    communicator = WebsocketCommunicator(application, f'ws/quidem/{session_id}&{key}&{nickname}/')
+    connected, _ = await communicator.connect()
+    assert connected
+    return communicator
+
+async def receive_all(communicator, timeout=0.2):
+    frames = []
+    while not await communicator.receive_nothing(timeout=timeout):
+        frames.append(json.loads(await communicator.receive_from()))
+    return frames
+
+# returns the author and a consumer_id -> communicator dict of users that joined during PRE_VOTING
+async def open_session(application, session_id, users):
+    author = await connect(application, session_id, 0, 'author')
+    await author.send_json_to({'action': Action.NEXT_PHASE.value})
+    await author.send_json_to({'action': Action.NOMINATE.value, 'consumer_id': Quidem.AUTHOR, 'body': {'nomination': 'nomination'}})
+    await receive_all(author)
+
+    joined = {}
+    for key in range(1, users + 1):
+        user = await connect(application, session_id, key, f'user{key}')
+        consumer_id = (await user.receive_json_from())['consumer_id']
+        joined[consumer_id] = user
+
+    await author.send_json_to({'action': Action.NEXT_PHASE.value})
+    await receive_all(author)
+    await asyncio.gather(*(receive_all(user) for user in joined.values()))
+    return author, joined
+
+# every user votes once, a vote counts as delivered when the author receives a state holding it
+async def vote_burst(author, users):
+    sent_at = {}
+    latencies = []
+    frames = 0
+
+    async def receive_author():
+        nonlocal frames
+        while len(latencies) < len(users):
+            frame = json.loads(await author.receive_from(timeout=30))
+            frames += 1
+            received_at = time.perf_counter()
+            for consumer_id in frame['state']['votes']:
+                if int(consumer_id) in sent_at:
+                    latencies.append(received_at - sent_at.pop(int(consumer_id)))
+
+    start = time.perf_counter()
+    receiver = asyncio.ensure_future(receive_author())
+    for consumer_id, user in users.items():
+        sent_at[consumer_id] = time.perf_counter()
+        await user.send_json_to({'action': Action.VOTE.value, 'body': {'vote_set': [0]}})
+    await receiver
+    elapsed = time.perf_counter() - start
+
+    user_frames = await asyncio.gather(*(receive_all(user, timeout=0.5) for user in users.values()))
+    frames += sum(len(received) for received in user_frames)
+    return elapsed, frames, latencies
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('users', [20, 100])
+async def test_vote_burst(settings, users):
+    settings.CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {
+                'capacity': 10000
+            }
+        }
+    }
+    application = get_application()
+
+    author, joined = await open_session(application, allocate_session(), users)
+    assert len(joined) == users
+    elapsed, frames, latencies = await vote_burst(author, joined)
+
+    print(f'\n{QuidemConsumer.__bases__[0].__name__}, {users} users: {users / elapsed:.0f} votes/sec, {frames / elapsed:.0f} messages/sec, '
+        f'p50 {percentile(latencies, 0.5) * 1000:.1f}ms, p99 {percentile(latencies, 0.99) * 1000:.1f}ms')
+    assert len(latencies) == users
+
+    for communicator in [author, *joined.values()]:
+        await communicator.disconnect()
+
+# users connecting all at once are admitted in batches, each batch costs a single broadcast
+@pytest.mark.asyncio
+@pytest.mark.parametrize('users', [1000])
+async def test_join_storm(settings, users):
+    settings.CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {
+                'capacity': 100000
+            }
+        }
+    }
+    application = get_application()
+    session_id = allocate_session()
+
+    author = await connect(application, session_id, 0, 'author')
+    await author.send_json_to({'action': Action.NEXT_PHASE.value})
+    await receive_all(author)
+
+    start = time.perf_counter()
+    joined = await asyncio.gather(*(connect(application, session_id, key, f'user{key}') for key in range(1, users + 1)))
+    replies = await asyncio.gather(*(user.receive_json_from(timeout=30) for user in joined))
+    elapsed = time.perf_counter() - start
+    broadcasts = await receive_all(author, timeout=0.5)
+
+    print(f'\n{users} joins in {elapsed:.2f}s, {len(broadcasts)} broadcasts')
+    assert len({reply['consumer_id'] for reply in replies}) == users
+    assert len(broadcasts) < users / 10
+
+    for communicator in [author, *joined]:
+        await communicator.disconnect()
+
+# whole sessions driven through routing.application by the load generator, see loadgen
+@pytest.mark.asyncio
+@pytest.mark.parametrize('rooms, users', [(1, 1000), (10, 100)])
+async def test_load(settings, rooms, users):
+    from ...loadgen import run_load
+    from ...routing import application
+
+    settings.CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {
+                'capacity': 100000
+            }
+        }
+    }
+    settings.QUIDEM_BROADCAST_WINDOW = 0.05
+    settings.QUIDEM_DELTA_BROADCASTS = True
+
+    stats = await run_load(application, rooms, users)
+
+    print(f'\n{rooms} rooms of {users} users\n{stats.format()}')
+    assert stats.rejected == 0 and stats.lost == 0
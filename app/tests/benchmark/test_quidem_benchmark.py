@@ -0,0 +1,103 @@
+import pytest
+
+import functools
+import itertools
+import random
+
+from ...quidem import Quidem, Action, ActionError
+
+pytestmark = pytest.mark.benchmark
+
+# Time per call of the hot paths of the Quidem engine on synthetic sessions
+# the timings go through benchmark_recorder (see conftest), which saves them as JSON and compares them with a baseline
+
+VOTERS = [100, 10000]
+NOMINATIONS = [10, 1000]
+SLOTS = [3, 10]
+
+# a session in VOTING where every voter cast a ballot, half of the nominations come from users
+# cached since it is only read, the benchmarks that change it restore what they change
+@functools.lru_cache(maxsize=None)
+def synthetic_session(voters, nominations, slots, seed=0):
+    rng = random.Random(seed)
+    quidem = Quidem(quidem_id=1, settings={'max_voting_slots': slots})
+    quidem.next_phase()
+    quidem.new_consumers([f'user{index}' for index in range(1, voters + 1)])
+    user_nominations = min(nominations // 2, voters)
+    for consumer_id in range(1, user_nominations + 1):
+        quidem.nominate(consumer_id, f'user nomination {consumer_id}')
+    for index in range(nominations - user_nominations):
+        quidem.nominate(Quidem.AUTHOR, f'author nomination {index}')
+    quidem.next_phase()
+
+    nomination_ids = [item['nomination_id'] for item in quidem.get_state(True)['nominations']]
+    ballot_size = min(slots, len(nomination_ids))
+    for consumer_id in range(1, voters + 1):
+        quidem.vote(consumer_id, rng.sample(nomination_ids, ballot_size))
+    return quidem, nomination_ids
+
+# ballots to cast in turn, each voter keeps replacing its ballot
+def ballot_cycle(voters, nomination_ids, slots, seed=1):
+    rng = random.Random(seed)
+    ballot_size = min(slots, len(nomination_ids))
+    return itertools.cycle([(consumer_id, rng.sample(nomination_ids, ballot_size)) for consumer_id in range(1, min(voters, 1000) + 1)])
+
+session_params = pytest.mark.parametrize('voters, nominations, slots', list(itertools.product(VOTERS, NOMINATIONS, SLOTS)))
+
+def name(path, voters, nominations, slots):
+    return f'{path}[voters={voters},nominations={nominations},slots={slots}]'
+
+@session_params
+def test_calculate_votes(benchmark_recorder, voters, nominations, slots):
+    quidem, _ = synthetic_session(voters, nominations, slots)
+    benchmark_recorder.measure(name('calculate_votes', voters, nominations, slots), quidem.calculate_votes)
+
+@session_params
+@pytest.mark.parametrize('is_author', [False, True])
+def test_get_state(benchmark_recorder, voters, nominations, slots, is_author):
+    quidem, _ = synthetic_session(voters, nominations, slots)
+    def get_state():
+        quidem._changed() # states are cached per version
+        quidem.get_state(is_author)
+    benchmark_recorder.measure(name(f'get_state_{"author" if is_author else "user"}', voters, nominations, slots), get_state)
+
+@session_params
+def test_get_nominations(benchmark_recorder, voters, nominations, slots):
+    quidem, _ = synthetic_session(voters, nominations, slots)
+    def get_nominations():
+        quidem._nominations._invalidate() # the view is cached until the nominations change
+        quidem._get_nominations()
+    benchmark_recorder.measure(name('get_nominations', voters, nominations, slots), get_nominations)
+
+@session_params
+def test_vote(benchmark_recorder, voters, nominations, slots):
+    quidem, nomination_ids = synthetic_session(voters, nominations, slots)
+    ballots = ballot_cycle(voters, nomination_ids, slots)
+    def vote():
+        quidem.vote(*next(ballots))
+    benchmark_recorder.measure(name('vote', voters, nominations, slots), vote)
+
+@session_params
+def test_process_action(benchmark_recorder, voters, nominations, slots):
+    quidem, nomination_ids = synthetic_session(voters, nominations, slots)
+    ballots = ballot_cycle(voters, nomination_ids, slots)
+    def process_action():
+        consumer_id, vote_set = next(ballots)
+        quidem.process_action(Action.VOTE.value, consumer_id, None, {'vote_set': vote_set})
+    benchmark_recorder.measure(name('process_action', voters, nominations, slots), process_action)
+
+# a batch of two ballots, the second one fails so the first is undone every time
+@session_params
+def test_process_actions(benchmark_recorder, voters, nominations, slots):
+    quidem, nomination_ids = synthetic_session(voters, nominations, slots)
+    ballots = ballot_cycle(voters, nomination_ids, slots)
+    def process_actions():
+        consumer_id, vote_set = next(ballots)
+        try:
+            quidem.process_actions(consumer_id, [
+                {'action': Action.VOTE.value, 'body': {'vote_set': vote_set}},
+                {'action': Action.VOTE.value, 'body': {'vote_set': ['x']}}
+            ])
+        except ActionError:
+            pass
+    benchmark_recorder.measure(name('process_actions', voters, nominations, slots), process_actions)
@@ -0,0 +1,47 @@
+import pytest
+
+import time
+
+from ...quidem import VotingAlgorithm
+from ... import tally, scoring
+from ...leaderboard import Leaderboard
+from ..unit.test_tally import random_session
+
+pytestmark = pytest.mark.benchmark
+
+def best_of(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+@pytest.mark.skipif(tally.numpy is None, reason='numpy is not installed')
+@pytest.mark.parametrize('voters', [10000, 100000])
+def test_numpy_tally_speedup(voters):
+    nominations, vote_sets, out_of = random_session(0, voters, author_nominations=20, user_nominations=200, slots=5)
+    vote_sets = [[int(nomination_id) for nomination_id in vote_set] for vote_set in vote_sets]
+    weights = scoring.weight_vector(VotingAlgorithm.exponential.value, out_of, 5)
+
+    python_time = best_of(lambda: tally.python_tally(nominations, vote_sets, weights))
+    numpy_time = best_of(lambda: tally.numpy_tally(nominations, vote_sets, weights))
+
+    print(f'\n{voters} ballots: python {python_time * 1000:.1f}ms, numpy {numpy_time * 1000:.1f}ms, speedup {python_time / numpy_time:.1f}x')
+    assert numpy_time < python_time
+
+# the views of a closed brainstorm only show the first few results
+@pytest.mark.parametrize('nominations', [1000, 10000])
+def test_leaderboard_top(nominations):
+    results = [{'nomination': str(index), 'nomination_id': index, 'votes': (index * 7919) % 1000} for index in range(nominations)]
+    ranking = sorted(results, key=lambda item: -item['votes'])
+
+    sort_time = best_of(lambda: sorted(results, key=lambda item: -item['votes'])[0:10])
+    leaderboard = Leaderboard(results)
+    top_time = best_of(lambda: leaderboard.top(10))
+    build_time = best_of(lambda: Leaderboard(results))
+
+    print(f'\n{nominations} nominations, top 10: sort {sort_time * 1000:.2f}ms, leaderboard {top_time * 1000:.3f}ms (built in {build_time * 1000:.2f}ms)')
+    assert leaderboard.top(10) == ranking[0:10]
+    assert top_time < sort_time
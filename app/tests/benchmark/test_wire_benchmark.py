@@ -0,0 +1,68 @@
+import pytest
+
+import json
+import random
+import time
+
+from ...quidem import Quidem
+from ... import wire
+
+pytestmark = pytest.mark.benchmark
+
+# Payload size and encode / decode time of the state frames in each wire format
+# a frame is encoded from the JSON state of the session host, as a consumer does for its client
+
+def best_of(func, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+# a session of users, half of them nominating, everyone voting, closed when results are wanted
+def realistic_session(users, closed=False):
+    rng = random.Random(0)
+    quidem = Quidem(quidem_id=1)
+    quidem.next_phase()
+    quidem.new_consumers([f'user{index}' for index in range(1, users + 1)])
+    for consumer_id in range(1, users + 1, 2):
+        quidem.nominate(consumer_id, f'nomination of user {consumer_id}')
+    quidem.next_phase()
+    nomination_ids = [item['nomination_id'] for item in quidem.get_state(True)['nominations']]
+    for consumer_id in range(1, users + 1):
+        quidem.vote(consumer_id, rng.sample(nomination_ids, 3))
+    if closed:
+        quidem.next_phase()
+        quidem.next_phase()
+    return quidem
+
+@pytest.mark.skipif(wire.msgpack is None, reason='msgpack is not installed')
+@pytest.mark.parametrize('users', [20, 200, 2000])
+@pytest.mark.parametrize('closed', [False, True])
+@pytest.mark.parametrize('is_author', [False, True])
+def test_state_frame(users, closed, is_author):
+    quidem = realistic_session(users, closed)
+    state = dict(quidem.get_state(is_author))
+    if not is_author:
+        del state['votes']
+    encoded = json.dumps(state).encode()
+    fields = {'vote': [0, -1, -3], 'user': 1, 'nickname': 'user1'}
+
+    print(f'\n{users} users, {"closed" if closed else "voting"}, {"author" if is_author else "user"} view:')
+    sizes = {}
+    for codec in (wire.JSON, wire.MSGPACK):
+        frame = codec.state_frame(quidem.version, encoded, fields)
+        sizes[codec.subprotocol] = len(frame.encode() if isinstance(frame, str) else frame)
+
+        # the first consumer of a process converts the shared state, the next ones only splice their fields
+        def encode_first():
+            wire._pack_json.cache_clear()
+            codec.state_frame(quidem.version, encoded, fields)
+        encode_first_time = best_of(encode_first)
+        encode_time = best_of(lambda: codec.state_frame(quidem.version, encoded, fields))
+        decode_time = best_of(lambda: wire.MSGPACK.decode(frame) if codec.binary else json.loads(frame))
+        print(f'  {codec.subprotocol}: {sizes[codec.subprotocol]} bytes, encode {encode_first_time * 1e6:.0f}us first / {encode_time * 1e6:.0f}us next, decode {decode_time * 1e6:.0f}us')
+
+    assert sizes['quidem.msgpack'] < sizes['quidem.json']
@@ -0,0 +1,10 @@
+import pytest
+
+from .. import session_ids
+
+# every test starts with session ids of its own, kept in the process
+@pytest.fixture(autouse=True)
+def local_session_ids(settings, monkeypatch):
+    settings.QUIDEM_SESSION_ID_CACHE = None
+    monkeypatch.setattr(session_ids, '_allocator', None)
+    monkeypatch.setattr(session_ids, '_marks', None)
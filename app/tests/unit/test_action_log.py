@@ -0,0 +1,199 @@
+import pytest
+
+import threading
+
+from ...quidem import Quidem, Action
+from ... import action_log
+from ...action_log import ActionLog, ActionLogError, replay, read_entries, recover_session
+from ...session_host import SessionHost
+
+# the actions of a short session, as (action, sender, target_consumer_id, body)
+ACTIONS = [
+    (Action.CHANGE_SETTING.value, Quidem.AUTHOR, None, {'question': 'lunch?'}),
+    (Action.NEXT_PHASE.value, Quidem.AUTHOR, None, None),
+    (Action.JOIN.value, Quidem.AUTHOR, None, {'nicknames': ['Bob', 'Alice', 'Carol']}),
+    (Action.NOMINATE.value, 1, 1, {'nomination': 'pizza'}),
+    (Action.NOMINATE.value, 2, 2, {'nomination': 'sushi'}),
+    (Action.NOMINATE.value, Quidem.AUTHOR, Quidem.AUTHOR, {'nomination': 'tacos'}),
+    (action_log.DISCONNECT, Quidem.AUTHOR, 3, None),
+    (Action.NEXT_PHASE.value, Quidem.AUTHOR, None, None),
+    (Action.VOTE.value, 1, None, {'vote_set': [-2, 0]}),
+    (Action.VOTE.value, 2, None, {'vote_set': [-1]}),
+    (Action.VOTE.value, 1, None, {'vote_set': [0, -1]}),
+    (Action.NEXT_PHASE.value, Quidem.AUTHOR, None, None),
+    (Action.NEXT_PHASE.value, Quidem.AUTHOR, None, None),
+]
+
+# applies the actions to quidem and records them
+def run_session(log, quidem, actions=ACTIONS):
+    for action, sender, target_consumer_id, body in actions:
+        action_log.apply_entry(quidem, [None, action, sender, target_consumer_id, body])
+        log.record(quidem, action, sender, target_consumer_id, body)
+    return quidem
+
+class TestActionLog:
+
+    def test_rebuild(self):
+        log = ActionLog(snapshot_interval=5)
+        quidem = Quidem(quidem_id=1)
+        log.snapshot(quidem)
+        run_session(log, quidem)
+        assert log.seq == len(ACTIONS)
+        assert log.rebuild().to_dict() == quidem.to_dict()
+
+    # the tail replayed on top of the snapshot never grows past the interval
+    def test_bounded_tail(self):
+        log = ActionLog(snapshot_interval=4)
+        quidem = Quidem(quidem_id=1)
+        log.snapshot(quidem)
+        for count in range(1, len(ACTIONS) + 1):
+            run_session(log, quidem, ACTIONS[count - 1:count])
+            assert len(log._tail) == count % 4
+            assert log.rebuild().to_dict() == quidem.to_dict()
+
+    def test_no_snapshot(self):
+        with pytest.raises(ActionLogError):
+            ActionLog().rebuild()
+
+    def test_file(self, tmp_path):
+        path = str(tmp_path / 'quidem_1.log')
+        log = ActionLog(path, snapshot_interval=5)
+        quidem = Quidem(quidem_id=1)
+        log.snapshot(quidem)
+        run_session(log, quidem, ACTIONS[:7])
+        log.close()
+        log.wait()
+
+        # carries on where it left off
+        log = ActionLog.load(path, snapshot_interval=5)
+        assert log.seq == 7
+        run_session(log, quidem, ACTIONS[7:])
+        log.close()
+        log.wait()
+
+        assert ActionLog.load(path).rebuild().to_dict() == quidem.to_dict()
+        entries = list(read_entries(path))
+        assert [entry[0] for entry in entries] == list(range(1, len(ACTIONS) + 1))
+        # the whole log replays from a new session
+        assert replay(entries, Quidem(quidem_id=1)).to_dict() == quidem.to_dict()
+
+    # the files are written by the writer thread, the caller only waits for them when asked to
+    def test_writer_thread(self, tmp_path, monkeypatch):
+        threads = []
+        write_line = ActionLog._write_line
+        def record_thread(log_file, line):
+            threads.append(threading.current_thread())
+            write_line(log_file, line)
+        monkeypatch.setattr(ActionLog, '_write_line', staticmethod(record_thread))
+
+        path = str(tmp_path / 'quidem_1.log')
+        log = ActionLog(path)
+        quidem = Quidem(quidem_id=1)
+        log.snapshot(quidem)
+        run_session(log, quidem, ACTIONS[:3])
+        log.wait()
+        assert [entry[0] for entry in read_entries(path)] == [1, 2, 3]
+        assert len(threads) == 3 and threading.current_thread() not in threads
+        log.close()
+
+    # closing only queues the close, the event loop waits for the files with drain()
+    @pytest.mark.asyncio
+    async def test_drain(self, tmp_path):
+        path = str(tmp_path / 'quidem_1.log')
+        log = ActionLog(path)
+        quidem = Quidem(quidem_id=1)
+        log.snapshot(quidem)
+        run_session(log, quidem, ACTIONS[:3])
+        log.close()
+        await log.drain()
+        assert ActionLog.load(path).rebuild().to_dict() == quidem.to_dict()
+
+    def test_write_error(self, tmp_path):
+        log = ActionLog(str(tmp_path / 'quidem_1.log'))
+        log.path = str(tmp_path / 'missing' / 'quidem_1.log')
+        log.snapshot(Quidem(quidem_id=1))
+        with pytest.raises(FileNotFoundError):
+            log.wait()
+        log._file.close()
+
+    def test_torn_entry(self, tmp_path):
+        path = str(tmp_path / 'quidem_1.log')
+        log = ActionLog(path)
+        quidem = Quidem(quidem_id=1)
+        log.snapshot(quidem)
+        run_session(log, quidem, ACTIONS[:3])
+        log.close()
+        log.wait()
+        with open(path, 'ab') as log_file:
+            log_file.write(b'[4,4,1,1,{"nomi')
+
+        log = ActionLog.load(path)
+        assert log.seq == 3
+        run_session(log, quidem, ACTIONS[3:4])
+        log.close()
+        log.wait()
+        assert [entry[0] for entry in read_entries(path)] == [1, 2, 3, 4]
+        assert ActionLog.load(path).rebuild().to_dict() == quidem.to_dict()
+
+# drops what the host sends
+class LayerStub:
+
+    async def send(self, channel, message):
+        pass
+
+    async def group_send(self, group, message):
+        pass
+
+@pytest.mark.asyncio
+class TestSessionHostLog:
+
+    @pytest.fixture
+    def host(self, settings, tmp_path):
+        settings.QUIDEM_ACTION_LOG_DIR = str(tmp_path)
+        settings.QUIDEM_SNAPSHOT_INTERVAL = 3
+        settings.QUIDEM_BROADCAST_WINDOW = 0
+        host = SessionHost(Quidem(quidem_id=1), LayerStub(), 'author')
+        yield host
+        host.release()
+
+    async def send(self, host, action, sender=Quidem.AUTHOR, consumer_id=None, body=None):
+        await host.process_action({'content': {'action': action, 'consumer_id': consumer_id, 'body': body}, 'sender': sender})
+
+    async def test_recover(self, host):
+        await self.send(host, Action.CHANGE_SETTING.value, body={'question': 'lunch?'})
+        await self.send(host, Action.NEXT_PHASE.value)
+        for nickname in ['Bob', 'Alice']:
+            await host.response_to_join_request({'channel_name': nickname, 'nickname': nickname})
+        await host.admit_joins({})
+        await self.send(host, Action.NOMINATE.value, 1, 1, {'nomination': 'pizza'})
+        # rejected actions are not logged
+        await self.send(host, Action.VOTE.value, 1, body={'vote_set': [-1]})
+        await host.disconnect_consumer({'consumer_id': 2})
+        await self.send(host, Action.NEXT_PHASE.value)
+        await self.send(host, Action.VOTE.value, 1, body={'vote_set': [-1]})
+
+        assert host.action_log.seq == 6
+        host.action_log.wait()
+        assert recover_session(1).to_dict() == host.quidem.to_dict()
+
+    # a new session with the id of an older one does not carry on with its log, a session hosted again does
+    async def test_new_session(self, host):
+        await self.send(host, Action.NEXT_PHASE.value)
+        session_log = host.action_log
+        host.release()
+        session_log.wait()
+        host.action_log = None
+        resumed = SessionHost(host.quidem, LayerStub(), 'worker', resume=True)
+        assert resumed.action_log.seq == 1
+        resumed.release()
+
+        new = SessionHost(Quidem(quidem_id=1), LayerStub(), 'author')
+        assert new.action_log.seq == 0
+        new.action_log.wait()
+        assert recover_session(1).to_dict() == Quidem(quidem_id=1).to_dict()
+        new.release()
+
+    async def test_not_logged(self, settings):
+        settings.QUIDEM_ACTION_LOG_DIR = None
+        assert SessionHost(Quidem(quidem_id=1), LayerStub(), 'author').action_log is None
+        assert recover_session(1) is None
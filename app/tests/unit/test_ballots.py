@@ -0,0 +1,70 @@
+import pytest
+
+from ...ballots import BallotStore
+from ... import tally, scoring
+from .test_tally import random_session, assert_same_results, requires_numpy
+
+class TestBallotStore:
+
+    @pytest.fixture
+    def ballots(self):
+        return BallotStore({1: [0, -2, 1], 2: [-3], 4: []})
+
+    def test_get(self, ballots):
+        assert ballots[1] == [0, -2, 1]
+        assert ballots.get(2) == [-3]
+        assert ballots.get(4) == []
+        assert ballots.get(3) is None
+        assert len(ballots) == 3
+        assert 2 in ballots and 3 not in ballots
+        assert ballots.as_dict() == {1: [0, -2, 1], 2: [-3], 4: []}
+        assert dict(ballots) == ballots.as_dict()
+
+    def test_replace_same_length(self, ballots):
+        size = ballots.buffer_size
+        ballots[1] = [1, 0, -2]
+        assert ballots[1] == [1, 0, -2]
+        assert ballots.buffer_size == size
+
+    def test_replace_other_length(self, ballots):
+        ballots[1] = [5]
+        ballots[2] = [6, 7]
+        assert ballots.as_dict() == {1: [5], 2: [6, 7], 4: []}
+        assert list(ballots) == [1, 2, 4]
+
+    def test_delete(self, ballots):
+        del ballots[2]
+        assert ballots.as_dict() == {1: [0, -2, 1], 4: []}
+        with pytest.raises(KeyError):
+            del ballots[2]
+
+    def test_compaction(self):
+        ballots = BallotStore()
+        for i in range(100):
+            ballots[1] = list(range(i % 5))
+            ballots[2] = [i]
+        assert ballots.as_dict() == {1: [0, 1, 2, 3], 2: [99]}
+        assert ballots.buffer_size <= 2 * ballots._buffer.itemsize * (5 + 2)
+
+    def test_pack(self, ballots):
+        ballots[1] = [3, 4]
+        buffer, offsets = ballots.pack()
+        assert buffer.tolist() == [2, 3, 4, 1, -3, 0]
+        assert offsets == [0, 3, 5]
+
+    def test_overflow(self, ballots):
+        with pytest.raises(OverflowError):
+            ballots[1] = [2 ** 40]
+        assert ballots[1] == [0, -2, 1]
+
+    @requires_numpy
+    def test_numpy_tally_packed(self):
+        nominations, vote_sets, out_of = random_session(0, 500)
+        weights = scoring.weight_vector(0, out_of, 3)
+        ballots = BallotStore()
+        for i, vote_set in enumerate(vote_sets):
+            ballots[i] = [int(nomination_id) for nomination_id in vote_set]
+        for i in range(0, len(vote_sets), 3):
+            ballots[i] = vote_sets[i] = [int(nomination_id) for nomination_id in vote_sets[i][1:]]
+        expected = tally.python_tally(nominations, vote_sets, weights)
+        assert_same_results(tally.numpy_tally(nominations, ballots.values(), weights), expected)
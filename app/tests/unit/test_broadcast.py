@@ -0,0 +1,119 @@
+import pytest
+
+import asyncio
+
+from ...broadcast import BroadcastScheduler
+from ...quidem import Quidem
+from ...session_host import SessionHost
+
+class TestBroadcastScheduler:
+
+    @pytest.fixture
+    def clock(self):
+        class Clock():
+            now = 0.0
+            def __call__(self):
+                return self.now
+        return Clock()
+
+    @pytest.fixture
+    def get_scheduler(self, clock):
+        def get_scheduler(window=0.05, max_delay=0.2):
+            broadcasts = []
+            timers = []
+            scheduler = BroadcastScheduler(
+                lambda: broadcasts.append(clock.now),
+                timers.append,
+                window=window,
+                max_delay=max_delay,
+                clock=clock
+            )
+            return scheduler, broadcasts, timers
+        return get_scheduler
+
+    def test_no_window(self, get_scheduler):
+        scheduler, broadcasts, timers = get_scheduler(window=0)
+        scheduler.request()
+        scheduler.request()
+        assert len(broadcasts) == 2
+        assert timers == []
+        assert scheduler.saved == 0
+
+    def test_coalesces_burst(self, clock, get_scheduler):
+        scheduler, broadcasts, timers = get_scheduler()
+        for _ in range(10):
+            scheduler.request()
+            clock.now += 0.001
+        assert broadcasts == []
+        assert timers == [0.05] # a single timer for the whole burst
+        assert scheduler.pending
+
+        clock.now = 0.05
+        scheduler.on_timer()
+        assert broadcasts == [] # the window slid with the last request
+        assert timers[-1] == pytest.approx(0.009)
+
+        clock.now = 0.06
+        scheduler.on_timer()
+        assert broadcasts == [0.06]
+        assert scheduler.metrics()['requested'] == 10
+        assert scheduler.metrics()['broadcasts'] == 1
+        assert scheduler.saved == 9
+
+    def test_max_delay(self, clock, get_scheduler):
+        scheduler, broadcasts, timers = get_scheduler(window=0.05, max_delay=0.1)
+        scheduler.request()
+        clock.now = 0.04
+        scheduler.request()
+        clock.now = 0.05
+        scheduler.on_timer()
+        clock.now = 0.08
+        scheduler.request()
+        clock.now = 0.09
+        scheduler.on_timer()
+        assert broadcasts == []
+        assert timers[-1] == pytest.approx(0.01) # bound by the max delay, not the last request
+
+        clock.now = 0.1
+        scheduler.on_timer()
+        assert broadcasts == [0.1]
+
+    def test_stale_timer(self, clock, get_scheduler):
+        scheduler, broadcasts, timers = get_scheduler()
+        scheduler.request()
+        scheduler.flush()
+        assert len(broadcasts) == 1
+        scheduler.on_timer()
+        assert len(broadcasts) == 1
+        assert not scheduler.pending
+
+    def test_flush_nothing_pending(self, get_scheduler):
+        scheduler, broadcasts, timers = get_scheduler()
+        scheduler.flush()
+        assert broadcasts == []
+
+    def test_totals(self, get_scheduler):
+        totals = dict(BroadcastScheduler.totals)
+        scheduler, broadcasts, timers = get_scheduler(window=0)
+        scheduler.request()
+        assert BroadcastScheduler.totals['requested'] == totals['requested'] + 1
+        assert BroadcastScheduler.totals['broadcasts'] == totals['broadcasts'] + 1
+
+class ChannelLayerStub:
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, channel, message):
+        self.sent.append((channel, message))
+
+# the flush posted when the window ends is held by the host until it is sent
+@pytest.mark.asyncio
+async def test_host_flush_timer():
+    host = SessionHost(Quidem(quidem_id=3), ChannelLayerStub(), 'host')
+    host._start_flush()
+    assert len(host._flush_tasks) == 1
+    await asyncio.gather(*host._flush_tasks)
+    assert host.channel_layer.sent == [('host', {'type': 'flush.broadcast', 'quidem_id': 3})]
+    assert host._flush_tasks == set()
+    host.release()
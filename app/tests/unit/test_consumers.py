@@ -1,5 +1,7 @@
 import pytest
 import asyncio
+import itertools
+import json
 
 from asgiref.sync import async_to_sync
 # from django.test import Client
@@ -9,6 +11,11 @@ from channels.testing import WebsocketCommunicator
 from ...quidem import Quidem, Phase, Action, ActionError
 
 from ...consumers import QuidemConsumer, QuidemConsumerError
+from ...session_host import SessionHost
+from ... import consumers, wire
+from ...worker_pool import WorkerPool
+from ...session_ids import SessionIdAllocator, LocalCounter
+from ... import session_ids
 from ...routing import application
 
 TEST_CHANNEL_LAYERS = {
@@ -51,8 +58,10 @@ class TestQuidemConsumer:
     #     client.cookies['nickname'] = 'Bob'
 
     @pytest.fixture(autouse=True)
-    def set_cache(self):
-        cache.set('next_quidem_id', Quidem.INITIAL_SESSION_ID)
+    def set_cache(self, monkeypatch):
+        cache.clear()
+        monkeypatch.setattr(session_ids, '_allocator', SessionIdAllocator(LocalCounter()))
+        session_ids.allocate_session()
 
     @pytest.fixture
     async def get_setup(self, settings):
@@ -203,3 +212,388 @@ class TestQuidemConsumer:
         assert 'error' in res
 
         await author.disconnect()
+
+# records what a consumer sends through the channel layer
+class ChannelLayerStub:
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, channel, message):
+        self.sent.append((channel, message))
+
+    async def group_send(self, group, message):
+        self.sent.append((group, message))
+
+    async def group_discard(self, group, channel):
+        pass
+
+class TestQuidemConsumerState:
+
+    @pytest.fixture
+    def consumer(self):
+        consumer = QuidemConsumer()
+        consumer.consumer_id = 2
+        consumer.nickname = 'Bob'
+        consumer.state_version = None
+        consumer._vote = None
+        consumer._awaiting_snapshot = False
+        consumer.host = None
+        consumer.codec = wire.negotiate([])
+        consumer.sent = []
+        consumer.channel_name = 'consumer'
+        consumer.client_key = 1002
+        consumer.channel_layer = ChannelLayerStub()
+        consumer._message_ids = itertools.count()
+        async def send(text_data):
+            consumer.sent.append(json.loads(text_data))
+        consumer.send = send
+        return consumer
+
+    @pytest.fixture
+    def host(self, settings):
+        settings.QUIDEM_BROADCAST_WINDOW = 0
+        quidem = Quidem(quidem_id=0)
+        quidem.next_phase()
+        for nickname in ['Bob', 'Alice']:
+            quidem.new_consumer(nickname)
+        quidem.nominate(Quidem.AUTHOR, 'nom')
+        quidem.next_phase()
+        quidem.vote(1, [0])
+        return SessionHost(quidem, ChannelLayerStub(), 'consumer')
+
+    @pytest.fixture
+    def joining_host(self, host):
+        quidem = Quidem(quidem_id=0)
+        quidem.next_phase()
+        host.quidem = quidem
+        return host
+
+    @pytest.mark.asyncio
+    async def test_send_state(self, host, consumer):
+        message = host._state_message(False)
+        assert 'votes' not in message
+        consumer.consumer_id = 1
+        await consumer.vote_updated({'type': 'vote.updated', 'vote': [0]})
+        await consumer.send_updated_state(message)
+        assert consumer.sent[0] == {'type': 'vote', 'vote': [0]}
+        frame = consumer.sent[-1]
+        assert frame['type'] == 'state'
+        assert frame['version'] == host.quidem.version
+        assert frame['state']['vote'] == [0]
+        assert frame['state']['user'] == 1
+        assert frame['state']['nickname'] == 'Bob'
+        assert 'votes' not in frame['state']
+        assert frame['state']['users'] == {'1': 'Bob', '2': 'Alice'}
+
+    # the binary frames hold the same state as the JSON ones
+    @pytest.mark.asyncio
+    @pytest.mark.skipif(wire.MSGPACK is None, reason='msgpack is not installed')
+    async def test_send_state_msgpack(self, settings, host, consumer):
+        settings.QUIDEM_DELTA_BROADCASTS = True
+        frames = []
+        async def send(text_data=None, bytes_data=None):
+            frames.append(bytes_data)
+        consumer.send = send
+        consumer.codec = wire.negotiate(['quidem.msgpack'])
+        consumer.consumer_id = 1
+
+        await consumer.vote_updated({'type': 'vote.updated', 'vote': [0]})
+        await consumer.send_updated_state(host._state_message(False))
+        host.quidem.force_remove_consumer(2)
+        message = host._state_message(False)
+        await consumer.send_updated_state(message)
+
+        vote, state, delta = [wire.MSGPACK.decode(frame) for frame in frames]
+        assert vote == {'type': 'vote', 'vote': [0]}
+        assert state['type'] == 'state'
+        assert state['state']['users'] == {'1': 'Bob', '2': 'Alice'}
+        assert state['state']['vote'] == [0]
+        assert delta == {'type': 'state_delta', 'version': message['version'], 'base_version': state['version'], 'delta': json.loads(message['delta'])}
+
+    @pytest.mark.asyncio
+    async def test_send_author_state(self, host, consumer):
+        consumer.consumer_id = Quidem.AUTHOR
+        await consumer.send_updated_state(host._state_message(True))
+        frame = consumer.sent[-1]
+        assert frame['state']['votes'] == {'1': [0]}
+        assert frame['state']['vote'] is None
+        assert frame['state']['user'] == Quidem.AUTHOR
+
+    # ballots do not change the view of the users, so in delta mode they are not broadcast to them at all
+    @pytest.mark.asyncio
+    async def test_send_delta(self, settings, host, consumer):
+        settings.QUIDEM_DELTA_BROADCASTS = True
+        first = host._state_message(False)
+        host.quidem.vote(2, [0])
+        assert host._state_message(False) is None
+        assert host._state_message(True) is not None
+        host.quidem.force_remove_consumer(2)
+        second = host._state_message(False)
+
+        consumer.consumer_id = 1
+        for message in [first, second]:
+            await consumer.send_updated_state(message)
+
+        assert [frame['type'] for frame in consumer.sent] == ['state', 'state_delta']
+        assert consumer.sent[1] == {'type': 'state_delta', 'version': second['version'], 'base_version': first['version'], 'delta': {'set': {'users': {'1': 'Bob'}}}}
+
+    @pytest.mark.asyncio
+    async def test_missed_delta(self, settings, host, consumer):
+        settings.QUIDEM_DELTA_BROADCASTS = True
+        requested = []
+        async def request_state_snapshot():
+            requested.append(True)
+        consumer._request_state_snapshot = request_state_snapshot
+        consumer.consumer_id = 1
+
+        await consumer.send_updated_state(host._state_message(False))
+        host.quidem.force_remove_consumer(2)
+        host._state_message(False)
+        host.quidem.force_remove_consumer(1)
+        await consumer.send_updated_state(host._state_message(False))
+
+        assert len(consumer.sent) == 1
+        assert requested
+
+    # the voter alone hears about its ballot, before the broadcast of the state that holds it
+    @pytest.mark.asyncio
+    async def test_vote_echo(self, host):
+        await host.process_action({'content': {'action': Action.VOTE.value, 'body': {'vote_set': [0]}}, 'sender': 2, 'channel_name': 'voter'})
+        sent = host.channel_layer.sent
+        assert sent[0] == ('voter', {'type': 'vote.updated', 'vote': [0]})
+        assert [group for group, _ in sent[1:]] == ['quidem_0', 'author_quidem_0']
+        assert all('votes' not in message and b'"votes"' not in message['state'] for _, message in sent[1:2])
+
+        # rejected ballots are not acknowledged
+        sent.clear()
+        await host.process_action({'content': {'action': Action.VOTE.value, 'body': {'vote_set': ['x']}}, 'sender': 2, 'channel_name': 'voter'})
+        assert sent == []
+
+        consumer = QuidemConsumer()
+        consumer._vote = None
+        consumer.codec = wire.negotiate([])
+        consumer.sent = []
+        async def send(text_data):
+            consumer.sent.append(json.loads(text_data))
+        consumer.send = send
+        await consumer.vote_updated({'type': 'vote.updated', 'vote': [0]})
+        await consumer.vote_updated({'type': 'vote.updated', 'vote': [0]})
+        assert consumer.sent == [{'type': 'vote', 'vote': [0]}]
+
+    @pytest.mark.asyncio
+    async def test_join(self, joining_host):
+        host = joining_host
+        await host.response_to_join_request({'channel_name': 'joiner', 'nickname': 'Carol'})
+        assert host.channel_layer.sent == [('consumer', {'type': 'admit.joins', 'quidem_id': 0})]
+        host.channel_layer.sent.clear()
+        await host.admit_joins({})
+
+        channel, reply = host.channel_layer.sent[0]
+        assert channel == 'joiner'
+        assert reply['type'] == 'join.accepted'
+        assert host.quidem.get_state(True)['users'][reply['consumer_id']] == 'Carol'
+        # the rest of the session hears about the new user too
+        assert [message['type'] for _, message in host.channel_layer.sent[1:]] == ['send_updated_state', 'send_updated_state']
+
+        joiner = QuidemConsumer()
+        joiner.consumer_id = None
+        joiner.nickname = 'Carol'
+        joiner.client_key = 1003
+        joiner.state_version = None
+        joiner._vote = None
+        joiner._awaiting_snapshot = False
+        joiner._join_requested_at = None
+        joiner.codec = wire.negotiate([])
+        joiner.sent = []
+        async def send(text_data):
+            joiner.sent.append(json.loads(text_data))
+        joiner.send = send
+
+        await joiner.join_accepted(reply)
+        assert joiner.sent[0] == {'type': 'join', 'key': 1003, 'consumer_id': reply['consumer_id']}
+        assert joiner.sent[1]['state']['users'][str(reply['consumer_id'])] == 'Carol'
+        assert joiner.sent[1]['version'] == host.quidem.version
+
+        # the broadcast of the same version does not reach the client twice
+        await joiner.send_updated_state(host.channel_layer.sent[1][1])
+        assert len(joiner.sent) == 2
+
+    @pytest.mark.asyncio
+    async def test_join_batch(self, joining_host):
+        host = joining_host
+        version = host.quidem.version
+
+        for nickname in ['Carol', 'Dave', 'Erin']:
+            await host.response_to_join_request({'channel_name': nickname, 'nickname': nickname})
+        await host.admit_joins({})
+        await host.admit_joins({})
+
+        sent = host.channel_layer.sent
+        assert [channel for channel, _ in sent[1:4]] == ['Carol', 'Dave', 'Erin']
+        assert len({message['consumer_id'] for _, message in sent[1:4]}) == 3
+        assert [message['type'] for _, message in sent[4:]] == ['send_updated_state', 'send_updated_state']
+        assert host.quidem.version == version + 1
+
+    # the session hosted by the author consumer is released when the author leaves without closing it
+    @pytest.mark.asyncio
+    async def test_author_disconnect(self, settings, tmp_path, consumer):
+        settings.QUIDEM_ACTION_LOG_DIR = str(tmp_path)
+        settings.QUIDEM_BROADCAST_WINDOW = 0
+        host = SessionHost(Quidem(quidem_id=5), ChannelLayerStub(), 'consumer')
+        await host.process_action({'content': {'action': Action.NEXT_PHASE.value}, 'sender': Quidem.AUTHOR, 'channel_name': 'consumer'})
+        consumer.consumer_id = Quidem.AUTHOR
+        consumer.quidem_id = 5
+        consumer._counted = False
+        consumer.host = host
+        session_log = host.action_log
+
+        await consumer.disconnect(1000)
+        assert consumer.host is None
+        assert host.action_log is None
+        # the final snapshot holds every action
+        session_log.wait()
+        with open(tmp_path / 'quidem_5.log.snapshot') as snapshot_file:
+            assert json.load(snapshot_file)['seq'] == 1
+
+    # the worker hosting the session is told when the author leaves
+    @pytest.mark.asyncio
+    async def test_author_disconnect_pool(self, monkeypatch, consumer):
+        monkeypatch.setattr(consumers, 'get_worker_pool', lambda: WorkerPool(['quidem-worker-0']))
+        consumer.consumer_id = Quidem.AUTHOR
+        consumer.quidem_id = 5
+        consumer._counted = False
+
+        await consumer.disconnect(1000)
+        assert consumer.channel_layer.sent == [('author_quidem_5', {'type': 'author.left', 'quidem_id': 5, 'message_id': 'consumer:0'})]
+
+    # malformed actions are counted as refused, the host goes on with the next ones
+    @pytest.mark.asyncio
+    async def test_malformed_actions(self, host):
+        version = host.quidem.version
+        for content, sender in (
+            ('vote', 1),
+            ({'action': Action.REMOVE_USER.value, 'consumer_id': 'abc'}, 1),
+            ({'action': Action.VOTE.value, 'body': [0]}, 1),
+            # a consumer the session no longer knows
+            ({'action': Action.VOTE.value, 'body': {'vote_set': [0]}}, 7),
+            ({'action': Action.CHANGE_SETTING.value, 'body': {'voting_algorithm': 'abc'}}, Quidem.AUTHOR),
+            ({'action': Action.NEXT_PHASE.value}, Quidem.AUTHOR)
+        ):
+            await host.process_action({'content': content, 'sender': sender})
+        assert host.quidem.version == version + 1
+        assert host.quidem.phase is Phase.POST_VOTING
+
+    # removing a user only closes the connection of that user
+    @pytest.mark.asyncio
+    async def test_remove_user(self, joining_host):
+        host = joining_host
+        for nickname in ['Bob', 'Alice']:
+            host.quidem.nominate(host.quidem.new_consumer(nickname), f'nom {nickname}')
+        consumers = {}
+        for consumer_id in [Quidem.AUTHOR, 1, 2]:
+            consumer = QuidemConsumer()
+            consumer.consumer_id = consumer_id
+            consumer.closed = False
+            async def close(consumer=consumer):
+                consumer.closed = True
+            consumer.close = close
+            consumers[consumer_id] = consumer
+
+        await host.process_action({'content': {'action': Action.REMOVE_USER.value, 'consumer_id': 1}, 'sender': Quidem.AUTHOR, 'channel_name': 'consumer'})
+        [disconnect] = [message for _, message in host.channel_layer.sent if message['type'] == 'filtered.disconnect.consumer']
+        for consumer in consumers.values():
+            await consumer.filtered_disconnect_consumer(disconnect)
+        assert {consumer_id: consumer.closed for consumer_id, consumer in consumers.items()} == {Quidem.AUTHOR: False, 1: True, 2: False}
+
+    @pytest.mark.asyncio
+    async def test_join_rejected(self, host):
+        await host.response_to_join_request({'channel_name': 'joiner', 'nickname': 'Carol'})
+        await host.admit_joins({})
+        assert host.channel_layer.sent[1:] == [('joiner', {'type': 'join.rejected'})]
+
+    # the consumer hosting the session hands it the actions of its client and those of the group
+    @pytest.mark.asyncio
+    async def test_delegates_to_host(self, host, consumer):
+        consumer.host = host
+        await consumer.receive_json({'action': Action.VOTE.value, 'body': {'vote_set': [0]}})
+        assert host.quidem.get_state(True)['votes'] == {1: [0], 2: [0]}
+        await consumer.process_action({'content': {'action': Action.VOTE.value, 'body': {'vote_set': []}}, 'sender': 1})
+        assert host.quidem.get_state(True)['votes'] == {1: [], 2: [0]}
+
+    @pytest.mark.asyncio
+    async def test_batch(self, host, consumer):
+        consumer.consumer_id = 2
+        consumer.host = host
+        await consumer.receive_json([
+            {'action': Action.VOTE.value, 'body': {'vote_set': [0]}},
+            {'action': Action.VOTE.value, 'body': {'vote_set': [0, 0]}}
+        ])
+        sent = host.channel_layer.sent
+        # the ballot and the result go to the sender alone, the session gets a single broadcast
+        assert sent[0] == ('consumer', {'type': 'vote.updated', 'vote': [0, 0]})
+        assert sent[1] == ('consumer', {'type': 'actions.result', 'applied': True, 'results': [{'status': 'ok'}, {'status': 'ok'}]})
+        assert [group for group, _ in sent[2:]] == ['quidem_0', 'author_quidem_0']
+
+        await consumer.actions_result(sent[1][1])
+        assert consumer.sent[-1] == {'type': 'actions', 'applied': True, 'results': [{'status': 'ok'}, {'status': 'ok'}]}
+
+    @pytest.mark.asyncio
+    async def test_batch_rejected(self, host):
+        version = host.quidem.version
+        await host.process_action({'content': [
+            {'action': Action.VOTE.value, 'body': {'vote_set': [0]}},
+            {'action': Action.NOMINATE.value, 'consumer_id': 2, 'body': {'nomination': 'late'}},
+            {'action': Action.VOTE.value, 'body': {'vote_set': []}}
+        ], 'sender': 2, 'channel_name': 'voter'})
+
+        assert host.channel_layer.sent == [('voter', {'type': 'actions.result', 'applied': False, 'results': [
+            {'status': 'ok'},
+            {'status': 'error', 'error': 'Nominating can only be performed during PRE_OPENING or PRE_VOTING phases'},
+            {'status': 'skipped'}
+        ]})]
+        assert host.quidem.get_vote(2) is None
+        assert host.quidem.version == version
+
+    @pytest.mark.asyncio
+    async def test_vote_coalescing(self, settings, host):
+        settings.QUIDEM_COALESCE_VOTES = True
+        for vote_set in ([0], [], [0, 0]):
+            await host.process_action({'content': {'action': Action.VOTE.value, 'body': {'vote_set': vote_set}}, 'sender': 2, 'channel_name': 'alice'})
+        await host.process_action({'content': {'action': Action.VOTE.value, 'body': {'vote_set': []}}, 'sender': 1, 'channel_name': 'bob'})
+        # nothing is applied until the host reads its own message, which is only sent once
+        assert host.channel_layer.sent == [('consumer', {'type': 'apply.votes', 'quidem_id': 0})]
+        assert host.quidem.get_vote(2) is None
+        host.channel_layer.sent.clear()
+
+        await host.apply_votes({'type': 'apply.votes', 'quidem_id': 0})
+        sent = host.channel_layer.sent
+        assert sent[0:2] == [('alice', {'type': 'vote.updated', 'vote': [0, 0]}), ('bob', {'type': 'vote.updated', 'vote': []})]
+        assert [group for group, _ in sent[2:]] == ['quidem_0', 'author_quidem_0']
+        assert host.quidem.get_state(True)['votes'] == {1: [], 2: [0, 0]}
+
+        sent.clear()
+        await host.apply_votes({'type': 'apply.votes', 'quidem_id': 0})
+        assert sent == []
+
+    # the ballot of a consumer removed while it was queued does not cost the ballots queued after it
+    @pytest.mark.asyncio
+    async def test_vote_coalescing_removed(self, settings, host):
+        settings.QUIDEM_COALESCE_VOTES = True
+        await host.process_action({'content': {'action': Action.VOTE.value, 'body': {'vote_set': [0, 0]}}, 'sender': 2, 'channel_name': 'alice'})
+        await host.process_action({'content': {'action': Action.VOTE.value, 'body': {'vote_set': []}}, 'sender': 1, 'channel_name': 'bob'})
+        host.quidem.force_remove_consumer(2)
+        await host.apply_votes({'type': 'apply.votes', 'quidem_id': 0})
+        assert host.quidem.get_vote(1) == []
+        assert host.quidem.get_vote(2) is None
+
+    @pytest.mark.asyncio
+    async def test_vote_coalescing_order(self, settings, host):
+        settings.QUIDEM_COALESCE_VOTES = True
+        await host.process_action({'content': {'action': Action.VOTE.value, 'body': {'vote_set': [0, 0]}}, 'sender': 2, 'channel_name': 'alice'})
+        # the ballot sent before the voting closes still counts
+        await host.process_action({'content': {'action': Action.NEXT_PHASE.value}, 'sender': Quidem.AUTHOR})
+        assert host.quidem.phase is Phase.POST_VOTING
+        assert host.quidem.get_vote(2) == [0, 0]
+        await host.apply_votes({'type': 'apply.votes', 'quidem_id': 0})
+        assert host.quidem.get_vote(2) == [0, 0]
@@ -0,0 +1,68 @@
+import pytest
+
+import random
+
+from ...leaderboard import Leaderboard
+from ...quidem import Quidem, Phase
+
+def random_results(count, seed=0):
+    rng = random.Random(seed)
+    # few distinct vote counts, so there are plenty of ties
+    return [{'nomination': f'nomination {index}', 'nomination_id': index - count // 2, 'votes': rng.randrange(20)} for index in range(count)]
+
+class TestLeaderboard:
+
+    @pytest.mark.parametrize('count', [0, 1, 2, 7, 100, 1000])
+    def test_top(self, count):
+        results = random_results(count)
+        ranking = sorted(results, key=lambda item: -item['votes'])
+        leaderboard = Leaderboard(results)
+        assert len(leaderboard) == count
+        for k in [0, 1, 3, 10, count, count + 1]:
+            assert leaderboard.top(k) == ranking[0:k]
+        assert leaderboard.top() == ranking
+        # read from the sorted ranking once it exists
+        assert leaderboard.top(5) == ranking[0:5]
+
+    def test_rank(self):
+        results = random_results(200)
+        ranking = sorted(results, key=lambda item: -item['votes'])
+        leaderboard = Leaderboard(results)
+        for rank, result in enumerate(ranking, 1):
+            assert leaderboard.rank(result['nomination_id']) == rank
+        assert leaderboard.rank(10000) is None
+
+    def test_ties_keep_order(self):
+        results = [{'nomination': name, 'nomination_id': index, 'votes': 1} for index, name in enumerate('abcd')]
+        assert [result['nomination'] for result in Leaderboard(results).top(3)] == ['a', 'b', 'c']
+
+class TestQuidemResults:
+
+    @pytest.fixture
+    def quidem(self):
+        quidem = Quidem()
+        quidem.next_phase()
+        quidem.new_consumers(['Bob', 'Alice', 'Carol'])
+        for consumer_id, nomination in [(1, 'pizza'), (2, 'sushi'), (3, 'tacos')]:
+            quidem.nominate(consumer_id, nomination)
+        quidem.next_phase()
+        quidem.vote(1, [-2, -1])
+        quidem.vote(2, [-2, -3])
+        quidem.vote(3, [-3])
+        quidem.next_phase()
+        quidem.next_phase()
+        return quidem
+
+    def test_results(self, quidem):
+        assert quidem.phase is Phase.CLOSED
+        assert [result['nomination'] for result in quidem.get_results()] == ['sushi', 'tacos', 'pizza']
+        assert quidem.get_results(1) == quidem.get_results()[0:1]
+        assert quidem.get_rank(-3) == 2
+        assert quidem.get_rank(0) is None
+
+    def test_views(self, quidem, monkeypatch):
+        assert quidem.get_state(False)['calculated_votes'] == quidem.get_results(1)
+        assert quidem.get_state(True)['calculated_votes'] == quidem.get_results()
+        monkeypatch.setattr(Quidem, 'author_results', 2)
+        quidem._changed()
+        assert quidem.get_state(True)['calculated_votes'] == quidem.get_results(2)
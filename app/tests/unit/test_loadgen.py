@@ -0,0 +1,55 @@
+import pytest
+
+from django.core.cache import cache
+
+from ... import wire
+from ...loadgen import LoadStats, percentile, run_load
+from ...routing import application
+
+TEST_CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'CONFIG': {
+            'capacity': 10000
+        }
+    },
+}
+
+def test_percentile():
+    values = [5, 1, 4, 2, 3]
+    assert percentile(values, 0) == 1
+    assert percentile(values, 0.5) == 3
+    assert percentile(values, 0.99) == 5
+
+def test_stats():
+    stats = LoadStats()
+    stats.join_latencies = [0.1, 0.2]
+    stats.add_action_latency('vote', 0.3)
+    stats.frames = 10
+    stats.elapsed = 2
+
+    summary = stats.to_dict()
+    assert summary['frames_per_second'] == 5
+    assert summary['join'] == {'count': 2, 'max': 0.2, 'p50': 0.2, 'p90': 0.2, 'p99': 0.2}
+    assert summary['actions']['vote']['p50'] == 0.3
+    assert 'vote: 1' in stats.format()
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('subprotocol', [
+    None,
+    pytest.param('quidem.msgpack', marks=pytest.mark.skipif(wire.MSGPACK is None, reason='msgpack is not installed'))
+])
+@pytest.mark.parametrize('delta', [False, True])
+async def test_run_load(settings, subprotocol, delta):
+    cache.clear()
+    settings.CHANNEL_LAYERS = TEST_CHANNEL_LAYERS
+    settings.QUIDEM_DELTA_BROADCASTS = delta
+
+    stats = await run_load(application, rooms=2, users=5, subprotocol=subprotocol, timeout=5)
+
+    assert len(stats.join_latencies) == 10
+    assert len(stats.action_latencies['nominate']) == 10
+    assert len(stats.action_latencies['vote']) == 10
+    assert len(stats.action_latencies['close']) == 2
+    assert stats.rejected == 0 and stats.lost == 0
+    assert stats.frames > 0
@@ -0,0 +1,159 @@
+import pytest
+
+from django.http import Http404
+from django.test import RequestFactory
+
+from ...quidem import Quidem, Action
+from ...session_host import SessionHost
+from ...consumers import QuidemConsumer
+from ...metrics import Registry, Counter, Gauge, Histogram, CounterFunction, action_label
+from ... import metrics
+from ...urls import metrics_view
+
+class ChannelLayerStub:
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, channel, message):
+        self.sent.append((channel, message))
+
+    async def group_send(self, group, message):
+        self.sent.append((group, message))
+
+    async def group_discard(self, group, channel):
+        pass
+
+@pytest.fixture
+def registry():
+    return Registry()
+
+@pytest.fixture
+def enabled(settings):
+    settings.QUIDEM_METRICS = True
+    settings.QUIDEM_BROADCAST_WINDOW = 0
+    metrics.REGISTRY.reset()
+    yield
+    metrics.REGISTRY.reset()
+
+def test_action_label():
+    assert action_label(Action.VOTE.value) == 'vote'
+    assert action_label(None) == 'unknown'
+
+def test_counter(registry):
+    counter = Counter('actions_total', 'Actions', ['action'], registry=registry)
+    counter.inc('vote')
+    counter.inc('vote', amount=2)
+    counter.inc('join')
+    assert counter.value('vote') == 3
+    assert registry.render() == (
+        '# HELP actions_total Actions\n'
+        '# TYPE actions_total counter\n'
+        'actions_total{action="join"} 1\n'
+        'actions_total{action="vote"} 3\n'
+    )
+
+def test_register_twice(registry):
+    Counter('actions_total', 'Actions', registry=registry)
+    with pytest.raises(ValueError):
+        Gauge('actions_total', 'Actions', registry=registry)
+
+def test_gauge(registry):
+    gauge = Gauge('sessions', 'Sessions', registry=registry)
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+    assert gauge.value() == 1
+    gauge.set(5)
+    assert registry.render().splitlines()[-1] == 'sessions 5'
+
+def test_histogram(registry):
+    histogram = Histogram('latency', 'Latency', ['view'], buckets=(0.1, 1), registry=registry)
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value, 'user')
+    assert histogram.value('user') == 4
+    assert registry.render().splitlines()[2:] == [
+        'latency_bucket{view="user",le="0.1"} 2',
+        'latency_bucket{view="user",le="1"} 3',
+        'latency_bucket{view="user",le="+Inf"} 4',
+        'latency_sum{view="user"} 2.65',
+        'latency_count{view="user"} 4'
+    ]
+
+def test_counter_function(registry):
+    totals = {'broadcasts': 3}
+    CounterFunction('broadcasts_total', 'Broadcasts', lambda: totals['broadcasts'], registry=registry)
+    totals['broadcasts'] = 4
+    assert registry.render().splitlines()[-1] == 'broadcasts_total 4'
+
+def test_label_escaping(registry):
+    counter = Counter('names', 'Names', ['name'], registry=registry)
+    counter.inc('a "b"\n')
+    assert registry.render().splitlines()[-1] == 'names{name="a \\"b\\"\\n"} 1'
+
+def make_host():
+    quidem = Quidem(quidem_id=0)
+    quidem.next_phase()
+    quidem.new_consumers(['Bob', 'Alice'])
+    quidem.nominate(Quidem.AUTHOR, 'nom')
+    quidem.next_phase()
+    return SessionHost(quidem, ChannelLayerStub(), 'consumer')
+
+@pytest.mark.asyncio
+async def test_host(enabled):
+    host = make_host()
+    assert metrics.SESSIONS.value() == 1
+
+    await host.process_action({'content': {'action': Action.VOTE.value, 'body': {'vote_set': [0]}}, 'sender': 1, 'channel_name': 'voter'})
+    await host.process_action({'content': {'action': Action.VOTE.value, 'body': {'vote_set': ['x']}}, 'sender': 2, 'channel_name': 'voter'})
+    assert metrics.ACTION_SECONDS.value('vote') == 2
+    assert metrics.ACTION_ERRORS.value('vote') == 1
+    # a frame that is not an action at all
+    await host.process_action({'content': 'vote', 'sender': 1, 'channel_name': 'voter'})
+    assert metrics.ACTION_ERRORS.value('unknown') == 1
+    # the accepted vote was broadcast to both views
+    assert metrics.BROADCAST_FANOUT.value('user') == 1
+    assert metrics.BROADCAST_FANOUT.value('author') == 1
+    assert metrics.BROADCAST_BYTES.value('state') > 0
+
+    host.release()
+    host.release()
+    assert metrics.SESSIONS.value() == 0
+
+# the author leaving without closing the session releases it as well
+@pytest.mark.asyncio
+async def test_author_disconnect(enabled):
+    consumer = QuidemConsumer()
+    consumer.quidem_id = 0
+    consumer.consumer_id = Quidem.AUTHOR
+    consumer.channel_name = 'consumer'
+    consumer.channel_layer = ChannelLayerStub()
+    consumer._counted = True
+    metrics.CONSUMERS.inc()
+    consumer.host = make_host()
+    assert metrics.SESSIONS.value() == 1
+
+    await consumer.disconnect(1000)
+    assert metrics.SESSIONS.value() == 0
+    assert metrics.CONSUMERS.value() == 0
+
+@pytest.mark.asyncio
+async def test_disabled(settings):
+    settings.QUIDEM_METRICS = False
+    metrics.REGISTRY.reset()
+    host = make_host()
+    await host.process_action({'content': {'action': Action.VOTE.value, 'body': {'vote_set': [0]}}, 'sender': 1, 'channel_name': 'voter'})
+    host.release()
+    assert 'quidem_action_seconds_count' not in metrics.REGISTRY.render()
+    assert metrics.SESSIONS.value() == 0
+
+def test_view(enabled):
+    metrics.SESSIONS.set(2)
+    response = metrics_view(RequestFactory().get('/metrics/'))
+    assert response['Content-Type'].startswith('text/plain; version=0.0.4')
+    assert 'quidem_sessions 2' in response.content.decode().splitlines()
+
+def test_view_disabled(settings):
+    settings.QUIDEM_METRICS = False
+    with pytest.raises(Http404):
+        metrics_view(RequestFactory().get('/metrics/'))
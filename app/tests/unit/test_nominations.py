@@ -0,0 +1,44 @@
+import pytest
+
+from ...nominations import NominationIndex
+
+class TestNominationIndex:
+
+    @pytest.fixture
+    def nominations(self):
+        nominations = NominationIndex()
+        nominations.add_author_nomination('anom1')
+        nominations.add_author_nomination('anom2')
+        nominations.set_user_nomination(3, 'nom1')
+        return nominations
+
+    def test_lookup(self, nominations):
+        assert len(nominations) == 3
+        assert nominations.get(1) == 'anom2'
+        assert nominations.get(-3) == 'nom1'
+        assert nominations.get(2) is None
+        assert -3 in nominations and 3 not in nominations
+
+    def test_user_nomination_replaced(self, nominations):
+        assert nominations.set_user_nomination(3, 'nom2') == -3
+        assert nominations.pairs() == [(0, 'anom1'), (1, 'anom2'), (-3, 'nom2')]
+
+    def test_ids_not_reused(self, nominations):
+        assert nominations.remove(1)
+        assert not nominations.remove(1)
+        assert nominations.add_author_nomination('anom3') == 2
+        assert nominations.pairs() == [(0, 'anom1'), (2, 'anom3'), (-3, 'nom1')]
+
+    def test_view_cached(self, nominations):
+        view = nominations.view()
+        assert nominations.view() is view
+        assert view[2] == {'nomination': 'nom1', 'nomination_id': -3}
+        nominations.remove(-3)
+        assert nominations.view() is not view
+        assert len(nominations.view()) == 2
+
+    def test_to_dict(self, nominations):
+        nominations.remove(0)
+        restored = NominationIndex.from_dict(nominations.to_dict())
+        assert restored.pairs() == nominations.pairs()
+        assert restored.add_author_nomination('anom3') == 2
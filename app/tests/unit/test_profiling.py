@@ -0,0 +1,126 @@
+import pytest
+
+import threading
+
+from ... import profiling
+from ...profiling import SamplingProfiler, profiled, get_profiler
+from ...quidem import Quidem
+from ...consumers import QuidemConsumer
+from ...session_host import SessionHost
+
+# samples are taken by hand from inside the handlers, the sampler thread waits longer than any test
+@pytest.fixture
+def profile_dir(settings, tmp_path):
+    settings.QUIDEM_PROFILE_DIR = str(tmp_path)
+    settings.QUIDEM_PROFILE_INTERVAL = 60
+    settings.QUIDEM_PROFILE_SESSIONS = None
+    yield tmp_path
+    if profiling._profiler is not None:
+        profiling._profiler.stop()
+        profiling._profiler = None
+
+class Consumer():
+
+    def __init__(self, quidem_id):
+        self.quidem_id = quidem_id
+        self.calls = 0
+
+    @profiled
+    async def handler(self, obj):
+        self.calls += 1
+        sampled_work()
+        return obj
+
+class Worker():
+
+    @profiled
+    async def handler(self, message):
+        sampled_work()
+
+def sampled_work():
+    profiler = get_profiler()
+    if profiler is not None:
+        profiler.sample()
+
+@pytest.mark.asyncio
+async def test_disabled(settings):
+    settings.QUIDEM_PROFILE_DIR = None
+    consumer = Consumer(1)
+    assert await consumer.handler({'a': 1}) == {'a': 1}
+    assert consumer.calls == 1
+    assert get_profiler() is None
+
+@pytest.mark.asyncio
+async def test_sample(profile_dir):
+    consumer = Consumer(1)
+    assert await consumer.handler({}) == {}
+    await consumer.handler({})
+
+    profiler = get_profiler()
+    [(stack, count)] = profiler.samples[1].items()
+    assert count == 2
+    frames = stack.split(';')
+    # the stack starts at the handler, the frames of the event loop are left out
+    assert frames[0].startswith('handler (test_profiling.py:')
+    assert frames[1].startswith('sampled_work (test_profiling.py:')
+    assert frames[-1].startswith('sample (profiling.py:')
+
+    profiling.release(1)
+    assert (profile_dir / 'quidem-1.folded').read_text() == f'{stack} 2\n'
+    # the samples of a released session are not kept
+    assert 1 not in profiler.samples
+
+@pytest.mark.asyncio
+async def test_message_session(profile_dir):
+    await Worker().handler({'quidem_id': 7})
+    assert list(get_profiler().samples) == [7]
+
+@pytest.mark.asyncio
+async def test_target_sessions(settings, profile_dir):
+    settings.QUIDEM_PROFILE_SESSIONS = [2]
+    await Consumer(1).handler({})
+    await Consumer(2).handler({})
+    assert list(get_profiler().samples) == [2]
+
+class ChannelLayerStub:
+
+    async def send(self, channel, message):
+        pass
+
+    async def group_send(self, group, message):
+        pass
+
+    async def group_discard(self, group, channel):
+        pass
+
+# the profile is written once the author hosting the session leaves, even without closing it
+@pytest.mark.asyncio
+async def test_author_disconnect(profile_dir):
+    consumer = QuidemConsumer()
+    consumer.quidem_id = 4
+    consumer.consumer_id = Quidem.AUTHOR
+    consumer.channel_name = 'consumer'
+    consumer.channel_layer = ChannelLayerStub()
+    consumer._counted = False
+    consumer.host = SessionHost(Quidem(quidem_id=4), consumer.channel_layer, 'consumer')
+    get_profiler().samples[4] = {'a;b': 2}
+
+    await consumer.disconnect(1000)
+    assert (profile_dir / 'quidem-4.folded').read_text() == 'a;b 2\n'
+    assert get_profiler().samples == {}
+
+def test_dump_all(tmp_path):
+    profiler = SamplingProfiler(str(tmp_path))
+    profiler.samples = {1: {'a;b': 3, 'a': 1}, 2: {'c': 1}}
+    profiler._changed = {1, 2}
+    profiler.dump_all()
+    assert (tmp_path / 'quidem-1.folded').read_text() == 'a 1\na;b 3\n'
+    assert (tmp_path / 'quidem-2.folded').read_text() == 'c 1\n'
+    assert profiler._changed == set()
+
+def test_sampler_thread(tmp_path):
+    profiler = SamplingProfiler(str(tmp_path), interval=0.001)
+    profiler.watch(threading.get_ident())
+    assert profiler._sampler.is_alive()
+    profiler.stop()
+    assert not profiler._sampler.is_alive()
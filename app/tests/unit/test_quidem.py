@@ -1,6 +1,7 @@
 import pytest
 
-from ...quidem import Quidem, Phase, Action, QuidemError, ActionPhaseException, ActionError, ConsumerIdMismatchException
+from ...quidem import Quidem, Phase, Action, QuidemError, ActionPhaseException, ActionError, ConsumerIdMismatchException, BatchActionError
+from ...nominations import NominationIndex
 
 class CallObject:
 
@@ -11,6 +12,14 @@ class CallObject:
         self.called = False
         self.parameters = []
 
+def build_nominations(author_nominations, user_nominations):
+    nominations = NominationIndex()
+    for nomination in author_nominations:
+        nominations.add_author_nomination(nomination)
+    for nomination_id, nomination in user_nominations.items():
+        nominations.set_user_nomination(-nomination_id, nomination)
+    return nominations
+
 class TestQuidem:
 
     @pytest.fixture
@@ -81,6 +90,48 @@ class TestQuidem:
         assert state_author['users'] == quidem._consumers
         assert state_author['phase'] == quidem.phase.value
 
+    # finished
+    def test_get_state_cached(self, quidem):
+        state_user = quidem.get_state()
+        state_author = quidem.get_state(True)
+
+        assert quidem.get_state() is state_user
+        assert quidem.get_state(True) is state_author
+
+        version = quidem.version
+        quidem.nominate(Quidem.AUTHOR, 'nomination')
+        assert quidem.version > version
+
+        assert quidem.get_state() is not state_user
+        assert quidem.get_state(True)['nominations'] == [{'nomination': 'nomination', 'nomination_id': 0}]
+        assert state_author['nominations'] == []
+
+    # finished
+    def test_version(self, quidem):
+        versions = [quidem.version]
+        def changed():
+            versions.append(quidem.version)
+            return versions[-1] > versions[-2]
+
+        quidem.settings = dict(quidem.settings, question='why?')
+        assert changed()
+        quidem.next_phase()
+        assert changed()
+        consumer_id = quidem.new_consumer('nickname')
+        assert changed()
+        assert not quidem.nominate(consumer_id, ' ')
+        assert not changed()
+        quidem.nominate(consumer_id, 'nomination')
+        assert changed()
+        assert not quidem.remove_nomination(5)
+        assert not changed()
+        quidem.next_phase()
+        assert changed()
+        quidem.vote(consumer_id, [-consumer_id])
+        assert changed()
+        quidem.force_close()
+        assert changed()
+
     # finished
     def test_get_nominations(self, quidem):
 
@@ -95,46 +146,41 @@ class TestQuidem:
         user_3 = 5
         user_nom_3 = 'nom_6'
 
-        quidem._author_nominations = [
+        quidem._nominations = build_nominations([
             author_nom_1,
             author_nom_2,
             author_nom_3
-        ]
-
-        quidem._user_nominations = {
+        ], {
             -user_1: user_nom_1,
             -user_2: user_nom_2,
             -user_3: user_nom_3
-        }
+        })
 
         nominations = quidem._get_nominations()
 
-        to_check = [*range(len(quidem._author_nominations)), -user_2, -user_1, -user_3]
+        assert nominations == [
+            {'nomination': author_nom_1, 'nomination_id': 0},
+            {'nomination': author_nom_2, 'nomination_id': 1},
+            {'nomination': author_nom_3, 'nomination_id': 2},
+            {'nomination': user_nom_1, 'nomination_id': -user_1},
+            {'nomination': user_nom_2, 'nomination_id': -user_2},
+            {'nomination': user_nom_3, 'nomination_id': -user_3}
+        ]
+        assert quidem._get_nominations() is nominations
 
-        initial_length_author_nominations = len(quidem._author_nominations)
-        initial_length_user_nominations = len(quidem._user_nominations.values())
-        checked_author_nominations = 0
-        checked_user_nominations = 0
+    # finished
+    def test_remove_nomination_keeps_ids(self, quidem):
+        quidem._nominations = build_nominations(['anom1', 'anom2', 'anom3'], {-2: 'nom1'})
 
-        i = 0
-        for nomination in nominations:
-            nomination_id = nomination['nomination_id']
-            if nomination_id in to_check:
-                if nomination_id < 0:
-                    del quidem._user_nominations[nomination_id]
-                    checked_user_nominations += 1
-                else:
-                    del quidem._author_nominations[quidem._author_nominations.index(nomination['nomination'])]
-                    checked_author_nominations += 1
-                del to_check[to_check.index(nomination_id)]
-            else:
-                print(nomination)
-            i += 1
-        assert len(quidem._author_nominations) == 0
-        assert len(quidem._user_nominations.values()) == 0
-        assert checked_author_nominations == initial_length_author_nominations
-        assert checked_user_nominations == initial_length_user_nominations
-        assert len(to_check) == 0
+        nominations = quidem._get_nominations()
+
+        assert quidem.remove_nomination(0)
+        assert quidem._get_nominations() is not nominations
+        assert [nomination['nomination_id'] for nomination in quidem._get_nominations()] == [1, 2, -2]
+        assert not quidem.remove_nomination(0)
+
+        quidem.nominate(Quidem.AUTHOR, 'anom4')
+        assert [nomination['nomination_id'] for nomination in quidem._get_nominations()] == [1, 2, 3, -2]
 
     # finished
     def test_process_action_exceptions(self, did_call):
@@ -255,6 +301,23 @@ class TestQuidem:
             with pytest.raises(ActionPhaseException):
                 quidem.new_consumer('nickname')
 
+    def test_new_consumers(self, quidem):
+        quidem._phase = Phase.PRE_VOTING
+        first = quidem.new_consumer('first')
+        version = quidem.version
+
+        consumer_ids = quidem.new_consumers(['a', 'b', 'c'])
+        assert consumer_ids == [first + 1, first + 2, first + 3]
+        assert [quidem._consumers[consumer_id] for consumer_id in consumer_ids] == ['a', 'b', 'c']
+        assert quidem.version == version + 1
+
+        assert quidem.new_consumers([]) == []
+        assert quidem.version == version + 1
+
+        quidem._phase = Phase.VOTING
+        with pytest.raises(ActionPhaseException):
+            quidem.new_consumers(['d'])
+
     # finished
     def test_new_consumer(self, quidem):
         quidem._phase = Phase.PRE_VOTING
@@ -395,17 +458,16 @@ class TestQuidem:
         }
 
         for action in actions:
-            quidem._author_nominations = list(initial_state['author_nominations'])
-            quidem._user_nominations = dict(initial_state['user_nominations'])
+            quidem._nominations = build_nominations(initial_state['author_nominations'], initial_state['user_nominations'])
             nomination = action['nomination']
             assert action['return'] == quidem.process_action(Action.NOMINATE, action['consumer_id'], action['target_consumer_id'], {'nomination': action['nomination']})
             if action['consumer_id'] == Quidem.AUTHOR:
-                assert action['expected_length'] == len(quidem._author_nominations)
-                assert action['return'] == (action['nomination'] in quidem._author_nominations)
+                assert action['expected_length'] == len(quidem._nominations.author_nominations)
+                assert action['return'] == (action['nomination'] in quidem._nominations.author_nominations)
             else:
-                assert action['expected_length'] == len(quidem._user_nominations.values())
+                assert action['expected_length'] == len(quidem._nominations.user_nominations)
                 if -action['consumer_id'] not in initial_state['user_nominations']:
-                    assert action['return'] == ((-action['consumer_id']) in quidem._user_nominations)
+                    assert action['return'] == ((-action['consumer_id']) in quidem._nominations.user_nominations)
 
     def test_remove_nomination_exceptions(self, quidem):
         quidem._consumers = {1: None}
@@ -462,15 +524,14 @@ class TestQuidem:
         ]
 
         for action in actions:
-            quidem._author_nominations = list(initial_quidem_state['author_nominations'])
-            quidem._user_nominations = dict(initial_quidem_state['user_nominations'])
+            quidem._nominations = build_nominations(initial_quidem_state['author_nominations'], initial_quidem_state['user_nominations'])
             quidem._consumers = dict(initial_quidem_state['consumers'])
 
             nomination_id = action['nomination_id']
-            original_nom = quidem._author_nominations[nomination_id] if nomination_id in quidem._author_nominations else None
+            original_nom = quidem._nominations.get(nomination_id) if nomination_id >= 0 else None
             assert action['return'] == quidem.process_action(Action.REMOVE_NOMINATION, Quidem.AUTHOR, Quidem.AUTHOR, {'nomination_id': action['nomination_id']})
             if original_nom:
-                assert original_nom not in quidem._author_nominations
+                assert original_nom not in quidem._nominations.author_nominations
     # finished
     def test_remove_nomination_user(self, quidem):
 
@@ -515,15 +576,14 @@ class TestQuidem:
         ]
 
         for action in actions:
-            quidem._author_nominations = list(initial_quidem_state['author_nominations'])
-            quidem._user_nominations = dict(initial_quidem_state['user_nominations'])
+            quidem._nominations = build_nominations(initial_quidem_state['author_nominations'], initial_quidem_state['user_nominations'])
             quidem._consumers = dict(initial_quidem_state['consumers'])
 
             nomination_id = -action['consumer_id']
-            original_nom = quidem._user_nominations[nomination_id] if nomination_id in quidem._user_nominations else None
+            original_nom = quidem._nominations.user_nominations.get(nomination_id)
             assert action['return'] == quidem.process_action(Action.REMOVE_NOMINATION, action['consumer_id'], action['consumer_id'], None)
             if original_nom:
-                assert -action['consumer_id'] not in quidem._user_nominations
+                assert -action['consumer_id'] not in quidem._nominations.user_nominations
 
     # finished
     def test_next_phase(self, quidem):
@@ -538,3 +598,90 @@ class TestQuidem:
         assert quidem.phase is Phase.CLOSED
         with pytest.raises(QuidemError):
             quidem.next_phase()
+
+    def test_change_settings(self, quidem):
+        quidem.change_settings({'question': 'lunch?', 'max_voting_slots': '2', 'voting_algorithm': '1'})
+        assert quidem.settings == {'voting_algorithm': 1, 'max_voting_slots': 2, 'question': 'lunch?'}
+        quidem.next_phase()
+        quidem.change_settings({'question': 'dinner?', 'max_voting_slots': 4})
+        assert quidem.settings == {'voting_algorithm': 1, 'max_voting_slots': 4, 'question': 'lunch?'}
+        quidem.next_phase()
+        quidem.change_settings({'max_voting_slots': 1, 'voting_algorithm': 0})
+        assert quidem.settings == {'voting_algorithm': 0, 'max_voting_slots': 4, 'question': 'lunch?'}
+
+    def test_process_actions(self, quidem):
+        quidem.next_phase()
+        consumer_id = quidem.new_consumer('Bob')
+        changed = quidem.process_actions(Quidem.AUTHOR, [
+            {'action': Action.NOMINATE.value, 'consumer_id': Quidem.AUTHOR, 'body': {'nomination': 'pizza'}},
+            {'action': Action.NOMINATE.value, 'consumer_id': Quidem.AUTHOR, 'body': {'nomination': ' '}},
+            {'action': Action.NOMINATE.value, 'consumer_id': str(Quidem.AUTHOR), 'body': {'nomination': 'tacos'}}
+        ])
+        assert changed == [True, False, True]
+        assert [item['nomination'] for item in quidem.get_state(True)['nominations']] == ['pizza', 'tacos']
+
+        quidem.next_phase()
+        quidem.process_actions(consumer_id, [
+            {'action': Action.VOTE.value, 'body': {'vote_set': [0]}},
+            {'action': Action.VOTE.value, 'body': {'vote_set': [1, 0]}}
+        ])
+        assert quidem.get_vote(consumer_id) == [1, 0]
+
+    def test_process_actions_rollback(self, quidem):
+        quidem.next_phase()
+        consumer_id = quidem.new_consumer('Bob')
+        quidem.nominate(Quidem.AUTHOR, 'pizza')
+        quidem.next_phase()
+        quidem.vote(consumer_id, [0])
+        before = quidem.to_dict()
+
+        with pytest.raises(BatchActionError) as err:
+            quidem.process_actions(consumer_id, [
+                {'action': Action.VOTE.value, 'body': {'vote_set': [0, 0]}},
+                {'action': Action.NOMINATE.value, 'consumer_id': consumer_id, 'body': {'nomination': 'tacos'}},
+                {'action': Action.VOTE.value, 'body': {'vote_set': []}}
+            ])
+        assert err.value.index == 1
+        assert isinstance(err.value.error, ActionPhaseException)
+        assert err.value.changed == [True]
+        # the vote of the batch is undone, the running tally with it
+        assert quidem.to_dict() == before
+        assert quidem.get_vote(consumer_id) == [0]
+        assert quidem.get_state(True)['votes'] == {consumer_id: [0]}
+        quidem.vote(consumer_id, [0, 0])
+        assert quidem.get_vote(consumer_id) == [0, 0]
+
+    def test_process_actions_malformed(self, quidem):
+        with pytest.raises(BatchActionError) as err:
+            quidem.process_actions(Quidem.AUTHOR, [{'action': Action.NOMINATE.value, 'consumer_id': 'x'}])
+        assert err.value.index == 0
+        with pytest.raises(BatchActionError) as err:
+            quidem.process_actions(Quidem.AUTHOR, [{'action': Action.NOMINATE.value, 'consumer_id': 0, 'body': {'nomination': 'a'}}, 'vote'])
+        assert err.value.index == 1
+        assert quidem.get_state(True)['nominations'] == []
+        with pytest.raises(BatchActionError):
+            quidem.process_actions(7, [{'action': Action.VOTE.value}])
+        with pytest.raises(BatchActionError) as err:
+            quidem.process_actions(Quidem.AUTHOR, [{'action': Action.NOMINATE.value, 'consumer_id': 0, 'body': 'pizza'}])
+        assert isinstance(err.value.error, ActionError)
+
+    # the nominations and the consumers removed by a failed batch are put back as they were
+    def test_process_actions_undo_removal(self, quidem):
+        quidem.next_phase()
+        bob, alice = quidem.new_consumers(['Bob', 'Alice'])
+        quidem.nominate(bob, 'pizza')
+        quidem.nominate(Quidem.AUTHOR, 'tacos')
+        before = quidem.to_dict()
+        state = quidem.get_state(True)
+
+        with pytest.raises(BatchActionError):
+            quidem.process_actions(Quidem.AUTHOR, [
+                {'action': Action.REMOVE_USER.value, 'consumer_id': bob},
+                {'action': Action.REMOVE_NOMINATION.value, 'consumer_id': Quidem.AUTHOR, 'body': {'nomination_id': 0}},
+                {'action': Action.NOMINATE.value, 'consumer_id': Quidem.AUTHOR, 'body': {'nomination': 'sushi'}},
+                {'action': 99, 'consumer_id': Quidem.AUTHOR}
+            ])
+        assert quidem.to_dict() == before
+        assert quidem.get_state(True) == state
+        quidem.nominate(Quidem.AUTHOR, 'sushi')
+        assert [item['nomination'] for item in quidem.get_state(True)['nominations']] == ['tacos', 'sushi', 'pizza']
@@ -0,0 +1,46 @@
+import pytest
+
+import math
+
+from ...quidem import VotingAlgorithm
+from ... import scoring
+
+class TestScoring:
+
+    @pytest.fixture(autouse=True)
+    def restore_rules(self):
+        rules = scoring.get_rules()
+        yield
+        scoring._rules.clear()
+        scoring._rules.update(rules)
+        scoring.weight_vector.cache_clear()
+
+    def test_voting_algorithms_registered(self):
+        for voting_algorithm in VotingAlgorithm:
+            algorithm = VotingAlgorithm.get_algorithm(voting_algorithm.value)
+            weights = scoring.weight_vector(voting_algorithm.value, 3, 3)
+            assert weights == pytest.approx([algorithm(3), algorithm(2), algorithm(1)])
+            assert scoring.get_rule(voting_algorithm.value).name == voting_algorithm.name
+
+    def test_weight_vector_cached(self):
+        weights = scoring.weight_vector(VotingAlgorithm.exponential.value, 4, 3)
+        assert scoring.weight_vector(VotingAlgorithm.exponential.value, 4, 3) is weights
+        assert isinstance(weights, tuple)
+
+    def test_unscorable_positions(self):
+        assert scoring.weight_vector(VotingAlgorithm.logarithmic.value, 2, 3) == (math.log(2), 0, 0)
+
+    def test_extra_rules(self):
+        assert scoring.weight_vector(scoring.BORDA, 3, 4) == (2, 1, 0, 0)
+        assert scoring.weight_vector(scoring.DOWDALL, 3, 3) == pytest.approx((1, 1 / 2, 1 / 3))
+        assert scoring.weight_vector(scoring.TRUNCATED_EXPONENTIAL, 3, 4) == (4, 2, 1, 0)
+
+    def test_register_rule(self):
+        scoring.register_rule(20, 'constant', lambda out_of, rank: 1)
+        assert scoring.weight_vector(20, 2, 2) == (1, 1)
+        scoring.register_rule(20, 'double', lambda out_of, rank: 2)
+        assert scoring.weight_vector(20, 2, 2) == (2, 2)
+
+    def test_unknown_rule(self):
+        with pytest.raises(ValueError):
+            scoring.get_rule(-1)
@@ -0,0 +1,193 @@
+import pytest
+
+import multiprocessing
+import os
+import threading
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+
+from ...quidem import Quidem, Action
+from ...session_host import SessionHost
+from ... import session_ids
+from ...session_ids import SessionIdAllocator, LocalCounter, CacheCounter, LocalMarks, CacheMarks
+
+# redis the cross-process tests share their ids through, they are skipped without one
+REDIS_URL = os.environ.get('QUIDEM_TEST_REDIS_URL')
+
+def redis_caches(redis_url):
+    return {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+        },
+        'quidem': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': redis_url,
+            'TIMEOUT': None
+        }
+    }
+
+# runs in a process of its own, like a worker of the deployment
+def allocate_in_process(redis_url, count, claimed_id):
+    from django.conf import settings
+    settings.CACHES = redis_caches(redis_url)
+    settings.QUIDEM_SESSION_ID_CACHE = 'quidem'
+    settings.QUIDEM_SESSION_ID_BLOCK = 4
+    return [session_ids.allocate_session() for _ in range(count)], session_ids.claim_session(claimed_id)
+
+class ChannelLayerStub:
+
+    async def send(self, channel, message):
+        pass
+
+    async def group_send(self, group, message):
+        pass
+
+class TestSessionIds:
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self, monkeypatch):
+        cache.clear()
+        monkeypatch.setattr(session_ids, '_allocator', SessionIdAllocator(LocalCounter(), block_size=4))
+        yield
+        cache.clear()
+
+    def test_local_counter(self):
+        counter = LocalCounter()
+        assert counter.lease(3) == Quidem.INITIAL_SESSION_ID
+        assert counter.lease(3) == Quidem.INITIAL_SESSION_ID + 3
+
+    def test_cache_counter(self):
+        counter = CacheCounter(cache, key='test_counter')
+        assert counter.lease(5) == Quidem.INITIAL_SESSION_ID
+        # a second worker shares the counter through the cache
+        assert CacheCounter(cache, key='test_counter').lease(5) == Quidem.INITIAL_SESSION_ID + 5
+
+    def test_leases_blocks(self):
+        leases = []
+        class Counter(LocalCounter):
+            def lease(self, count):
+                leases.append(count)
+                return super().lease(count)
+
+        allocator = SessionIdAllocator(Counter(), block_size=3)
+        assert [allocator.allocate() for _ in range(7)] == [1, 2, 3, 4, 5, 6, 7]
+        assert leases == [3, 3, 3]
+
+    def test_allocate_session(self):
+        session_id = session_ids.allocate_session()
+        assert session_ids.is_allocated(session_id)
+        assert not session_ids.is_allocated(session_id + 1)
+
+    def test_claim_session(self):
+        session_id = session_ids.allocate_session()
+        assert session_ids.claim_session(session_id)
+        assert not session_ids.claim_session(session_id)
+
+    def test_release_session(self):
+        session_id = session_ids.allocate_session()
+        session_ids.claim_session(session_id)
+        session_ids.release_session(session_id)
+        assert not session_ids.is_allocated(session_id)
+        assert session_ids.allocate_session() != session_id
+
+    def test_cache_marks(self):
+        marks = CacheMarks(cache)
+        marks.allocate(5, 60)
+        assert marks.is_allocated(5)
+        assert marks.claim(5)
+        assert not marks.claim(5)
+        marks.release(5)
+        assert not marks.is_allocated(5)
+        assert cache.get('quidem_5_author') is None
+
+    def test_unclaimed_marks_expire(self):
+        now = [0]
+        marks = LocalMarks(lambda: now[0])
+        marks.allocate(5, 60)
+        marks.allocate(6, 60)
+        assert marks.claim(6)
+        now[0] = 61
+        assert not marks.is_allocated(5)
+        assert marks.is_allocated(6)
+        marks.allocate(7, 60)
+        assert 5 not in marks._allocated
+        assert marks.is_allocated(6)
+
+    def test_claimed_cache_marks_stay(self):
+        marks = CacheMarks(cache)
+        marks.allocate(8, 60)
+        marks.claim(8)
+        assert cache.get('quidem_8_allocated') is not None
+        assert cache._expire_info[cache.make_and_validate_key('quidem_8_allocated')] is None
+        marks.release(8)
+
+    # the default cache lives in each process and would hand the same ids to every worker
+    def test_per_process_cache(self, settings):
+        settings.QUIDEM_SESSION_ID_CACHE = 'default'
+        with pytest.raises(ImproperlyConfigured):
+            session_ids.allocate_session()
+
+    @pytest.mark.asyncio
+    async def test_closed_session_released(self, settings):
+        settings.QUIDEM_BROADCAST_WINDOW = 0
+        session_id = session_ids.allocate_session()
+        session_ids.claim_session(session_id)
+        host = SessionHost(Quidem(quidem_id=session_id), ChannelLayerStub(), 'author')
+        await host.process_action({'content': {'action': Action.CLOSE_SESSION.value}, 'sender': Quidem.AUTHOR, 'channel_name': 'author'})
+        assert host.closed
+        assert not session_ids.is_allocated(session_id)
+
+    # workers sharing a counter, each with several threads allocating at once
+    @pytest.mark.parametrize('get_counter', [LocalCounter, lambda: CacheCounter(cache, key='stress_counter')])
+    def test_no_collisions(self, get_counter):
+        counter = get_counter()
+        workers = [SessionIdAllocator(counter, block_size=8) for _ in range(4)]
+        allocated = []
+        barrier = threading.Barrier(16)
+
+        def allocate(allocator):
+            barrier.wait()
+            ids = [allocator.allocate() for _ in range(500)]
+            allocated.extend(ids)
+
+        threads = [threading.Thread(target=allocate, args=(workers[index % 4],)) for index in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(allocated) == 16 * 500
+        assert len(set(allocated)) == len(allocated)
+
+    def test_concurrent_claims(self):
+        session_id = session_ids.allocate_session()
+        claims = []
+        barrier = threading.Barrier(8)
+
+        def claim():
+            barrier.wait()
+            claims.append(session_ids.claim_session(session_id))
+
+        threads = [threading.Thread(target=claim) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert claims.count(True) == 1
+
+# worker processes sharing the counter and the claims through redis
+@pytest.mark.skipif(REDIS_URL is None, reason='QUIDEM_TEST_REDIS_URL is not set')
+def test_no_collisions_across_processes(settings):
+    settings.CACHES = redis_caches(REDIS_URL)
+    settings.QUIDEM_SESSION_ID_CACHE = 'quidem'
+    claimed_id = session_ids.allocate_session()
+
+    with multiprocessing.get_context('spawn').Pool(4) as pool:
+        results = pool.starmap(allocate_in_process, [(REDIS_URL, 200, claimed_id)] * 4)
+
+    allocated = [claimed_id] + [session_id for ids, _ in results for session_id in ids]
+    assert len(set(allocated)) == len(allocated)
+    assert [claimed for _, claimed in results].count(True) == 1
+    session_ids.release_session(claimed_id)
@@ -0,0 +1,92 @@
+import pytest
+
+import json
+import threading
+
+from ...quidem import Quidem, Phase
+from ...session_store import SessionStore, InMemorySessionStore, RedisSessionStore, RevisionConflict
+
+def build_quidem(quidem_id=1):
+    quidem = Quidem(quidem_id=quidem_id)
+    quidem.nominate(Quidem.AUTHOR, 'anom')
+    quidem.next_phase()
+    for nickname in ['Bob', 'Alice', 'Carol']:
+        consumer_id = quidem.new_consumer(nickname)
+        quidem.nominate(consumer_id, f'nom {nickname}')
+    quidem.remove_nomination(-3)
+    quidem.next_phase()
+    quidem.vote(1, [-1, 0])
+    quidem.vote(2, [0])
+    return quidem
+
+class TestSessionStore:
+
+    @pytest.fixture
+    def store(self):
+        return InMemorySessionStore()
+
+    def test_abstract(self):
+        with pytest.raises(TypeError):
+            SessionStore()
+
+    def test_to_dict(self):
+        quidem = build_quidem()
+        restored = Quidem.from_dict(json.loads(json.dumps(quidem.to_dict())))
+        assert restored.version == quidem.version
+        assert restored.get_state(True) == quidem.get_state(True)
+        assert restored.get_leaderboard() == quidem.get_leaderboard()
+
+        # the restored session keeps running where the stored one stopped
+        restored.vote(3, [-2])
+        quidem.vote(3, [-2])
+        assert restored.get_leaderboard() == quidem.get_leaderboard()
+        assert restored.version == quidem.version
+
+    def test_save_load(self, store):
+        assert store.load(1) == (0, None)
+        assert store.save(build_quidem(), 0) == 1
+        revision, quidem = store.load(1)
+        assert revision == 1
+        assert quidem.phase is Phase.VOTING
+
+    def test_conflict(self, store):
+        store.save(build_quidem(), 0)
+        with pytest.raises(RevisionConflict):
+            store.save(build_quidem(), 0)
+        store.delete(1)
+        assert store.load(1) == (0, None)
+
+    def test_concurrent_saves(self, store):
+        store.save(build_quidem(), 0)
+        saved = []
+
+        barrier = threading.Barrier(16)
+        def save():
+            barrier.wait()
+            try:
+                saved.append(store.save(build_quidem(), 1))
+            except RevisionConflict:
+                pass
+
+        threads = [threading.Thread(target=save) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert saved == [2]
+        assert store.revision(1) == 2
+
+    def test_redis_store(self):
+        fakeredis = pytest.importorskip('fakeredis')
+        store = RedisSessionStore(fakeredis.FakeRedis())
+        assert store.load(1) == (0, None)
+        store.save(build_quidem(), 0)
+        with pytest.raises(RevisionConflict):
+            store.save(build_quidem(), 0)
+        quidem = build_quidem()
+        quidem.vote(3, [0])
+        store.save(quidem, 1)
+        revision, quidem = store.load(1)
+        assert revision == 2
+        assert quidem.get_vote(3) == [0]
@@ -0,0 +1,68 @@
+import pytest
+
+from ...quidem import Quidem, Phase
+from ...state_delta import diff_state, apply_delta
+
+class TestStateDelta:
+
+    @pytest.fixture
+    def quidem(self):
+        quidem = Quidem()
+        quidem.next_phase()
+        for nickname in ['a', 'b', 'c', 'd']:
+            quidem.new_consumer(nickname)
+        quidem.nominate(Quidem.AUTHOR, 'anom1')
+        quidem.nominate(Quidem.AUTHOR, 'anom2')
+        quidem.nominate(1, 'nom1')
+        quidem.nominate(2, 'nom2')
+        return quidem
+
+    def assert_round_trip(self, old, new):
+        delta = diff_state(old, new)
+        assert apply_delta(old, delta) == new
+        return delta
+
+    def test_no_change(self, quidem):
+        assert diff_state(quidem.get_state(True), quidem.get_state(True)) is None
+
+    def test_nominations_patched(self, quidem):
+        old = quidem.get_state(True)
+        quidem.nominate(Quidem.AUTHOR, 'anom3')
+        quidem.remove_nomination(-1)
+        delta = self.assert_round_trip(old, quidem.get_state(True))
+        assert delta == {
+            'patch': {
+                'nominations': {
+                    'set': [[2, {'nomination': 'anom3', 'nomination_id': 2}]],
+                    'unset': [-1]
+                }
+            }
+        }
+
+    def test_users_patched(self, quidem):
+        old = quidem.get_state()
+        quidem.remove_consumer(3)
+        delta = self.assert_round_trip(old, quidem.get_state())
+        assert delta == {'patch': {'users': {'unset': [3]}}}
+
+    def test_phase_and_unset(self, quidem):
+        quidem.next_phase()
+        old = quidem.get_state()
+        quidem.next_phase()
+        delta = self.assert_round_trip(old, quidem.get_state())
+        assert delta == {'set': {'phase': Phase.POST_VOTING.value}, 'unset': ['nominations']}
+
+    def test_votes_patched(self, quidem):
+        quidem.next_phase()
+        for consumer_id in [1, 2, 3]:
+            quidem.vote(consumer_id, [0])
+        old = quidem.get_state(True)
+        quidem.vote(2, [1, 0])
+        delta = self.assert_round_trip(old, quidem.get_state(True))
+        assert delta == {'patch': {'votes': {'set': {2: [1, 0]}}}}
+
+    def test_reordered_list_replaced(self):
+        old = {'nominations': [{'nomination_id': i} for i in range(4)]}
+        new = {'nominations': [old['nominations'][i] for i in [1, 0, 2, 3]]}
+        delta = self.assert_round_trip(old, new)
+        assert delta == {'set': new}
@@ -0,0 +1,188 @@
+import pytest
+
+import random
+
+from ...quidem import Quidem, Phase, VotingAlgorithm, ActionError
+from ... import tally, scoring
+
+requires_numpy = pytest.mark.skipif(tally.numpy is None, reason='numpy is not installed')
+
+# the loop Quidem.calculate_votes ran before the tally engines, kept as the reference result
+def reference_tally(nominations, vote_sets, out_of, voting_algorithm):
+    results = {}
+    for nomination_id, nomination in nominations:
+        results[nomination_id] = {
+            'nomination': nomination,
+            'nomination_id': nomination_id,
+            'votes': 0
+        }
+    for vote_set in vote_sets:
+        for i in range(len(vote_set)):
+            nomination_id = int(vote_set[i])
+            if nomination_id not in results:
+                continue
+            results[nomination_id]['votes'] += voting_algorithm(out_of - i)
+    return sorted(results.values(), key=lambda item: -item['votes'])
+
+def random_session(seed, voters, author_nominations=6, user_nominations=6, slots=3):
+    rng = random.Random(seed)
+    nominations = [(-(i + 1), f'user_nom_{i}') for i in range(user_nominations)]
+    nominations += [(i, f'author_nom_{i}') for i in range(author_nominations)]
+    ids = [nomination_id for nomination_id, _ in nominations] + [99, -99] # includes unknown ids
+    vote_sets = []
+    for _ in range(voters):
+        vote_set = rng.sample(ids, rng.randint(0, slots))
+        vote_sets.append([str(nomination_id) if rng.random() < 0.5 else nomination_id for nomination_id in vote_set])
+    return nominations, vote_sets, min(len(nominations), slots)
+
+def assert_same_results(results, expected):
+    assert [item['nomination_id'] for item in results] == [item['nomination_id'] for item in expected]
+    assert [item['nomination'] for item in results] == [item['nomination'] for item in expected]
+    assert [item['votes'] for item in results] == pytest.approx([item['votes'] for item in expected])
+
+class TestTally:
+
+    ALGORITHMS = [algorithm.value for algorithm in VotingAlgorithm]
+
+    @pytest.mark.parametrize('engine', [tally.PYTHON, pytest.param(tally.NUMPY, marks=requires_numpy)])
+    @pytest.mark.parametrize('algorithm', ALGORITHMS)
+    def test_parity(self, engine, algorithm):
+        voting_algorithm = VotingAlgorithm.get_algorithm(algorithm)
+        for seed in range(5):
+            nominations, vote_sets, out_of = random_session(seed, 200)
+            weights = scoring.weight_vector(algorithm, out_of, 3)
+            expected = reference_tally(nominations, vote_sets, out_of, voting_algorithm)
+            assert_same_results(tally.tally(nominations, vote_sets, weights, engine), expected)
+
+    @pytest.mark.parametrize('engine', [tally.PYTHON, pytest.param(tally.NUMPY, marks=requires_numpy)])
+    def test_positions_past_weights(self, engine):
+        results = tally.tally([(0, 'a'), (1, 'b'), (2, 'c')], [[0, 1, 2], [2, 1]], (3, 1), engine)
+        assert [(item['nomination_id'], item['votes']) for item in results] == [(0, 3), (2, 3), (1, 2)]
+
+    @pytest.mark.parametrize('engine', [tally.PYTHON, pytest.param(tally.NUMPY, marks=requires_numpy)])
+    def test_empty(self, engine):
+        assert tally.tally([], [[1, 2]], (), engine) == []
+        assert tally.tally([(0, 'nom')], [[0]], (), engine) == [{'nomination': 'nom', 'nomination_id': 0, 'votes': 0}]
+        results = tally.tally([(0, 'nom')], [], (1,), engine)
+        assert results == [{'nomination': 'nom', 'nomination_id': 0, 'votes': 0}]
+
+    @requires_numpy
+    def test_numpy_integral_votes(self):
+        results = tally.numpy_tally([(0, 'a'), (1, 'b')], [[1, 0], ['1']], (2, 1))
+        assert results[0] == {'nomination': 'b', 'nomination_id': 1, 'votes': 4}
+        assert isinstance(results[0]['votes'], int)
+
+    def test_unknown_engine(self):
+        with pytest.raises(ValueError):
+            tally.tally([], [], (), 'unknown')
+
+    @pytest.mark.parametrize('engine', [tally.PYTHON, pytest.param(tally.NUMPY, marks=requires_numpy)])
+    def test_calculate_votes(self, monkeypatch, engine):
+        monkeypatch.setattr(Quidem, 'tally_engine', engine)
+
+        quidem = Quidem()
+        quidem.nominate(Quidem.AUTHOR, 'anom1')
+        quidem.nominate(Quidem.AUTHOR, 'anom2')
+        quidem.nominate(2, 'nom1')
+        quidem.nominate(3, 'nom2')
+        quidem._phase = Phase.POST_VOTING
+        quidem._votes = {
+            1: ['0', '-2', '1'],
+            2: [-3, 0],
+            3: ['5', 1]
+        }
+
+        quidem.next_phase()
+
+        assert [item['nomination_id'] for item in quidem.get_results()] == [0, 1, -3, -2]
+        assert [item['votes'] for item in quidem.get_results()] == [5, 3, 3, 2]
+        assert quidem._nominations.user_nominations == {-2: 'nom1', -3: 'nom2'}
+
+class TestRunningTally:
+
+    @pytest.fixture
+    def quidem(self):
+        quidem = Quidem()
+        quidem._phase = Phase.PRE_VOTING
+        quidem.nominate(Quidem.AUTHOR, 'anom1')
+        quidem.nominate(Quidem.AUTHOR, 'anom2')
+        quidem.nominate(2, 'nom1')
+        quidem.nominate(3, 'nom2')
+        quidem._consumers = {1: None, 2: None, 3: None}
+        quidem.next_phase()
+        return quidem
+
+    @pytest.mark.parametrize('algorithm', TestTally.ALGORITHMS)
+    def test_parity(self, algorithm):
+        voting_algorithm = VotingAlgorithm.get_algorithm(algorithm)
+        nominations, vote_sets, out_of = random_session(0, 300)
+        running_tally = tally.RunningTally(nominations, out_of, 3)
+        for vote_set in vote_sets:
+            running_tally.add(vote_set)
+        running_tally.results(scoring.weight_vector(VotingAlgorithm.linear.value, out_of, 3))
+        # replaces every other ballot
+        for i in range(0, len(vote_sets), 2):
+            running_tally.remove(vote_sets[i])
+            vote_sets[i] = vote_sets[i][::-1]
+            running_tally.add(vote_sets[i])
+        expected = reference_tally(nominations, vote_sets, out_of, voting_algorithm)
+        assert_same_results(running_tally.results(scoring.weight_vector(algorithm, out_of, 3)), expected)
+
+    # fractional weights are applied to whole ballot counts, withdrawing ballots leaves no rounding behind
+    def test_no_drift(self):
+        nominations, vote_sets, out_of = random_session(1, 1000)
+        weights = scoring.weight_vector(scoring.DOWDALL, out_of, 3)
+        running_tally = tally.RunningTally(nominations, out_of, 3)
+        for vote_set in vote_sets:
+            running_tally.add(vote_set)
+        running_tally.results(weights)
+        for vote_set in vote_sets[1:]:
+            running_tally.remove(vote_set)
+
+        expected = {nomination_id: 0 for nomination_id, _ in nominations}
+        for i, nomination_id in enumerate(vote_sets[0]):
+            if int(nomination_id) in expected:
+                expected[int(nomination_id)] = weights[i]
+        assert {item['nomination_id']: item['votes'] for item in running_tally.scores(weights)} == expected
+
+    def test_vote_replaces_ballot(self, quidem):
+        assert quidem.vote(1, ['0', -2, 1])
+        assert quidem.vote(2, [-3])
+        assert [item['votes'] for item in quidem.get_leaderboard()] == [3, 3, 2, 1]
+
+        assert quidem.vote(1, [1])
+        leaderboard = quidem.get_leaderboard()
+        assert [item['nomination_id'] for item in leaderboard] == [1, -3, 0, -2]
+        assert [item['votes'] for item in leaderboard] == [3, 3, 0, 0]
+        assert quidem.get_vote(1) == [1]
+
+    def test_voting_algorithm_change(self, quidem):
+        quidem.vote(1, [0, 1])
+        quidem.vote(2, [0])
+        quidem.get_leaderboard()
+
+        quidem.settings['voting_algorithm'] = VotingAlgorithm.square.value
+        assert [item['votes'] for item in quidem.get_leaderboard()] == [18, 4, 0, 0]
+
+        quidem.vote(3, [1])
+        assert [item['votes'] for item in quidem.get_leaderboard()] == [18, 13, 0, 0]
+
+    def test_close_uses_running_tally(self, quidem):
+        quidem.vote(1, [0, 1, -3, -2])
+        quidem.next_phase()
+        quidem.next_phase()
+        assert quidem.get_results() == quidem.get_leaderboard()
+        assert [item['nomination_id'] for item in quidem.get_results()] == [0, 1, -3, -2]
+
+    def test_registered_rule(self, quidem):
+        quidem.settings['voting_algorithm'] = scoring.DOWDALL
+        quidem.vote(1, [-2, 0])
+        quidem.vote(2, [0, -2, 1])
+        leaderboard = quidem.get_leaderboard()
+        assert [item['nomination_id'] for item in leaderboard] == [0, -2, 1, -3]
+        assert [item['votes'] for item in leaderboard] == pytest.approx([1.5, 1.5, 1 / 3, 0])
+
+    def test_invalid_vote_set(self, quidem):
+        with pytest.raises(ActionError):
+            quidem.vote(1, ['nomination'])
+        assert quidem.get_vote(1) is None
@@ -0,0 +1,62 @@
+import pytest
+
+import json
+
+from ... import wire
+from ...wire import splice_json, intern_keys, extern_keys, negotiate
+
+needs_msgpack = pytest.mark.skipif(wire.msgpack is None, reason='msgpack is not installed')
+
+STATE = {
+    'settings': {'max_voting_slots': 3, 'question': 'lunch?'},
+    'users': {'1': 'Bob', '2': 'Alice'},
+    'phase': 3,
+    'calculated_votes': [],
+    'nominations': [{'nomination': 'pizza', 'nomination_id': -1}, {'nomination': 'sushi', 'nomination_id': 0}]
+}
+
+class TestWire:
+
+    def test_splice_json(self):
+        assert json.loads(splice_json(b'{"a": 1}', {'b': [2]})) == {'a': 1, 'b': [2]}
+        assert json.loads(splice_json('{}', {'b': 2})) == {'b': 2}
+        assert splice_json('{"a": 1}', {}) == '{"a": 1}'
+
+    def test_intern_keys(self):
+        interned = intern_keys(STATE)
+        assert interned[wire.KEY_IDS['users']] == {'1': 'Bob', '2': 'Alice'}
+        assert interned[wire.KEY_IDS['nominations']][0] == {wire.KEY_IDS['nomination']: 'pizza', wire.KEY_IDS['nomination_id']: -1}
+        assert extern_keys(interned) == STATE
+
+    def test_negotiate(self):
+        assert negotiate(None) is wire.DEFAULT
+        assert negotiate(None).subprotocol is None
+        assert negotiate(['chat', 'quidem.json']) is wire.JSON
+        expected = wire.MSGPACK if wire.msgpack is not None else wire.JSON
+        assert negotiate(['quidem.msgpack', 'quidem.json']) is expected
+
+    def test_json_frames(self):
+        encoded = json.dumps(STATE).encode()
+        state = json.loads(wire.JSON.state_frame(4, encoded, {'vote': None, 'user': 1}))
+        assert state == {'type': 'state', 'version': 4, 'state': dict(STATE, vote=None, user=1)}
+        delta = json.loads(wire.JSON.delta_frame(5, 4, b'{"set": {"phase": 4}}', {'vote': [0]}))
+        assert delta == {'type': 'state_delta', 'version': 5, 'base_version': 4, 'delta': {'set': {'phase': 4}}, 'vote': [0]}
+
+    @needs_msgpack
+    def test_msgpack_frames(self):
+        encoded = json.dumps(STATE).encode()
+        codec = wire.MSGPACK
+        fields = {'vote': None, 'user': 1, 'nickname': 'Bob'}
+        assert codec.decode(codec.state_frame(4, encoded, fields)) == json.loads(wire.JSON.state_frame(4, encoded, fields))
+        delta = b'{"set": {"phase": 4}, "unset": ["nominations"]}'
+        assert codec.decode(codec.delta_frame(5, 4, delta, {'vote': [0]})) == json.loads(wire.JSON.delta_frame(5, 4, delta, {'vote': [0]}))
+        assert codec.decode(codec.encode({'action': 1, 'body': {'vote_set': [0, -1]}})) == {'action': 1, 'body': {'vote_set': [0, -1]}}
+
+    # maps of every header size
+    @needs_msgpack
+    @pytest.mark.parametrize('size', [0, 14, 15, 16, 0x10000])
+    def test_splice_msgpack(self, size):
+        obj = {f'k{index}': index for index in range(size)}
+        spliced = wire.splice_msgpack(wire.msgpack.packb(obj), {'vote': [1]})
+        assert wire.msgpack.unpackb(spliced, strict_map_key=False) == {wire.KEY_IDS['vote']: [1], **obj}
+        assert wire.splice_msgpack(wire.msgpack.packb(obj), {}) == wire.msgpack.packb(obj)
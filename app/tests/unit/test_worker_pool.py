@@ -0,0 +1,281 @@
+import pytest
+
+import asyncio
+import logging
+
+from channels.layers import InMemoryChannelLayer
+from django.core.exceptions import ImproperlyConfigured
+
+from ...quidem import Quidem, Action, Phase
+from ... import session_store, worker_pool
+from ...session_store import InMemorySessionStore
+from ...worker_pool import HashRing, WorkerPool, QuidemWorker, get_worker_pool, rebalance, request_report
+
+WORKERS = ['quidem-worker-0', 'quidem-worker-1', 'quidem-worker-2']
+
+# the tests run in one process, a store in memory stands in for the redis the url points at
+# and a file based cache, which processes share as well, for the cache of the session ids
+@pytest.fixture
+def shared_store(monkeypatch, settings, tmp_path):
+    settings.QUIDEM_SESSION_STORE_URL = 'redis://127.0.0.1:6379/0'
+    settings.CACHES = {**settings.CACHES, 'quidem': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': str(tmp_path / 'cache')}}
+    settings.QUIDEM_SESSION_ID_CACHE = 'quidem'
+    store = InMemorySessionStore()
+    monkeypatch.setattr(session_store, '_session_store', store)
+    monkeypatch.setattr(worker_pool, '_pool_workers', None)
+    return store
+
+class TestHashRing:
+
+    def test_get(self):
+        ring = HashRing(WORKERS)
+        assert ring.nodes == WORKERS
+        assert {ring.get(key) for key in range(1000)} == set(WORKERS)
+        # the same key always lands on the same node
+        assert [ring.get(key) for key in range(100)] == [HashRing(reversed(WORKERS)).get(key) for key in range(100)]
+
+    def test_empty(self):
+        with pytest.raises(LookupError):
+            HashRing().get(1)
+
+    def test_balance(self):
+        ring = HashRing(WORKERS)
+        counts = {worker: 0 for worker in WORKERS}
+        for key in range(3000):
+            counts[ring.get(key)] += 1
+        assert min(counts.values()) > 600
+
+    # only the keys of the new node move, and only onto it
+    def test_add_moves_few_keys(self):
+        ring = HashRing(WORKERS)
+        before = {key: ring.get(key) for key in range(3000)}
+        ring.add('quidem-worker-3')
+        moved = [key for key in before if ring.get(key) != before[key]]
+        assert 0 < len(moved) < 3000 / 3
+        assert {ring.get(key) for key in moved} == {'quidem-worker-3'}
+
+    def test_remove(self):
+        ring = HashRing(WORKERS)
+        before = {key: ring.get(key) for key in range(1000)}
+        ring.remove('quidem-worker-1')
+        assert ring.nodes == ['quidem-worker-0', 'quidem-worker-2']
+        for key, node in before.items():
+            if node != 'quidem-worker-1':
+                assert ring.get(key) == node
+
+class TestWorkerPool:
+
+    def test_session_counts(self):
+        pool = WorkerPool(WORKERS)
+        for quidem_id in range(1, 31):
+            assert pool.assign(quidem_id) == pool.worker_for(quidem_id)
+        pool.release(1)
+        counts = pool.session_counts()
+        assert set(counts) == set(WORKERS)
+        assert sum(counts.values()) == 29
+
+    def test_add_worker(self):
+        pool = WorkerPool(WORKERS)
+        for quidem_id in range(1, 301):
+            pool.assign(quidem_id)
+        moved = pool.add_worker('quidem-worker-3')
+        assert moved
+        assert all(new == 'quidem-worker-3' for _, new in moved.values())
+        assert pool.session_counts()['quidem-worker-3'] == len(moved)
+
+    def test_get_worker_pool(self, settings, shared_store):
+        settings.QUIDEM_WORKERS = []
+        assert get_worker_pool() is None
+        settings.QUIDEM_WORKERS = WORKERS
+        assert get_worker_pool().workers == WORKERS
+
+    # a store in memory would lose the sessions handed over between worker processes
+    def test_needs_shared_store(self, settings):
+        settings.QUIDEM_WORKERS = WORKERS
+        settings.QUIDEM_SESSION_STORE_URL = None
+        with pytest.raises(ImproperlyConfigured):
+            get_worker_pool()
+        with pytest.raises(ImproperlyConfigured):
+            QuidemWorker()
+
+    # session ids kept in each worker process would collide
+    def test_needs_shared_session_ids(self, settings):
+        settings.QUIDEM_WORKERS = WORKERS
+        settings.QUIDEM_SESSION_STORE_URL = 'redis://127.0.0.1:6379/0'
+        with pytest.raises(ImproperlyConfigured):
+            get_worker_pool()
+
+@pytest.mark.asyncio
+class TestQuidemWorker:
+
+    @pytest.fixture(autouse=True)
+    def store(self, settings, shared_store):
+        settings.QUIDEM_WORKERS = WORKERS[:2]
+        settings.QUIDEM_BROADCAST_WINDOW = 0
+        return shared_store
+
+    @pytest.fixture
+    def layer(self):
+        return InMemoryChannelLayer()
+
+    @pytest.fixture
+    def get_worker(self, layer):
+        def inner(channel):
+            worker = QuidemWorker()
+            worker.scope = {'type': 'channel', 'channel': channel}
+            worker.channel_layer = layer
+            return worker
+        return inner
+
+    # reads the author state broadcast to the author group
+    async def receive_author_state(self, layer, channel):
+        message = await layer.receive(channel)
+        while message['type'] != 'send_updated_state' or not message['author']:
+            message = await layer.receive(channel)
+        return message
+
+    async def test_hosts_session(self, layer, get_worker):
+        worker = get_worker(WORKERS[0])
+        await layer.group_add('author_quidem_1', 'author')
+        await worker.quidem_host({'type': 'quidem.host', 'quidem_id': 1})
+        assert sorted(worker.hosts) == [1]
+        version = worker.hosts[1].quidem.version
+        assert (await self.receive_author_state(layer, 'author'))['version'] == version
+
+        await worker.process_action({'type': 'process_action', 'quidem_id': 1, 'content': {'action': Action.NEXT_PHASE.value}, 'sender': Quidem.AUTHOR})
+        assert worker.hosts[1].quidem.phase is Phase.PRE_VOTING
+        assert (await self.receive_author_state(layer, 'author'))['version'] == version + 1
+
+        # messages of sessions the worker does not host and that are not stored are dropped
+        await worker.process_action({'type': 'process_action', 'quidem_id': 2, 'content': {'action': Action.NEXT_PHASE.value}, 'sender': Quidem.AUTHOR})
+        assert sorted(worker.hosts) == [1]
+
+        await worker.pool_report({'type': 'pool.report', 'reply_channel': 'report'})
+        assert await layer.receive('report') == {'type': 'pool.sessions', 'worker': WORKERS[0], 'sessions': [1]}
+
+    async def test_close_session(self, store, layer, get_worker):
+        store.save(Quidem(quidem_id=1), 0)
+        worker = get_worker(WORKERS[0])
+        await worker.quidem_host({'type': 'quidem.host', 'quidem_id': 1, 'revision': 1})
+        await worker.process_action({'type': 'process_action', 'quidem_id': 1, 'content': {'action': Action.CLOSE_SESSION.value}, 'sender': Quidem.AUTHOR})
+        assert worker.hosts == {}
+        assert store.load(1) == (0, None)
+
+    # the old worker saves the session, the new one picks it up from the store and the late messages are forwarded
+    async def test_rebalance(self, store, layer, get_worker):
+        old = get_worker(WORKERS[0])
+        quidem_id = next(quidem_id for quidem_id in range(1, 100) if WorkerPool(WORKERS).worker_for(quidem_id) == WORKERS[2])
+        await old.quidem_host({'type': 'quidem.host', 'quidem_id': quidem_id})
+        await old.process_action({'type': 'process_action', 'quidem_id': quidem_id, 'content': {'action': Action.NEXT_PHASE.value}, 'sender': Quidem.AUTHOR})
+
+        await old.pool_rebalance({'type': 'pool.rebalance', 'workers': [WORKERS[2]]})
+        assert old.hosts == {}
+        assert old.moved == {quidem_id: WORKERS[2]}
+        assert store.load(quidem_id)[1].phase is Phase.PRE_VOTING
+
+        handed_over = await layer.receive(WORKERS[2])
+        assert handed_over == {'type': 'quidem.host', 'quidem_id': quidem_id, 'revision': 1}
+        owner = get_worker(WORKERS[2])
+        await owner.quidem_host(handed_over)
+        assert owner.hosts[quidem_id].quidem.phase is Phase.PRE_VOTING
+
+        late = {'type': 'response.to.join.request', 'quidem_id': quidem_id, 'channel_name': 'joiner', 'nickname': 'Carol'}
+        await old.response_to_join_request(late)
+        forwarded = await layer.receive(WORKERS[2])
+        while forwarded['type'] == 'send_updated_state':
+            forwarded = await layer.receive(WORKERS[2])
+        assert forwarded == late
+
+    # the new owner carries on with the action log the old worker wrote
+    async def test_hand_over_log(self, settings, tmp_path, layer, get_worker):
+        settings.QUIDEM_ACTION_LOG_DIR = str(tmp_path)
+        old = get_worker(WORKERS[0])
+        quidem_id = next(quidem_id for quidem_id in range(1, 100) if WorkerPool(WORKERS).worker_for(quidem_id) == WORKERS[2])
+        await old.quidem_host({'type': 'quidem.host', 'quidem_id': quidem_id})
+        await old.process_action({'type': 'process_action', 'quidem_id': quidem_id, 'content': {'action': Action.NEXT_PHASE.value}, 'sender': Quidem.AUTHOR})
+        await old.pool_rebalance({'type': 'pool.rebalance', 'workers': [WORKERS[2]]})
+
+        owner = get_worker(WORKERS[2])
+        await owner.quidem_host({'type': 'quidem.host', 'quidem_id': quidem_id, 'revision': 1})
+        assert owner.hosts[quidem_id].action_log.seq == 1
+        owner.hosts[quidem_id].release()
+
+    # a handed over session missing from the store is never replaced by an empty one
+    async def test_handed_over_session_missing(self, layer, get_worker, caplog):
+        worker = get_worker(WORKERS[0])
+        with caplog.at_level(logging.ERROR, logger='app.worker_pool'):
+            await worker.quidem_host({'type': 'quidem.host', 'quidem_id': 1, 'revision': 1})
+        assert 'handed over at revision 1' in caplog.text
+        assert worker.hosts == {}
+
+    # the session is saved at the revision it was loaded at, a worker that saved it since then wins and the session stays
+    async def test_hand_over_conflict(self, store, layer, get_worker):
+        store.save(Quidem(quidem_id=1), 0)
+        worker = get_worker(WORKERS[0])
+        await worker.quidem_host({'type': 'quidem.host', 'quidem_id': 1, 'revision': 1})
+        assert worker.hosts[1].revision == 1
+        store.save(Quidem(quidem_id=1), 1)
+
+        await worker.pool_rebalance({'type': 'pool.rebalance', 'workers': [WORKERS[1]]})
+        assert sorted(worker.hosts) == [1]
+        assert worker.moved == {}
+
+    # while the session moves both workers are in its author group, the copy the old worker forwards is dropped
+    async def test_hand_over_duplicates(self, store, layer, get_worker):
+        old = get_worker(WORKERS[0])
+        quidem_id = next(quidem_id for quidem_id in range(1, 100) if WorkerPool(WORKERS).worker_for(quidem_id) == WORKERS[2])
+        await old.quidem_host({'type': 'quidem.host', 'quidem_id': quidem_id})
+        await old.pool_rebalance({'type': 'pool.rebalance', 'workers': [WORKERS[2]]})
+        owner = get_worker(WORKERS[2])
+        await owner.quidem_host({'type': 'quidem.host', 'quidem_id': quidem_id, 'revision': 1})
+
+        message = {'type': 'process_action', 'quidem_id': quidem_id, 'message_id': 'author:0', 'content': {'action': Action.NEXT_PHASE.value}, 'sender': Quidem.AUTHOR}
+        await owner.process_action(dict(message))
+        await old.process_action(dict(message))
+        forwarded = await layer.receive(WORKERS[2])
+        while forwarded['type'] != 'process_action':
+            forwarded = await layer.receive(WORKERS[2])
+        await owner.process_action(forwarded)
+        assert owner.hosts[quidem_id].quidem.phase is Phase.PRE_VOTING
+
+    # a session hosted by a worker goes away with its author, and is not picked up again by the messages it sent itself
+    async def test_author_left(self, store, layer, get_worker):
+        worker = get_worker(WORKERS[0])
+        await worker.quidem_host({'type': 'quidem.host', 'quidem_id': 1})
+        host = worker.hosts[1]
+        await worker.author_left({'type': 'author.left', 'quidem_id': 1})
+        assert worker.hosts == {}
+        assert host.released
+        await worker.flush_broadcast({'type': 'flush.broadcast', 'quidem_id': 1})
+        assert worker.hosts == {}
+
+    # a message the host fails on is logged, the worker goes on with its other sessions
+    async def test_failing_message(self, layer, get_worker, caplog):
+        worker = get_worker(WORKERS[0])
+        await worker.quidem_host({'type': 'quidem.host', 'quidem_id': 1})
+        with caplog.at_level(logging.ERROR, logger='app.worker_pool'):
+            await worker.send_state_snapshot({'type': 'send_state_snapshot', 'quidem_id': 1})
+        assert 'Quidem 1 failed to handle send_state_snapshot' in caplog.text
+        assert sorted(worker.hosts) == [1]
+
+    # the workers leaving the pool are told as well, and new sessions are routed to the new pool
+    async def test_rebalance_pool(self, layer):
+        await rebalance(layer, [WORKERS[1], WORKERS[2]])
+        assert get_worker_pool().workers == [WORKERS[1], WORKERS[2]]
+        for worker in WORKERS:
+            assert await layer.receive(worker) == {'type': 'pool.rebalance', 'workers': [WORKERS[1], WORKERS[2]]}
+
+    async def test_request_report(self, layer, get_worker):
+        worker = get_worker(WORKERS[0])
+        await worker.quidem_host({'type': 'quidem.host', 'quidem_id': 1})
+
+        # the worker is in the author group, the broadcast state arrives on its channel first
+        async def answer():
+            message = await layer.receive(WORKERS[0])
+            while message['type'] != 'pool.report':
+                message = await layer.receive(WORKERS[0])
+            await worker.pool_report(message)
+        task = asyncio.ensure_future(answer())
+        # the second worker never answers
+        assert await request_report(layer, WORKERS[:2], timeout=0.1) == {WORKERS[0]: [1]}
+        await task
@@ -1,20 +1,27 @@
 from django.contrib import admin
 from django.urls import path
-from django.http import JsonResponse
-from django.core.cache import cache
+from django.http import JsonResponse, HttpResponse, Http404
 from django.views.decorators.http import require_POST
 from django.views.decorators.csrf import csrf_exempt
 
-cache.set('next_quidem_id', 0, None)
+from .session_ids import allocate_session
+from . import metrics
 
 @csrf_exempt
 @require_POST
 def create_quidem(request):
     return JsonResponse({
-        'session_id': cache.get('next_quidem_id')
+        'session_id': allocate_session()
     })
     # Redirect user to quidem app / websocket endpoint
 
+# metrics of this process in the Prometheus text format, only served when QUIDEM_METRICS is set
+def metrics_view(request):
+    if not metrics.enabled():
+        raise Http404('Metrics are disabled')
+    return HttpResponse(metrics.REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 urlpatterns = [
     path('create/', create_quidem),
+    path('metrics/', metrics_view),
 ]
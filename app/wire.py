@@ -0,0 +1,149 @@
+import functools
+import json
+
+try:
+    import msgpack
+except ImportError: # msgpack is optional, clients then only get JSON
+    msgpack = None
+
+# Encodings of the frames sent over the websocket, negotiated through the websocket subprotocol
+#
+# quidem.json - JSON text frames, also used when the client asks for no subprotocol
+# quidem.msgpack - MessagePack binary frames, map keys found in KEYS are sent as their index
+#
+# state and delta messages arrive from the session host as JSON already, each codec wraps them into a frame
+# and adds the fields of the consumer without going through the whole state again
+
+# keys interned by the binary encoding, clients hold the same table so new keys only ever go at the end
+KEYS = (
+    'type', 'version', 'base_version', 'state', 'delta', 'key', 'consumer_id', 'user', 'nickname',
+    'vote', 'votes', 'users', 'settings', 'phase', 'nominations', 'nomination', 'nomination_id',
+    'calculated_votes', 'voting_algorithm', 'max_voting_slots', 'question', 'set', 'unset', 'patch',
+    'action', 'body', 'vote_set', 'applied', 'results', 'status', 'error'
+)
+KEY_IDS = {key: index for index, key in enumerate(KEYS)}
+
+# adds fields to a JSON encoded object without decoding it
+def splice_json(encoded, fields):
+    if isinstance(encoded, bytes):
+        encoded = encoded.decode()
+    if not fields:
+        return encoded
+    spliced = json.dumps(fields)
+    if encoded == '{}':
+        return spliced
+    return spliced[:-1] + ', ' + encoded[1:]
+
+# replaces the map keys found in KEYS by their index, values are left as they are
+def intern_keys(obj):
+    if isinstance(obj, dict):
+        return {KEY_IDS.get(key, key): intern_keys(value) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [intern_keys(item) for item in obj]
+    return obj
+
+def extern_keys(obj):
+    if isinstance(obj, dict):
+        return _extern_pairs((key, extern_keys(value)) for key, value in obj.items())
+    elif isinstance(obj, list):
+        return [extern_keys(item) for item in obj]
+    return obj
+
+# the same, as hooks of the decoders so the keys are swapped while decoding
+def _intern_pairs(pairs):
+    return {KEY_IDS.get(key, key): value for key, value in pairs}
+
+def _extern_pairs(pairs):
+    return {(KEYS[key] if type(key) is int and 0 <= key < len(KEYS) else key): value for key, value in pairs}
+
+class JsonCodec():
+
+    binary = False
+
+    def __init__(self, subprotocol):
+        self.subprotocol = subprotocol
+
+    def encode(self, obj):
+        return json.dumps(obj)
+
+    def decode(self, data):
+        return json.loads(data)
+
+    # the fields of the consumer go into the state, next to the shared view
+    def state_frame(self, version, state, fields):
+        return f'{{"type": "state", "version": {version}, "state": {splice_json(state, fields)}}}'
+
+    # the fields of the consumer go next to the delta, they are set on the state as is
+    def delta_frame(self, version, base_version, delta, fields):
+        return splice_json(
+            f'{{"type": "state_delta", "version": {version}, "base_version": {base_version}, "delta": {delta.decode()}}}',
+            fields
+        )
+
+class MsgpackCodec():
+
+    subprotocol = 'quidem.msgpack'
+    binary = True
+
+    def encode(self, obj):
+        return msgpack.packb(intern_keys(obj))
+
+    def decode(self, data):
+        return msgpack.unpackb(data, strict_map_key=False, object_pairs_hook=_extern_pairs)
+
+    def state_frame(self, version, state, fields):
+        return _pack_frame({'type': 'state', 'version': version}, 'state', splice_msgpack(_pack_json(state), fields))
+
+    def delta_frame(self, version, base_version, delta, fields):
+        frame = _pack_frame({'type': 'state_delta', 'version': version, 'base_version': base_version}, 'delta', _pack_json(delta))
+        return splice_msgpack(frame, fields)
+
+# every consumer of a process gets the same shared state, so it is converted once per version
+@functools.lru_cache(maxsize=64)
+def _pack_json(encoded):
+    return msgpack.packb(json.loads(encoded, object_pairs_hook=_intern_pairs))
+
+def _map_header(count):
+    if count <= 0x0f:
+        return bytes([0x80 | count])
+    elif count <= 0xffff:
+        return b'\xde' + count.to_bytes(2, 'big')
+    return b'\xdf' + count.to_bytes(4, 'big')
+
+# returns (entry count, header size) of a packed map
+def _read_map_header(packed):
+    first = packed[0]
+    if 0x80 <= first <= 0x8f:
+        return first & 0x0f, 1
+    elif first == 0xde:
+        return int.from_bytes(packed[1:3], 'big'), 3
+    elif first == 0xdf:
+        return int.from_bytes(packed[1:5], 'big'), 5
+    raise ValueError('Packed object is not a map')
+
+def _pack_entries(fields):
+    return b''.join(msgpack.packb(KEY_IDS.get(key, key)) + msgpack.packb(intern_keys(value)) for key, value in fields.items())
+
+# adds fields to a packed map without unpacking it
+def splice_msgpack(packed, fields):
+    if not fields:
+        return packed
+    count, header_size = _read_map_header(packed)
+    return _map_header(count + len(fields)) + _pack_entries(fields) + packed[header_size:]
+
+# packs fields along with a value that is packed already
+def _pack_frame(fields, key, packed):
+    return _map_header(len(fields) + 1) + _pack_entries(fields) + msgpack.packb(KEY_IDS[key]) + packed
+
+JSON = JsonCodec('quidem.json')
+DEFAULT = JsonCodec(None)
+MSGPACK = MsgpackCodec() if msgpack is not None else None
+
+_codecs = {codec.subprotocol: codec for codec in (JSON, MSGPACK) if codec is not None}
+
+# the first subprotocol offered by the client that is supported, JSON without a subprotocol otherwise
+def negotiate(subprotocols):
+    for subprotocol in subprotocols or ():
+        if subprotocol in _codecs:
+            return _codecs[subprotocol]
+    return DEFAULT
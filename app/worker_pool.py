@@ -0,0 +1,372 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+
+from channels.consumer import AsyncConsumer
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .quidem import Quidem
+from .session_host import SessionHost
+from .session_store import get_session_store, RevisionConflict
+from .action_log import recover_session
+from .profiling import profiled
+from . import session_ids
+
+logger = logging.getLogger(__name__)
+
+# Hosts quidem sessions in a pool of worker processes instead of the consumer of the author
+#
+# each worker is a channels worker listening on its own channel, run with `manage.py runworker <channel>`
+# for every channel in the QUIDEM_WORKERS setting, sessions go to workers by consistent hashing of the quidem_id
+# the worker hosting a session joins its author group in place of the author consumer
+# `manage.py quidem_pool` changes which of those workers the sessions are spread over, the workers that no
+# longer own a session hand it over to its new worker through the session store
+
+# consistent hash ring, adding or removing a node only moves the keys next to its points
+class HashRing():
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self._points = [] # sorted hashes of every point on the ring
+        self._nodes = {} # point hash -> node
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+    @property
+    def nodes(self):
+        return sorted(set(self._nodes.values()))
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            point = self._hash(f'{node}#{replica}')
+            if point not in self._nodes:
+                bisect.insort(self._points, point)
+            self._nodes[point] = node
+
+    def remove(self, node):
+        for replica in range(self.replicas):
+            point = self._hash(f'{node}#{replica}')
+            if self._nodes.get(point) == node:
+                del self._nodes[point]
+                self._points.pop(bisect.bisect_left(self._points, point))
+
+    def get(self, key):
+        if not self._points:
+            raise LookupError('The hash ring has no nodes')
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._nodes[self._points[index]]
+
+# the workers of the pool along with the sessions placed on them
+class WorkerPool():
+
+    def __init__(self, workers=(), replicas=100):
+        self.ring = HashRing(workers, replicas)
+        self._sessions = {} # quidem_id -> worker
+
+    @property
+    def workers(self):
+        return self.ring.nodes
+
+    def worker_for(self, quidem_id):
+        return self.ring.get(quidem_id)
+
+    def assign(self, quidem_id):
+        self._sessions[quidem_id] = self.worker_for(quidem_id)
+        return self._sessions[quidem_id]
+
+    def release(self, quidem_id):
+        self._sessions.pop(quidem_id, None)
+
+    # returns quidem_id -> (old worker, new worker) for the sessions that move
+    def add_worker(self, worker):
+        self.ring.add(worker)
+        return self._rebalance()
+
+    def remove_worker(self, worker):
+        self.ring.remove(worker)
+        return self._rebalance()
+
+    def _rebalance(self):
+        moved = {}
+        for quidem_id, worker in self._sessions.items():
+            owner = self.worker_for(quidem_id)
+            if owner != worker:
+                moved[quidem_id] = (worker, owner)
+                self._sessions[quidem_id] = owner
+        return moved
+
+    def session_counts(self):
+        counts = {worker: 0 for worker in self.workers}
+        for worker in self._sessions.values():
+            counts[worker] += 1
+        return counts
+
+# sessions move between workers through the session store, one kept in memory would lose them on the way
+# and each worker process would hand out the same session ids without a cache shared by all of them
+def check_settings():
+    if not getattr(settings, 'QUIDEM_WORKERS', None):
+        return
+    if not getattr(settings, 'QUIDEM_SESSION_STORE_URL', None):
+        raise ImproperlyConfigured('QUIDEM_WORKERS needs a session store shared by the workers, set QUIDEM_SESSION_STORE_URL')
+    if session_ids.get_shared_cache() is None:
+        raise ImproperlyConfigured('QUIDEM_WORKERS needs session ids shared by the workers, set QUIDEM_SESSION_ID_CACHE')
+
+POOL_KEY = 'quidem_pool_workers'
+
+_pool_workers = None # workers of the pool when there is no shared cache to keep them in
+
+# the workers the sessions are spread over, every worker of QUIDEM_WORKERS until the pool is changed
+# kept in the cache shared by the workers (see session_ids) so every consumer routes to the same pool
+def get_pool_workers():
+    shared_cache = session_ids.get_shared_cache()
+    workers = shared_cache.get(POOL_KEY) if shared_cache is not None else _pool_workers
+    return sorted(workers if workers is not None else getattr(settings, 'QUIDEM_WORKERS', None) or [])
+
+def set_pool_workers(workers):
+    global _pool_workers
+    shared_cache = session_ids.get_shared_cache()
+    if shared_cache is not None:
+        shared_cache.set(POOL_KEY, sorted(workers), None)
+    else:
+        _pool_workers = sorted(workers)
+
+_worker_pool = None
+
+# the current pool, None when sessions are hosted by the author consumers
+def get_worker_pool():
+    global _worker_pool
+    if not getattr(settings, 'QUIDEM_WORKERS', None):
+        return None
+    check_settings()
+    workers = get_pool_workers()
+    if _worker_pool is None or _worker_pool.workers != workers:
+        _worker_pool = WorkerPool(workers)
+    return _worker_pool
+
+# spreads the sessions over the given workers, new sessions go to them right away
+# and every worker of the old or the new pool hands over the sessions it no longer owns
+async def rebalance(channel_layer, workers):
+    previous_workers = get_pool_workers()
+    set_pool_workers(workers)
+    for worker in sorted(set(previous_workers) | set(workers)):
+        await channel_layer.send(
+            worker,
+            {
+                'type': 'pool.rebalance',
+                'workers': sorted(workers)
+            }
+        )
+
+# returns worker -> quidem ids of the sessions it hosts, workers that do not answer within timeout seconds are left out
+async def request_report(channel_layer, workers, timeout=5):
+    reply_channel = await channel_layer.new_channel()
+    for worker in workers:
+        await channel_layer.send(
+            worker,
+            {
+                'type': 'pool.report',
+                'reply_channel': reply_channel
+            }
+        )
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    report = {}
+    while len(report) < len(workers):
+        try:
+            message = await asyncio.wait_for(channel_layer.receive(reply_channel), max(deadline - loop.time(), 0))
+        except asyncio.TimeoutError:
+            break
+        report[message['worker']] = message['sessions']
+    return report
+
+class QuidemWorker(AsyncConsumer):
+
+    SEEN_MESSAGES = 1000 # ids of the latest messages kept for each session, see _dispatch
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        check_settings()
+        self.pool = WorkerPool(get_pool_workers())
+        self.hosts = {} # quidem_id -> SessionHost
+        self.moved = {} # quidem_id -> worker the session was handed over to
+        self.seen = {} # quidem_id -> ids of the latest messages applied to the session, oldest first
+
+    # the channel the worker listens on, also the one it joins the author groups with
+    @property
+    def worker_channel(self):
+        return self.scope['channel']
+
+    ### pool messages
+
+    # hosts a new session, or one handed over by another worker which has to be in the store at the revision it was saved at
+    # a new session replaces whatever an older session with the same id left in the store
+    async def quidem_host(self, message):
+        quidem_id = message['quidem_id']
+        if quidem_id in self.hosts:
+            pass
+        elif message.get('revision') is None:
+            get_session_store().delete(quidem_id)
+            await self._host(Quidem(quidem_id=quidem_id))
+        else:
+            revision, quidem = self._load(quidem_id)
+            if revision < message['revision']:
+                logger.error('Quidem %s was handed over at revision %s but the store holds revision %s', quidem_id, message['revision'], revision)
+                return
+            await self._host(quidem, revision, resume=True)
+        await self.hosts[quidem_id].broadcast_updated_state()
+
+    # hands the sessions this worker no longer owns to their new worker
+    async def pool_rebalance(self, message):
+        self.pool = WorkerPool(message['workers'], self.pool.ring.replicas)
+        for quidem_id in list(self.hosts):
+            self.pool.assign(quidem_id)
+            owner = self.pool.worker_for(quidem_id)
+            if owner != self.worker_channel:
+                try:
+                    await self._hand_over(quidem_id, owner)
+                except RevisionConflict:
+                    logger.warning('Quidem %s stays on %s, another worker saved it since it was loaded', quidem_id, self.worker_channel)
+
+    async def pool_report(self, message):
+        await self.channel_layer.send(
+            message['reply_channel'],
+            {
+                'type': 'pool.sessions',
+                'worker': self.worker_channel,
+                'sessions': sorted(self.hosts)
+            }
+        )
+
+    ### session messages, routed to the host of their quidem_id
+
+    @profiled
+    async def process_action(self, message):
+        await self._dispatch('process_action', message)
+
+    async def disconnect_consumer(self, message):
+        await self._dispatch('disconnect_consumer', message)
+
+    async def author_left(self, message):
+        await self._dispatch('author_left', message, load=False)
+
+    @profiled
+    async def broadcast_updated_state(self, message):
+        await self._dispatch('broadcast_updated_state', message)
+
+    async def flush_broadcast(self, message):
+        await self._dispatch('flush_broadcast', message, load=False)
+
+    async def send_state_snapshot(self, message):
+        await self._dispatch('send_state_snapshot', message)
+
+    async def response_to_join_request(self, message):
+        await self._dispatch('response_to_join_request', message)
+
+    async def admit_joins(self, message):
+        await self._dispatch('admit_joins', message, load=False)
+
+    async def apply_votes(self, message):
+        await self._dispatch('apply_votes', message, load=False)
+
+    # author states are sent to the author group the worker is in, they are only meant for the author consumer
+    async def send_updated_state(self, message):
+        pass
+
+    ### other methods
+
+    async def _host(self, quidem, revision=0, resume=False):
+        host = SessionHost(quidem, self.channel_layer, self.worker_channel, revision, resume)
+        self.hosts[quidem.quidem_id] = host
+        self.moved.pop(quidem.quidem_id, None)
+        self.pool.assign(quidem.quidem_id)
+        await self.channel_layer.group_add(host.get_author_group(), self.worker_channel)
+        return host
+
+    # (revision, quidem) of the session as it was last saved, or as rebuilt from its action log when that is newer
+    # ie. a session that was handed over once and then lost its worker
+    def _load(self, quidem_id):
+        revision, quidem = get_session_store().load(quidem_id)
+        recovered = recover_session(quidem_id)
+        if recovered is not None and (quidem is None or recovered.version > quidem.version):
+            quidem = recovered
+        return revision, quidem
+
+    # sessions handed over to another worker are forwarded to it, unknown ones are picked up from the session store
+    # unless load is unset, ie. for the messages a host sends itself, which mean nothing once it is gone
+    # a message already applied to the session is dropped, see _seen
+    # a failing message is logged, the worker goes on with the other sessions
+    async def _dispatch(self, name, message, load=True):
+        quidem_id = message['quidem_id']
+        host = self.hosts.get(quidem_id)
+        if host is None:
+            if quidem_id in self.moved:
+                await self.channel_layer.send(self.moved[quidem_id], message)
+                return
+            if not load:
+                return
+            revision, quidem = self._load(quidem_id)
+            if quidem is None:
+                return
+            host = await self._host(quidem, revision, resume=True)
+
+        if self._seen(quidem_id, message.get('message_id')):
+            return
+        try:
+            await getattr(host, name)(message)
+        except Exception:
+            logger.exception('Quidem %s failed to handle %s', quidem_id, message.get('type'))
+        if host.closed or host.released:
+            del self.hosts[quidem_id]
+            self.seen.pop(quidem_id, None)
+            self.pool.release(quidem_id)
+            get_session_store().delete(quidem_id)
+            await self.channel_layer.group_discard(host.get_author_group(), self.worker_channel)
+
+    # returns whether the message with this id was already applied to the session, messages without an id are always new
+    # while a session moves the messages sent to its author group reach both workers, and the old one forwards its copies
+    def _seen(self, quidem_id, message_id):
+        if message_id is None:
+            return False
+        seen = self.seen.setdefault(quidem_id, {})
+        if message_id in seen:
+            return True
+        seen[message_id] = None
+        if len(seen) > self.SEEN_MESSAGES:
+            del seen[next(iter(seen))]
+        return False
+
+    # the new owner joins the author group before this worker leaves it, messages that still reach this worker are forwarded
+    # the session stays here when it cannot be saved, ie. RevisionConflict when another worker saved it since it was loaded
+    async def _hand_over(self, quidem_id, owner):
+        host = self.hosts[quidem_id]
+        await host.flush()
+        host.revision = get_session_store().save(host.quidem, host.revision)
+        del self.hosts[quidem_id]
+        self.seen.pop(quidem_id, None)
+        session_log = host.action_log
+        host.release()
+        # the new owner carries on with the log, which has to hold everything recorded here first
+        if session_log is not None:
+            try:
+                await session_log.drain()
+            except OSError:
+                logger.exception('Quidem %s is handed over with an incomplete action log', quidem_id)
+
+        self.moved[quidem_id] = owner
+        await self.channel_layer.group_add(host.get_author_group(), owner)
+        await self.channel_layer.group_discard(host.get_author_group(), self.worker_channel)
+        await self.channel_layer.send(
+            owner,
+            {
+                'type': 'quidem.host',
+                'quidem_id': quidem_id,
+                'revision': host.revision
+            }
+        )